@@ -0,0 +1,69 @@
+"""
+Benchmark rendering ikCam activities with many authors.
+
+Run from the top of the source tree:
+
+    python benchmarks/ikcam.py
+
+For each number of authors, this prints the time it takes to parse and
+render one activity, and that time per author. The time per author should
+stay flat as the number of authors grows.
+"""
+
+import timeit
+
+from wokkel.generic import parseXml
+
+from ikdisplay import aggregator, source
+
+ENTRY = """
+<entry xmlns="http://www.w3.org/2005/Atom">
+  <id>http://ixion.local/activity/833</id>
+  <verb xmlns="http://activitystrea.ms/spec/1.0/">http://mediamatic.nl/ns/anymeta/2010/activitystreams/ikcam</verb>
+  <object xmlns="http://activitystrea.ms/spec/1.0/">
+    <id xmlns="http://www.w3.org/2005/Atom">http://ixion.local/id/613</id>
+    <object-type>http://mediamatic.nl/ns/anymeta/2008/kind/attachment</object-type>
+    <title xmlns="http://www.w3.org/2005/Atom">Group portrait</title>
+    <link xmlns="http://www.w3.org/2005/Atom" rel="figure" href="http://ixion.local/figure/613"/>
+  </object>
+  <target xmlns="http://activitystrea.ms/spec/1.0/">
+    <id xmlns="http://www.w3.org/2005/Atom">http://ixion.local/id/528</id>
+    <title xmlns="http://www.w3.org/2005/Atom">Eurosonic Noorderslag</title>
+  </target>
+%s
+</entry>"""
+
+AUTHOR = """
+  <author>
+    <id>http://ixion.local/id/%(id)d</id>
+    <name>Person %(id)d</name>
+    <uri>http://ixion.local/person/%(id)d/nl</uri>
+  </author>"""
+
+def makePayload(count):
+    authors = ''.join([AUTHOR % {'id': 1000 + i} for i in xrange(count)])
+    return parseXml(ENTRY % authors)
+
+
+
+def main():
+    src = source.IkCamSource()
+    src.activate()
+    src.feed = aggregator.Feed(handle=u'benchmark', language=u'en')
+
+    print "%8s %12s %12s" % ("authors", "usec/item", "usec/author")
+    for count in (1, 10, 50, 100, 200, 500, 1000):
+        payload = makePayload(count)
+        number = max(10, 10000 // count)
+
+        def render():
+            src.format_record(source.parseActivity(payload))
+
+        seconds = min(timeit.repeat(render, repeat=3, number=number))
+        perItem = seconds / number * 1e6
+        print "%8d %12.1f %12.2f" % (count, perItem, perItem / count)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,20 @@
+import collections
+import hashlib
+import re
+import time
+
 from twisted.application import service
 from twisted.internet import defer
 from twisted.python import log
 
 from axiom import item, attributes
 
-from ikdisplay.source import ISource
+from ikdisplay.notification import Notification
+from ikdisplay.ratelimit import TokenBucket
+from ikdisplay.source import ISource, SourceMixin, formatTime
+
+_whitespace = re.compile(r'\s+', re.UNICODE)
+_hashtag = re.compile(r'#\w+', re.UNICODE)
 
 class Feed(item.Item):
     """
@@ -49,33 +59,764 @@ class LoggingAggregator(service.Service):
 
 
 
+def fingerprint(notification):
+    """
+    Return a fingerprint of the content of a notification.
+
+    The fingerprint covers the fields that make up the content, including
+    the URI of the item the notification is about and its number of
+    retweets, so that updates of a collapsed retweet are not dropped. It
+    also covers the origin of the notification, so that different incoming
+    items with the same text, like two votes of one person for the same
+    answer, are not dropped, while a redelivered item is. Statuses are
+    told apart by their URI. The time and the source it came in through are
+    left out, as are differences in case and whitespace, so that the same
+    content rendered by different sources has the same fingerprint.
+
+    @param notification: The notification, or an equivalent C{dict}.
+    @rtype: C{str}
+    """
+    parts = []
+    for key in ('title', 'subtitle', 'html', 'icon', 'picture', 'uri',
+                'retweets'):
+        value = notification.get(key)
+        if value is None:
+            parts.append(u'')
+        else:
+            parts.append(_whitespace.sub(u' ', value).strip().lower())
+    parts.append(getattr(notification, 'origin', None) or u'')
+    return hashlib.sha1(u'\0'.join(parts).encode('utf-8')).digest()
+
+
+
+class DedupeWindow(object):
+    """
+    Bounded set of the most recently seen fingerprints.
+
+    When full, the fingerprint that was seen least recently is dropped. A
+    fingerprint that was first seen more than L{maxAge} seconds ago no
+    longer counts as seen, so that content may be passed on again after a
+    while, even on a quiet feed.
+
+    @ivar size: The maximum number of fingerprints kept.
+    @type size: C{int}
+    @ivar maxAge: Number of seconds a fingerprint is kept, or C{None} for
+        no limit.
+    @type maxAge: C{float}
+    """
+
+    def __init__(self, size, maxAge=None, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self.size = size
+        self.maxAge = maxAge
+        self.clock = clock
+        self._fingerprints = collections.OrderedDict()
+
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+
+    def seen(self, fingerprint):
+        """
+        Check if a fingerprint is in the window, and add it.
+
+        @return: Whether the fingerprint was already in the window.
+        @rtype: C{bool}
+        """
+        fingerprints = self._fingerprints
+        now = self.clock.seconds()
+        if fingerprint in fingerprints:
+            firstSeen = fingerprints.pop(fingerprint)
+            if self.maxAge is None or now - firstSeen <= self.maxAge:
+                fingerprints[fingerprint] = firstSeen
+                return True
+
+        fingerprints[fingerprint] = now
+        if len(fingerprints) > self.size:
+            fingerprints.popitem(last=False)
+        return False
+
+
+
+class Deduplicator(object):
+    """
+    Drops notifications with content recently passed on to the same feed.
+
+    Each feed has a L{DedupeWindow} with the fingerprints of its last
+    L{windowSize} distinct notifications of at most L{maxAge} seconds ago.
+
+    @ivar windowSize: The number of fingerprints remembered per feed.
+    @type windowSize: C{int}
+    @ivar maxAge: Number of seconds a fingerprint is remembered, or C{None}
+        for no limit.
+    @type maxAge: C{float}
+    @ivar checked: The number of notifications checked, per feed.
+    @type checked: C{dict}
+    @ivar hits: The number of notifications dropped, per feed.
+    @type hits: C{dict}
+    """
+
+    def __init__(self, windowSize=512, maxAge=3600, clock=None):
+        self.windowSize = windowSize
+        self.maxAge = maxAge
+        self.clock = clock
+        self.checked = {}
+        self.hits = {}
+        self._windows = {}
+
+
+    def filterNotifications(self, feed, notifications):
+        """
+        Return the notifications that have not recently been seen for a feed.
+
+        @param feed: The handle of the feed.
+        @type feed: C{unicode}
+        @rtype: C{list}
+        """
+        try:
+            window = self._windows[feed]
+        except KeyError:
+            window = self._windows[feed] = DedupeWindow(self.windowSize,
+                                                        self.maxAge,
+                                                        self.clock)
+
+        result = []
+        for notification in notifications:
+            if isinstance(notification, Notification):
+                value = notification.getSerialized(fingerprint)
+            else:
+                value = fingerprint(notification)
+
+            if not window.seen(value):
+                result.append(notification)
+
+        self.checked[feed] = self.checked.get(feed, 0) + len(notifications)
+        hits = len(notifications) - len(result)
+        if hits:
+            self.hits[feed] = self.hits.get(feed, 0) + hits
+        return result
+
+
+    def getMetrics(self):
+        """
+        Return the number of checked and dropped notifications per feed.
+
+        @rtype: C{dict}
+        """
+        return dict((feed, {'checked': checked,
+                            'hits': self.hits.get(feed, 0)})
+                    for feed, checked in self.checked.iteritems())
+
+
+
+class _Overflow(object):
+    """
+    Notifications held back by L{FloodControl} for a feed.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.topics = collections.Counter()
+        self.call = None
+
+
+
+class FloodControl(object):
+    """
+    Holds each feed to a steady rate of notifications.
+
+    Each feed has a L{TokenBucket} that admits L{rate} notifications per
+    second, with bursts of up to L{burst} notifications. The notifications
+    in a batch are considered in order of the priority of their source.
+    Notifications with a positive priority are always let through, and
+    notifications with a negative priority may only use the part of the
+    bucket above L{lowPriorityReserve}.
+
+    Notifications that update an item that was let through before, like
+    the retweet counts of a collapsed status, do not add to the flood and
+    are always let through.
+
+    Notifications over the rate are not passed on. Instead, they are counted
+    and summarized in a notification that is published at most every
+    L{summaryInterval} seconds, mentioning the most frequent hashtags in
+    the held back notifications. The summary is in the language of the
+    feed, looked up in L{store}, and has the time it was made as its meta
+    data.
+
+    @ivar publish: Callable that takes a feed handle and a list of
+        notifications, to publish summaries with.
+    @ivar rate: Number of notifications per second to let through.
+    @type rate: C{float}
+    @ivar burst: Maximum number of notifications to let through at once.
+    @type burst: C{float}
+    @ivar lowPriorityReserve: Fraction of the bucket that is reserved for
+        notifications that do not have a negative priority.
+    @type lowPriorityReserve: C{float}
+    @ivar summaryInterval: Number of seconds between summaries.
+    @type summaryInterval: C{float}
+    @ivar maxTopics: Maximum number of hashtags mentioned in a summary.
+    @type maxTopics: C{int}
+    @ivar maxItems: Number of item identifiers let through to remember per
+        feed, to recognize updates.
+    @type maxItems: C{int}
+    @ivar store: The store with the feeds, to look up their language, or
+        C{None} to use English.
+    @type store: L{axiom.store.Store}
+    @ivar passed: The number of notifications let through, per feed.
+    @type passed: C{dict}
+    @ivar held: The number of notifications held back, per feed.
+    @type held: C{dict}
+    """
+
+    lowPriorityReserve = 0.5
+    summaryInterval = 30
+    maxTopics = 3
+    maxItems = 1000
+    store = None
+
+    TEXTS_NL = {
+            'summary_title': u'en nog %d',
+            'summary_topics': u'over %s',
+            }
+    TEXTS_EN = {
+            'summary_title': u'and %d more',
+            'summary_topics': u'about %s',
+            }
+
+    def __init__(self, publish, rate, burst, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self.publish = publish
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.passed = {}
+        self.held = {}
+        self._buckets = {}
+        self._overflows = {}
+        self._items = {}
+
+
+    def filterNotifications(self, feed, notifications):
+        """
+        Return the notifications of a feed that are within its rate.
+
+        The others are held back for the next summary.
+
+        @param feed: The handle of the feed.
+        @type feed: C{unicode}
+        @return: The notifications let through, highest priority first.
+        @rtype: C{list}
+        """
+        try:
+            bucket = self._buckets[feed]
+        except KeyError:
+            bucket = TokenBucket(self.rate, self.burst, self.clock)
+            self._buckets[feed] = bucket
+
+        try:
+            items = self._items[feed]
+        except KeyError:
+            items = self._items[feed] = collections.OrderedDict()
+
+        result = []
+        overflow = []
+        notifications = sorted(notifications, reverse=True,
+                               key=lambda n: getattr(n, 'priority', 0))
+        for notification in notifications:
+            priority = getattr(notification, 'priority', 0)
+            itemIdentifier = getattr(notification, 'itemIdentifier', None)
+            if itemIdentifier is not None and itemIdentifier in items:
+                result.append(notification)
+            elif priority > 0:
+                bucket.consume()
+                result.append(notification)
+            else:
+                if priority < 0:
+                    reserve = bucket.capacity * self.lowPriorityReserve
+                else:
+                    reserve = 0
+
+                if bucket.consume(reserve):
+                    result.append(notification)
+                else:
+                    overflow.append(notification)
+
+        for notification in result:
+            itemIdentifier = getattr(notification, 'itemIdentifier', None)
+            if itemIdentifier is not None:
+                items.pop(itemIdentifier, None)
+                items[itemIdentifier] = None
+                if len(items) > self.maxItems:
+                    items.popitem(last=False)
+
+        self.passed[feed] = self.passed.get(feed, 0) + len(result)
+        if overflow:
+            self._hold(feed, overflow)
+        return result
+
+
+    def _hold(self, feed, notifications):
+        try:
+            state = self._overflows[feed]
+        except KeyError:
+            state = self._overflows[feed] = _Overflow()
+
+        state.count += len(notifications)
+        for notification in notifications:
+            text = notification.get('subtitle') or u''
+            state.topics.update(tag.lower() for tag in _hashtag.findall(text))
+
+        self.held[feed] = self.held.get(feed, 0) + len(notifications)
+
+        if state.call is None:
+            state.call = self.clock.callLater(self.summaryInterval,
+                                              self._summarize, feed)
+
+
+    def getTexts(self, feed):
+        """
+        Return the text labels for the language of a feed.
+
+        The time format and names are those of the sources.
+        """
+        language = u'en'
+        if self.store is not None:
+            feedItem = self.store.findFirst(Feed, Feed.handle == feed)
+            if feedItem is not None and feedItem.language in ('nl', 'en'):
+                language = feedItem.language
+
+        attr = 'TEXTS_' + language.upper()
+        texts = dict(getattr(SourceMixin, attr))
+        texts.update(getattr(self, attr))
+        return texts
+
+
+    def _summarize(self, feed):
+        state = self._overflows.pop(feed)
+        texts = self.getTexts(feed)
+
+        summary = Notification(title=texts['summary_title'] % state.count)
+        topics = [topic for topic, count
+                        in state.topics.most_common(self.maxTopics)]
+        if topics:
+            summary['subtitle'] = texts['summary_topics'] % u', '.join(topics)
+        summary['meta'] = formatTime(texts['time_format'],
+                                     time.localtime(self.clock.seconds()),
+                                     texts)
+
+        self.publish(feed, [summary])
+
+
+    def stop(self):
+        """
+        Publish the summaries of all held back notifications now.
+        """
+        for feed, state in self._overflows.items():
+            if state.call.active():
+                state.call.cancel()
+            self._summarize(feed)
+
+
+
+class _Lane(object):
+    """
+    Queue of batches of notifications with the same priority.
+    """
+
+    def __init__(self):
+        self.queue = collections.deque()
+        self.published = 0
+        self.shed = 0
+        self.totalDelay = 0
+        self.maxDelay = 0
+
+
+
+class LaneScheduler(object):
+    """
+    Publishes notifications in order of the priority of their source.
+
+    Batches of notifications are queued in a lane per priority, and at most
+    L{maxPending} batches are being published at the same time. When
+    publishing of a batch has finished, the oldest batch in the lane with
+    the highest priority is published next. When more than L{maxQueued}
+    batches are queued, the oldest batch in the lane with the lowest
+    priority is shed.
+
+    For each lane, the time batches spent queued is measured.
+
+    Batches are published from a loop rather than from the callbacks of
+    earlier batches, so that publishes that finish right away do not nest.
+
+    @ivar publish: Callable that takes a feed handle and a list of
+        notifications, and returns a Deferred that fires when they have been
+        published.
+    @ivar maxPending: Maximum number of batches being published at once.
+    @type maxPending: C{int}
+    @ivar maxQueued: Maximum number of batches queued over all lanes.
+    @type maxQueued: C{int}
+    """
+
+    def __init__(self, publish, maxPending=4, maxQueued=1000, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self.publish = publish
+        self.maxPending = maxPending
+        self.maxQueued = maxQueued
+        self.clock = clock
+        self.pending = 0
+        self.queued = 0
+        self._lanes = {}
+        self._dispatching = False
+
+
+    def enqueue(self, feed, notifications):
+        """
+        Queue notifications for publishing, in lanes by priority.
+
+        @param feed: The handle of the feed.
+        @type feed: C{unicode}
+        """
+        now = self.clock.seconds()
+        batches = {}
+        for notification in notifications:
+            priority = getattr(notification, 'priority', 0)
+            batches.setdefault(priority, []).append(notification)
+
+        for priority, batch in batches.iteritems():
+            try:
+                lane = self._lanes[priority]
+            except KeyError:
+                lane = self._lanes[priority] = _Lane()
+            lane.queue.append((now, feed, batch))
+            self.queued += 1
+
+        while self.queued > self.maxQueued:
+            self._shed()
+
+        self._dispatch()
+
+
+    def _shed(self):
+        """
+        Drop the oldest batch in the lane with the lowest priority.
+        """
+        for priority in sorted(self._lanes):
+            lane = self._lanes[priority]
+            if lane.queue:
+                lane.queue.popleft()
+                lane.shed += 1
+                self.queued -= 1
+                return
+
+
+    def _dispatch(self):
+        """
+        Publish batches, highest priority first, up to L{maxPending}.
+
+        When called while already dispatching, for example because a publish
+        finished right away, this returns at once and the running loop picks
+        up the freed slot.
+        """
+        if self._dispatching:
+            return
+
+        self._dispatching = True
+        try:
+            while self.pending < self.maxPending and self.queued:
+                for priority in sorted(self._lanes, reverse=True):
+                    lane = self._lanes[priority]
+                    if lane.queue:
+                        break
+
+                enqueued, feed, notifications = lane.queue.popleft()
+                self.queued -= 1
+
+                delay = self.clock.seconds() - enqueued
+                lane.published += 1
+                lane.totalDelay += delay
+                lane.maxDelay = max(lane.maxDelay, delay)
+
+                self.pending += 1
+                d = defer.maybeDeferred(self.publish, feed, notifications)
+                d.addErrback(log.err)
+                d.addBoth(self._published)
+        finally:
+            self._dispatching = False
+
+
+    def _published(self, result):
+        self.pending -= 1
+        self._dispatch()
+
+
+    def getMetrics(self):
+        """
+        Return the queue length and queueing delays of each lane.
+
+        @return: Per priority, the number of queued, published and shed
+            batches, and the mean and maximum time published batches
+            spent queued.
+        @rtype: C{dict}
+        """
+        metrics = {}
+        for priority, lane in self._lanes.iteritems():
+            if lane.published:
+                meanDelay = lane.totalDelay / lane.published
+            else:
+                meanDelay = None
+            metrics[priority] = {'queued': len(lane.queue),
+                                 'published': lane.published,
+                                 'shed': lane.shed,
+                                 'meanDelay': meanDelay,
+                                 'maxDelay': lane.maxDelay}
+        return metrics
+
+
+
 class PubSubAggregator(service.Service):
+    """
+    Aggregator that publishes notifications to a node per feed.
+
+    @ivar archive: Archive to add the published notifications to, or
+        C{None}.
+    @type archive: L{ikdisplay.archive.NotificationArchive}
+    @ivar deduplicator: Drops notifications with content that was recently
+        published to the same feed, or C{None}.
+    @type deduplicator: L{Deduplicator}
+    @ivar floodControl: Holds feeds to a steady rate of notifications, or
+        C{None}.
+    @type floodControl: L{FloodControl}
+    @ivar scheduler: Queues notifications to be published in order of
+        priority, or C{None} to publish them right away.
+    @type scheduler: L{LaneScheduler}
+    @ivar history: Keeps the last published notifications of each feed for
+        displays that (re)connect, or C{None}.
+    @type history: L{AggregatorFromNotifier}
+    """
+
     pubsubHandler = None
+    archive = None
+    history = None
+    deduplicator = None
+    floodControl = None
+    scheduler = None
 
     def __init__(self, service):
         self.service = service
 
 
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.floodControl is not None:
+            self.floodControl.stop()
+
+
     def processNotifications(self, feed, notifications):
-        self.pubsubHandler.publishNotifications(self.service, feed,
-                                                notifications)
+        if self.deduplicator is not None:
+            notifications = self.deduplicator.filterNotifications(
+                feed, notifications)
+
+        if self.floodControl is not None and notifications:
+            notifications = self.floodControl.filterNotifications(
+                feed, notifications)
+
+        if not notifications:
+            return
+        elif self.scheduler is not None:
+            self.scheduler.enqueue(feed, notifications)
+        else:
+            self.publishNotifications(feed, notifications)
+
+
+    def publishNotifications(self, feed, notifications):
+        """
+        Publish notifications to the node of a feed, and archive them.
+
+        Notifications are only archived and added to the history once they
+        have been published, so that neither claims a delivery that failed.
+        Failures to publish are logged.
+
+        @return: Deferred that fires when the notifications have been
+            published, or publishing failed.
+        """
+        def published(result):
+            if self.archive is not None:
+                self.archive.addNotifications(feed, notifications)
+            if self.history is not None:
+                self.history.processNotifications(feed, notifications)
+
+        def eb(failure):
+            log.err(failure, "Failed to publish to %r" % feed)
+
+        d = self.pubsubHandler.publishNotifications(self.service, feed,
+                                                    notifications)
+        d.addCallbacks(published, eb)
+        return d
 
 
 
 class AggregatorFromNotifier(service.Service):
+    """
+    Aggregator that passes notifications to a notifier, keeping a history
+    per feed.
+
+    When started, the history of each feed is restored in the background.
+    If L{archive} is set, the last notifications of each archived feed are
+    read from the archive. Otherwise, if L{pubsubHandler} is set, the last
+    notifications published to the nodes of L{feeds} on L{service} are
+    requested, which happens once the XMPP connection has been established.
+    Notifications that come in while restoring are kept after the restored
+    ones, and L{getHistory} waits for the restore to finish. Notifications
+    that update an item already in the history replace it.
+
+    @ivar notifier: Object to pass each notification to with C{notify}, or
+        C{None} to only keep the history.
+    @ivar maxHistory: Maximum number of notifications in the history of a
+        feed.
+    @type maxHistory: C{int}
+    @ivar history: The last notifications, oldest first, by feed handle.
+    @type history: C{dict}
+    @ivar archive: Archive to restore the history from, or C{None}.
+    @type archive: L{ikdisplay.archive.NotificationArchive}
+    @ivar pubsubHandler: Publish-subscribe client to request the
+        notifications of L{feeds} with, or C{None}.
+    @type pubsubHandler: L{ikdisplay.xmpp.PubSubDispatcher}
+    @ivar service: The publish-subscribe service with the nodes of the feeds.
+    @type service: L{JID<twisted.words.protocols.jabber.jid.JID>}
+    @ivar feeds: The handles of the feeds to restore the history of from
+        publish-subscribe.
+    @type feeds: C{list}
+    """
 
     maxHistory = 13
+    archive = None
+    pubsubHandler = None
+    service = None
+    feeds = ()
 
-    def __init__(self, notifier):
+    def __init__(self, notifier=None):
         self.notifier = notifier
-        self.history = []
+        self.history = {}
+        self._restoring = False
+        self._waitingForHistory = []
+
+
+    def startService(self):
+        service.Service.startService(self)
+        self.restoreHistory()
+
+
+    def _mergeHistory(self, history, notifications):
+        """
+        Add notifications to a history, replacing earlier versions.
+
+        A notification with the same item identifier as one already in the
+        history is an update of that item, and replaces it in place.
+
+        @return: The new history, truncated to L{maxHistory}.
+        @rtype: C{list}
+        """
+        history = list(history)
+        positions = {}
+        for index, notification in enumerate(history):
+            positions[getattr(notification, 'itemIdentifier', None)] = index
+
+        for notification in notifications:
+            itemIdentifier = getattr(notification, 'itemIdentifier', None)
+            if itemIdentifier is not None and itemIdentifier in positions:
+                history[positions[itemIdentifier]] = notification
+            else:
+                positions[itemIdentifier] = len(history)
+                history.append(notification)
+        return history[-self.maxHistory:]
 
 
     def processNotifications(self, feed, notifications):
-        map(self.notifier.notify, notifications)
-        self.history.extend(notifications)
-        self.history = self.history[-self.maxHistory:]
+        if self.notifier is not None:
+            map(self.notifier.notify, notifications)
+        self.history[feed] = self._mergeHistory(self.history.get(feed, []),
+                                                notifications)
+
+
+    def _fetchHistory(self):
+        """
+        Retrieve the last notifications from the archive or pubsub nodes.
+
+        @return: Deferred that fires with a dictionary of lists of
+            notifications, oldest first, by feed handle.
+        """
+        if self.archive is not None:
+            history = {}
+            for handle in self.archive.getHandles():
+                history[handle] = [notification
+                                   for timestamp, notification
+                                   in self.archive.getLast(handle,
+                                                           self.maxHistory)]
+            return defer.succeed(history)
+        elif self.pubsubHandler is not None:
+            def eb(failure, handle):
+                log.err(failure, "Failed to retrieve history of %r" % handle)
+                return []
 
+            ds = []
+            for handle in self.feeds:
+                d = self.pubsubHandler.fetchNotifications(self.service, handle,
+                                                          self.maxHistory)
+                d.addErrback(eb, handle)
+                ds.append(d)
 
-    def getHistory(self):
-        return defer.succeed(self.history)
+            d = defer.gatherResults(ds)
+            d.addCallback(lambda results: dict(zip(self.feeds, results)))
+            return d
+        else:
+            return defer.succeed({})
+
+
+    def restoreHistory(self):
+        """
+        Restore the history of each feed from before the last restart.
+
+        @return: Deferred that fires when the history has been restored.
+        """
+        def cb(restored):
+            for handle, notifications in restored.iteritems():
+                self.history[handle] = self._mergeHistory(
+                    [], notifications + self.history.get(handle, []))
+
+        def done(result):
+            self._restoring = False
+            waiting, self._waitingForHistory = self._waitingForHistory, []
+            for handle, d in waiting:
+                d.callback(self.history.get(handle, []))
+            return result
+
+        self._restoring = True
+        d = self._fetchHistory()
+        d.addCallback(cb)
+        d.addErrback(log.err)
+        d.addBoth(done)
+        return d
+
+
+    def getHistory(self, handle):
+        """
+        Return the history of a feed, once it has been restored.
+
+        @param handle: The handle of the feed.
+        @type handle: C{unicode}
+        @return: Deferred that fires with the last notifications of the
+            feed, oldest first.
+        """
+        if self._restoring:
+            d = defer.Deferred()
+            self._waitingForHistory.append((handle, d))
+            return d
+        else:
+            return defer.succeed(self.history.get(handle, []))
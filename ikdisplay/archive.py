@@ -0,0 +1,441 @@
+# -*- test-case-name: ikdisplay.test.test_archive -*-
+
+"""
+Archive of delivered notifications.
+
+Notifications are archived per feed, so that displays that start late, and
+reports after an event, can read back what has been delivered.
+"""
+
+import mmap
+import os
+import re
+import struct
+import urllib
+
+from twisted.application import service
+from twisted.words.xish.domish import escapeToXml
+
+from wokkel.generic import parseXml
+
+from ikdisplay.notification import elementToNotification, notificationToXml
+
+_indexEntry = struct.Struct('>dQI')
+_segmentName = re.compile(r'^(\d{16})\.index$')
+
+def _serializeEntry(notification):
+    """
+    Serialize a notification for the archive.
+
+    If the notification has an item identifier, its serialization is
+    wrapped in an C{item} element with that identifier, so that later
+    updates of the same item can be recognized when reading back.
+
+    @rtype: C{str}
+    """
+    xml = notificationToXml(notification)
+    itemIdentifier = getattr(notification, 'itemIdentifier', None)
+    if itemIdentifier is not None:
+        xml = u"<item id='%s'>%s</item>" % (escapeToXml(itemIdentifier, 1),
+                                             xml)
+    return xml.encode('utf-8')
+
+
+
+def _parseEntry(xml):
+    """
+    Parse a notification serialized with L{_serializeEntry}.
+
+    @type xml: C{str}
+    @rtype: L{Notification<ikdisplay.notification.Notification>}
+    """
+    element = parseXml(xml)
+    if element.name == 'item':
+        notification = elementToNotification(element.firstChildElement())
+        notification.itemIdentifier = element.getAttribute('id')
+    else:
+        notification = elementToNotification(element)
+    return notification
+
+
+
+def _mapFile(path):
+    """
+    Map a file into memory for reading.
+
+    @return: The memory map, or C{None} if the file is empty.
+    @rtype: C{mmap.mmap}
+    """
+    f = open(path, 'rb')
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return None
+        return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+
+
+class FeedArchive(object):
+    """
+    The segments of the archive of a single feed.
+
+    Each segment is a pair of files: a data file with the serialized
+    notifications appended one after another, and an index file with a
+    fixed-width entry per notification, holding its time, and its offset and
+    length in the data file. Index entries are written after the data they
+    point to, so that an entry that points past the end of the data file,
+    or that was only partly written, can be ignored.
+
+    Reading maps the files into memory, and only the index entries and
+    notifications needed are looked at.
+
+    @ivar path: The directory with the segments of this feed.
+    @type path: C{str}
+    @ivar segmentSize: Size in bytes of the data file after which a new
+        segment is started.
+    @type segmentSize: C{int}
+    """
+
+    def __init__(self, path, segmentSize):
+        self.path = path
+        self.segmentSize = segmentSize
+
+        self._data = None
+        self._index = None
+        self._dataSize = 0
+
+
+    def _listSegments(self):
+        """
+        Return the numbers of the segments, oldest first.
+        """
+        if not os.path.exists(self.path):
+            return []
+
+        numbers = []
+        for name in os.listdir(self.path):
+            match = _segmentName.match(name)
+            if match:
+                numbers.append(int(match.group(1)))
+        numbers.sort()
+        return numbers
+
+
+    def _getPaths(self, number):
+        base = os.path.join(self.path, '%016d' % number)
+        return base + '.data', base + '.index'
+
+
+    def _openSegment(self):
+        self.close()
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        numbers = self._listSegments()
+        if numbers:
+            number = numbers[-1] + 1
+        else:
+            number = 0
+
+        dataPath, indexPath = self._getPaths(number)
+        self._data = open(dataPath, 'ab')
+        self._index = open(indexPath, 'ab')
+        self._dataSize = 0
+
+
+    def close(self):
+        """
+        Close the segment currently written to.
+        """
+        if self._data is not None:
+            self._data.close()
+            self._index.close()
+            self._data = None
+            self._index = None
+            self._dataSize = 0
+
+
+    def write(self, entries):
+        """
+        Append serialized notifications to the archive.
+
+        @param entries: Tuples of time and serialized notification.
+        @type entries: C{list}
+        """
+        if self._data is None:
+            self._openSegment()
+
+        data = []
+        index = []
+        offset = self._dataSize
+        for timestamp, xml in entries:
+            data.append(xml)
+            index.append(_indexEntry.pack(timestamp, offset, len(xml)))
+            offset += len(xml)
+
+        self._data.write(''.join(data))
+        self._data.flush()
+        self._index.write(''.join(index))
+        self._index.flush()
+
+        self._dataSize = offset
+        if self._dataSize >= self.segmentSize:
+            self.close()
+
+
+    def _readSegment(self, number):
+        """
+        Map the data and index of a segment into memory.
+
+        @return: The data map, the index map, and the number of valid
+            entries in the index, or C{None} if the segment is empty.
+        """
+        dataPath, indexPath = self._getPaths(number)
+        if not os.path.exists(dataPath):
+            return None
+
+        index = _mapFile(indexPath)
+        if index is None:
+            return None
+
+        data = _mapFile(dataPath)
+        dataSize = data is not None and len(data) or 0
+
+        count = len(index) // _indexEntry.size
+        while count:
+            timestamp, offset, length = _indexEntry.unpack_from(
+                index, (count - 1) * _indexEntry.size)
+            if offset + length <= dataSize:
+                break
+            count -= 1
+
+        if not count:
+            return None
+
+        return data, index, count
+
+
+    def _getEntry(self, segment, position):
+        data, index, count = segment
+        timestamp, offset, length = _indexEntry.unpack_from(
+            index, position * _indexEntry.size)
+        return timestamp, data[offset:offset + length]
+
+
+    def _findSince(self, segment, since):
+        """
+        Return the position of the first entry at or after a time.
+        """
+        data, index, count = segment
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            timestamp = _indexEntry.unpack_from(
+                index, middle * _indexEntry.size)[0]
+            if timestamp < since:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+    def getLast(self, count):
+        """
+        Return the last notifications, oldest first.
+
+        @param count: The maximum number of notifications to return.
+        @type count: C{int}
+        @return: Tuples of time and serialized notification.
+        @rtype: C{list}
+        """
+        entries = []
+        for number in reversed(self._listSegments()):
+            if len(entries) >= count:
+                break
+
+            segment = self._readSegment(number)
+            if segment is None:
+                continue
+
+            position = segment[2]
+            while position and len(entries) < count:
+                position -= 1
+                entries.append(self._getEntry(segment, position))
+
+        entries.reverse()
+        return entries
+
+
+    def getSince(self, since):
+        """
+        Return the notifications archived at or after a time, oldest first.
+
+        @param since: The time to return notifications from.
+        @type since: C{float}
+        @return: Tuples of time and serialized notification.
+        @rtype: C{list}
+        """
+        entries = []
+        for number in self._listSegments():
+            segment = self._readSegment(number)
+            if segment is None:
+                continue
+
+            for position in xrange(self._findSince(segment, since),
+                                   segment[2]):
+                entries.append(self._getEntry(segment, position))
+        return entries
+
+
+
+class NotificationArchive(service.Service):
+    """
+    Append-only archive of delivered notifications, per feed.
+
+    Notifications are stored in their XML serialization, as cached on the
+    notification for publishing, together with their item identifier. Added
+    notifications are buffered and written to disk together, at most
+    L{flushDelay} seconds later, so that archiving does not hold up
+    publishing.
+
+    @ivar path: The directory to keep the archive in, with a subdirectory
+        per feed.
+    @type path: C{str}
+    @ivar flushDelay: Maximum number of seconds added notifications are
+        buffered before they are written.
+    @type flushDelay: C{float}
+    @ivar segmentSize: Size in bytes of the notifications in a segment after
+        which a new segment is started.
+    @type segmentSize: C{int}
+    """
+
+    flushDelay = 1
+    segmentSize = 16 * 1024 * 1024
+
+    def __init__(self, path, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self.path = path
+        self.clock = clock
+
+        self._feeds = {}
+        self._pending = {}
+        self._flushCall = None
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+        self.flush()
+        for feedArchive in self._feeds.itervalues():
+            feedArchive.close()
+
+
+    def _getFeedArchive(self, handle):
+        try:
+            return self._feeds[handle]
+        except KeyError:
+            name = urllib.quote(handle.encode('utf-8'), safe='')
+            feedArchive = FeedArchive(os.path.join(self.path, name),
+                                      self.segmentSize)
+            self._feeds[handle] = feedArchive
+            return feedArchive
+
+
+    def addNotifications(self, handle, notifications):
+        """
+        Add notifications delivered to a feed.
+
+        The notifications are written with the next flush.
+
+        @param handle: The handle of the feed.
+        @type handle: C{unicode}
+        """
+        timestamp = self.clock.seconds()
+        entries = self._pending.setdefault(handle, [])
+        for notification in notifications:
+            entries.append((timestamp, _serializeEntry(notification)))
+
+        if self._flushCall is None:
+            self._flushCall = self.clock.callLater(self.flushDelay,
+                                                   self.flush)
+
+
+    def flush(self, handle=None):
+        """
+        Write buffered notifications to disk.
+
+        @param handle: The handle of the feed to write the notifications of,
+            or C{None} for all feeds.
+        """
+        if handle is None:
+            if self._flushCall is not None:
+                if self._flushCall.active():
+                    self._flushCall.cancel()
+                self._flushCall = None
+            pending, self._pending = self._pending, {}
+        else:
+            pending = {}
+            if handle in self._pending:
+                pending[handle] = self._pending.pop(handle)
+
+        for handle, entries in pending.iteritems():
+            self._getFeedArchive(handle).write(entries)
+
+
+    def getHandles(self):
+        """
+        Return the handles of the feeds that have notifications archived.
+
+        @rtype: C{list} of C{unicode}
+        """
+        handles = set(self._pending)
+        if os.path.exists(self.path):
+            for name in os.listdir(self.path):
+                handles.add(urllib.unquote(name).decode('utf-8'))
+        return sorted(handles)
+
+
+    def getLast(self, handle, count):
+        """
+        Return the last notifications delivered to a feed.
+
+        Buffered notifications of the feed are flushed first. Both the write
+        and the read happen synchronously, blocking the reactor, also when
+        called from a web request.
+
+        @param handle: The handle of the feed.
+        @type handle: C{unicode}
+        @param count: The maximum number of notifications to return.
+        @type count: C{int}
+        @return: Tuples of time and notification, oldest first.
+        @rtype: C{list}
+        """
+        self.flush(handle)
+        entries = self._getFeedArchive(handle).getLast(count)
+        return [(timestamp, _parseEntry(xml))
+                for timestamp, xml in entries]
+
+
+    def getSince(self, handle, since):
+        """
+        Return the notifications delivered to a feed since a time.
+
+        Buffered notifications of the feed are flushed first. Both the write
+        and the read happen synchronously, blocking the reactor, also when
+        called from a web request.
+
+        @param handle: The handle of the feed.
+        @type handle: C{unicode}
+        @param since: The time to return notifications from.
+        @type since: C{float}
+        @return: Tuples of time and notification, oldest first.
+        @rtype: C{list}
+        """
+        self.flush(handle)
+        entries = self._getFeedArchive(handle).getSince(since)
+        return [(timestamp, _parseEntry(xml))
+                for timestamp, xml in entries]
@@ -0,0 +1,297 @@
+# -*- test-case-name: ikdisplay.test.test_journal -*-
+
+"""
+Journal of incoming events.
+
+Raw events, as received from the publish-subscribe service and the Twitter
+Streaming API, are appended to a journal on disk, so that they can be
+replayed through the sources after a crash, or when templates change.
+"""
+
+import os
+import re
+import struct
+import zlib
+
+from twisted.application import service
+from twisted.internet import task
+from twisted.python import log
+
+_recordHeader = struct.Struct('>II')
+_bodyHeader = struct.Struct('>dB')
+_segmentName = re.compile(r'^(\d{16})\.journal$')
+
+class Journal(service.Service):
+    """
+    Append-only, segmented journal of raw incoming events.
+
+    Each record has a kind, naming the type of event, the time it was
+    appended, and the raw event data. Records are written to segment files
+    in a directory, with a length and CRC-32 checksum, so that a record that
+    was only partly written when the process crashed is detected on reading.
+
+    Appended records are buffered and written to disk together, at most
+    L{commitDelay} seconds later, so that appending does not wait for disk
+    I/O. A new segment is started every time the journal is started, and
+    when the current segment has grown beyond L{segmentSize} bytes. The
+    oldest segments are removed when the journal has grown beyond
+    L{maxSize} bytes, or when they were last written more than L{maxAge}
+    seconds ago.
+
+    @ivar path: The directory to store the segments in.
+    @type path: C{str}
+    @ivar handlers: Callables to replay records with, by kind. Each is
+        called with the raw data of the record.
+    @type handlers: C{dict}
+    @ivar commitDelay: Maximum number of seconds appended records are
+        buffered before they are written.
+    @type commitDelay: C{float}
+    @ivar sync: Whether to flush written records to disk with C{fsync}. This
+        blocks the reactor until the disk has written them, so it is off by
+        default.
+    @type sync: C{bool}
+    @ivar segmentSize: Size in bytes after which a new segment is started.
+    @type segmentSize: C{int}
+    @ivar maxSize: Total size in bytes to keep, or C{None} for no limit.
+    @type maxSize: C{int}
+    @ivar maxAge: Number of seconds to keep segments, or C{None} for no limit.
+    @type maxAge: C{float}
+    @ivar pruneInterval: Number of seconds between checks for segments to
+        remove.
+    @type pruneInterval: C{float}
+    """
+
+    commitDelay = 0.1
+    sync = False
+    segmentSize = 16 * 1024 * 1024
+    maxSize = 1024 * 1024 * 1024
+    maxAge = 7 * 24 * 60 * 60
+    pruneInterval = 60 * 60
+
+    def __init__(self, path, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self.path = path
+        self.clock = clock
+        self.handlers = {}
+
+        self._pending = []
+        self._commitCall = None
+        self._file = None
+        self._fileSize = 0
+        self._segmentPath = None
+        self._pruneCall = None
+
+
+    def startService(self):
+        service.Service.startService(self)
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        self._pruneCall = task.LoopingCall(self.prune)
+        self._pruneCall.clock = self.clock
+        self._pruneCall.start(self.pruneInterval)
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+
+        if self._pruneCall is not None and self._pruneCall.running:
+            self._pruneCall.stop()
+        self.commit()
+        self._closeSegment()
+
+
+    def _listSegments(self):
+        """
+        Return the numbers and paths of the segments, oldest first.
+        """
+        segments = []
+        for name in os.listdir(self.path):
+            match = _segmentName.match(name)
+            if match:
+                segments.append((int(match.group(1)),
+                                 os.path.join(self.path, name)))
+        segments.sort()
+        return segments
+
+
+    def _openSegment(self):
+        self._closeSegment()
+
+        segments = self._listSegments()
+        if segments:
+            number = segments[-1][0] + 1
+        else:
+            number = 0
+
+        self._segmentPath = os.path.join(self.path, '%016d.journal' % number)
+        self._file = open(self._segmentPath, 'ab')
+        self._fileSize = 0
+
+
+    def _closeSegment(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._fileSize = 0
+            self._segmentPath = None
+
+
+    def append(self, kind, data, timestamp=None):
+        """
+        Append a record to the journal.
+
+        The record is written with the next commit.
+
+        @param kind: The kind of event, at most 255 bytes.
+        @type kind: C{str}
+        @param data: The raw event data.
+        @type data: C{str}
+        @param timestamp: The time of the event. Defaults to now.
+        @type timestamp: C{float}
+        """
+        if timestamp is None:
+            timestamp = self.clock.seconds()
+
+        body = _bodyHeader.pack(timestamp, len(kind)) + kind + data
+        checksum = zlib.crc32(body) & 0xffffffff
+        self._pending.append(_recordHeader.pack(len(body), checksum))
+        self._pending.append(body)
+
+        if self._commitCall is None:
+            self._commitCall = self.clock.callLater(self.commitDelay,
+                                                    self.commit)
+
+
+    def commit(self):
+        """
+        Write all buffered records to disk at once.
+        """
+        if self._commitCall is not None:
+            if self._commitCall.active():
+                self._commitCall.cancel()
+            self._commitCall = None
+
+        if not self._pending:
+            return
+
+        data = ''.join(self._pending)
+        self._pending = []
+
+        if self._file is None:
+            self._openSegment()
+
+        self._file.write(data)
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+
+        self._fileSize += len(data)
+        if self._fileSize >= self.segmentSize:
+            self._closeSegment()
+            self.prune()
+
+
+    def prune(self):
+        """
+        Remove the oldest segments beyond the maximum size or age.
+
+        The segment currently written to is never removed.
+        """
+        segments = []
+        for number, path in self._listSegments():
+            if path != self._segmentPath:
+                segments.append((path, os.path.getsize(path),
+                                 os.path.getmtime(path)))
+
+        total = sum([size for path, size, mtime in segments])
+        total += self._fileSize
+        now = self.clock.seconds()
+
+        for path, size, mtime in segments:
+            if ((self.maxSize is not None and total > self.maxSize) or
+                (self.maxAge is not None and now - mtime > self.maxAge)):
+                os.remove(path)
+                total -= size
+            else:
+                break
+
+
+    def _readSegment(self, path):
+        f = open(path, 'rb')
+        try:
+            offset = 0
+            while True:
+                header = f.read(_recordHeader.size)
+                if not header:
+                    return
+                elif len(header) < _recordHeader.size:
+                    log.msg("Truncated record in %s at %d" % (path, offset))
+                    return
+
+                length, checksum = _recordHeader.unpack(header)
+                body = f.read(length)
+                if (len(body) < length or
+                    zlib.crc32(body) & 0xffffffff != checksum):
+                    log.msg("Corrupt record in %s at %d" % (path, offset))
+                    return
+
+                timestamp, kindLength = _bodyHeader.unpack_from(body)
+                start = _bodyHeader.size
+                kind = body[start:start + kindLength]
+                yield timestamp, kind, body[start + kindLength:]
+
+                offset += _recordHeader.size + length
+        finally:
+            f.close()
+
+
+    def records(self, since=None):
+        """
+        Iterate over the records in the journal, in the order appended.
+
+        Buffered records are committed first. Reading a segment stops at the
+        first record that is incomplete or has a wrong checksum.
+
+        @param since: If not C{None}, skip records appended before this time.
+        @type since: C{float}
+        @return: Iterator over tuples of timestamp, kind and data.
+        """
+        self.commit()
+
+        for number, path in self._listSegments():
+            for timestamp, kind, data in self._readSegment(path):
+                if since is None or timestamp >= since:
+                    yield timestamp, kind, data
+
+
+    def replay(self, since=None):
+        """
+        Pass the records in the journal to the handlers for their kind.
+
+        The records are replayed as fast as the reactor allows, without
+        blocking it. Records without a handler are skipped.
+
+        @param since: If not C{None}, skip records appended before this time.
+        @type since: C{float}
+        @return: Deferred that fires with the number of replayed records.
+        """
+        replayed = []
+
+        def replayRecords():
+            for timestamp, kind, data in self.records(since):
+                handler = self.handlers.get(kind)
+                if handler is not None:
+                    try:
+                        handler(data)
+                    except:
+                        log.err(None, "Failed to replay %s record" % kind)
+                    replayed.append(timestamp)
+                yield None
+
+        d = task.coiterate(replayRecords())
+        d.addCallback(lambda _: len(replayed))
+        return d
@@ -0,0 +1,286 @@
+# -*- test-case-name: ikdisplay.test.test_notification -*-
+
+"""
+Notifications.
+
+Sources render the items they receive into notifications, that are then
+aggregated into feeds.
+"""
+
+from twisted.words.xish.domish import escapeToXml
+
+from wokkel.generic import parseXml
+
+NS_NOTIFICATION = 'http://mediamatic.nl/ns/ikdisplay/2009/notification'
+
+_missing = object()
+
+class Notification(object):
+    """
+    A notification, as rendered by a source.
+
+    Notifications have a fixed set of fields, in L{fields}. Fields that have
+    not been set are absent, as with keys of a C{dict}. Besides attribute
+    access, notifications provide a C{dict} compatible interface, so that
+    they can be used in places that expect a C{dict}, and compare equal to
+    the C{dict} with the same keys and values.
+
+    Serialized forms of a notification can be cached on it with
+    L{getSerialized}. The cache is cleared when a field is changed.
+
+    @cvar fields: The names of the known fields, in serialization order.
+    @type fields: C{tuple}
+    @ivar itemIdentifier: The identifier of the publish-subscribe item to
+        publish this notification as, or C{None} to have one assigned.
+        Publishing again with the same identifier updates the item in place.
+    @type itemIdentifier: C{unicode}
+    @ivar priority: The priority of the source of this notification. Higher
+        values are let through first when a feed is flooded.
+    @type priority: C{int}
+    @ivar origin: Identifies the incoming item this notification was
+        rendered from, like the node and identifier of a publish-subscribe
+        item, or C{None}.
+    @type origin: C{unicode}
+    """
+
+    fields = ('title', 'subtitle', 'html', 'icon', 'picture', 'uri', 'meta',
+              'via', 'retweets')
+
+    __slots__ = fields + ('itemIdentifier', 'priority', 'origin',
+                          '_serialized')
+    __hash__ = None
+
+    def __init__(self, *args, **kwargs):
+        object.__setattr__(self, '_serialized', None)
+        object.__setattr__(self, 'itemIdentifier', None)
+        object.__setattr__(self, 'priority', 0)
+        object.__setattr__(self, 'origin', None)
+        self.update(*args, **kwargs)
+
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        object.__setattr__(self, '_serialized', None)
+
+
+    def __delattr__(self, name):
+        object.__delattr__(self, name)
+        object.__setattr__(self, '_serialized', None)
+
+
+    def __repr__(self):
+        return 'Notification(%r)' % (self.asDict(),)
+
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            value = getattr(self, key, _missing)
+            if value is not _missing:
+                return value
+        raise KeyError(key)
+
+
+    def __setitem__(self, key, value):
+        if key not in self.fields:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        delattr(self, key)
+
+
+    def __contains__(self, key):
+        return (key in self.fields and
+                getattr(self, key, _missing) is not _missing)
+
+
+    def __iter__(self):
+        return self.iterkeys()
+
+
+    def __len__(self):
+        return len(self.keys())
+
+
+    def __eq__(self, other):
+        if isinstance(other, Notification):
+            other = other.asDict()
+        elif not isinstance(other, dict):
+            return NotImplemented
+        return self.asDict() == other
+
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+    def iteritems(self):
+        for name in self.fields:
+            value = getattr(self, name, _missing)
+            if value is not _missing:
+                yield name, value
+
+
+    def iterkeys(self):
+        for name, value in self.iteritems():
+            yield name
+
+
+    def itervalues(self):
+        for name, value in self.iteritems():
+            yield value
+
+
+    def items(self):
+        return list(self.iteritems())
+
+
+    def keys(self):
+        return list(self.iterkeys())
+
+
+    def values(self):
+        return list(self.itervalues())
+
+
+    def update(self, *args, **kwargs):
+        """
+        Set fields from a mapping or sequence of pairs, and keywords.
+        """
+        if args:
+            other, = args
+            if hasattr(other, 'iteritems'):
+                other = other.iteritems()
+            for key, value in other:
+                self[key] = value
+        for key, value in kwargs.iteritems():
+            self[key] = value
+
+
+    def toXml(self):
+        """
+        Return the XML serialization of this notification.
+
+        The serialization is cached, so that publishing the same notification
+        to several places, or again, does not serialize it again.
+        """
+        return self.getSerialized(renderXml)
+
+
+    def copy(self):
+        notification = Notification(self.iteritems())
+        notification.itemIdentifier = self.itemIdentifier
+        notification.priority = self.priority
+        notification.origin = self.origin
+        return notification
+
+
+    def asDict(self):
+        """
+        Return the fields that have been set as a C{dict}.
+        """
+        return dict(self.iteritems())
+
+
+    def getSerialized(self, serializer):
+        """
+        Return the serialized form of this notification.
+
+        The result of C{serializer} is cached on this notification, until one
+        of its fields changes.
+
+        @param serializer: Callable that takes a notification and returns
+            its serialized form.
+        """
+        cache = self._serialized
+        if cache is None:
+            cache = {}
+            object.__setattr__(self, '_serialized', cache)
+
+        try:
+            return cache[serializer]
+        except KeyError:
+            result = cache[serializer] = serializer(self)
+            return result
+
+
+
+def renderXml(notification):
+    """
+    Serialize a notification to an XML payload in L{NS_NOTIFICATION}.
+
+    Each field becomes a child element, in the order of
+    L{Notification.fields}. Fields set to C{None} become empty elements.
+
+    @param notification: The notification, or an equivalent C{dict}.
+    @rtype: C{unicode}
+    """
+    parts = [u"<notification xmlns='%s'>" % NS_NOTIFICATION]
+    for key, value in notification.iteritems():
+        if value is None:
+            parts.append(u'<%s/>' % key)
+        else:
+            parts.append(u'<%s>%s</%s>' % (key, escapeToXml(value), key))
+    parts.append(u'</notification>')
+    return u''.join(parts)
+
+
+
+def notificationToXml(notification):
+    """
+    Return the XML serialization of a notification, cached if possible.
+
+    @param notification: The notification, or an equivalent C{dict}.
+    @rtype: C{unicode}
+    """
+    if isinstance(notification, Notification):
+        return notification.toXml()
+    else:
+        return renderXml(notification)
+
+
+
+def parseNotification(xml):
+    """
+    Parse a notification serialized with L{renderXml}.
+
+    @param xml: The serialized notification, encoded as UTF-8.
+    @type xml: C{str}
+    @rtype: L{Notification}
+    """
+    return elementToNotification(parseXml(xml))
+
+
+
+def elementToNotification(element):
+    """
+    Convert a notification payload element to a notification.
+
+    Empty elements are converted to fields set to C{None}, and unknown
+    elements are ignored.
+
+    @param element: The C{notification} element in L{NS_NOTIFICATION}.
+    @type element: L{domish.Element<twisted.words.xish.domish.Element>}
+    @rtype: L{Notification}
+    """
+    notification = Notification()
+    for child in element.elements():
+        if child.name in Notification.fields:
+            if child.children:
+                notification[child.name] = unicode(child)
+            else:
+                notification[child.name] = None
+    return notification
@@ -0,0 +1,58 @@
+# -*- test-case-name: ikdisplay.test.test_ratelimit -*-
+
+"""
+Rate limiting.
+"""
+
+class TokenBucket(object):
+    """
+    Token bucket for limiting the rate of events.
+
+    The bucket holds up to L{capacity} tokens and is refilled at L{rate}
+    tokens per second. Each admitted event takes one token from the bucket.
+
+    @ivar rate: Number of tokens added per second.
+    @type rate: C{float}
+    @ivar capacity: Maximum number of tokens in the bucket, the burst size.
+    @type capacity: C{float}
+    @ivar tokens: Number of tokens in the bucket at the last update.
+    @type tokens: C{float}
+    @ivar clock: Provider of the current time.
+    @type clock: Object providing L{twisted.internet.interfaces.IReactorTime}
+    """
+
+    def __init__(self, rate, capacity, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock.seconds()
+
+
+    def _refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+    def consume(self, reserve=0):
+        """
+        Take a token from the bucket.
+
+        @param reserve: Number of tokens that must be left in the bucket
+            after taking a token. This allows for reserving part of the
+            bucket for events with a higher preference.
+        @type reserve: C{float}
+        @return: Whether a token could be taken, i.e. the event is admitted.
+        @rtype: C{bool}
+        """
+        self._refill()
+        if self.tokens - 1 >= reserve:
+            self.tokens -= 1
+            return True
+        else:
+            return False
@@ -8,21 +8,29 @@ publish-subscribe mechanism that are converted into a common format to be
 aggregated into a feed. A feed is composed of one or more sources.
 """
 
+from htmlentitydefs import name2codepoint
+from HTMLParser import HTMLParser, HTMLParseError
 from itertools import permutations
-import locale
+import collections
 import re
 import random
 import time
 
 from zope.interface import Attribute, Interface, implements
 
+from twisted.internet import defer, protocol
 from twisted.python import log, reflect
-from twisted.web import client
+from twisted.web import client, error, http
 from twisted.words.xish.domish import escapeToXml
 
 from axiom import attributes, item
+from axiom.item import declareLegacyItem
+from axiom.upgrade import registerAttributeCopyingUpgrader
 
+from ikdisplay.notification import Notification
+from ikdisplay.ratelimit import TokenBucket
 from ikdisplay.xmpp import IPubSubEventProcessor, JIDAttribute, getPubSubService
+from ikdisplay.xmpp import parseItems
 
 NS_ACTIVITY_SPEC = 'http://activitystrea.ms/spec/1.0/'
 NS_ACTIVITY_SCHEMA = 'http://activitystrea.ms/schema/1.0/'
@@ -32,6 +40,49 @@ NS_ATOM = 'http://www.w3.org/2005/Atom'
 TYPE_ATTACHMENT = 'http://mediamatic.nl/ns/anymeta/2008/kind/attachment'
 ACTIVITY_COMMIT = 'http://mediamatic.nl/ns/schema/2010/verb/commit'
 
+_timeDirective = re.compile(r'%(-?)([abdHMY%])')
+_timeCache = {}
+
+def formatTime(timeFormat, timeTuple, texts):
+    """
+    Render a time tuple without touching the process locale.
+
+    This supports the C{strftime} directives C{%a}, C{%b}, C{%d}, C{%H},
+    C{%M}, C{%Y} and C{%%}, as well as the unpadded glibc variants like
+    C{%-d}. Abbreviated day and month names are taken from the C{'days'}
+    and C{'months'} entries in C{texts}.
+
+    @param timeFormat: The format, as for C{time.strftime}.
+    @type timeFormat: C{str}
+    @param timeTuple: The time to render.
+    @type timeTuple: C{time.struct_time}
+    @param texts: The texts for the desired language.
+    @type texts: C{dict}
+    @rtype: C{unicode}
+    """
+    def replace(match):
+        unpadded, directive = match.groups()
+        if directive == 'a':
+            return texts['days'][timeTuple.tm_wday]
+        elif directive == 'b':
+            return texts['months'][timeTuple.tm_mon - 1]
+        elif directive == '%':
+            return u'%'
+        elif directive == 'Y':
+            return unicode(timeTuple.tm_year)
+
+        value = {'d': timeTuple.tm_mday,
+                 'H': timeTuple.tm_hour,
+                 'M': timeTuple.tm_min}[directive]
+        if unpadded:
+            return unicode(value)
+        else:
+            return u'%02d' % value
+
+    return _timeDirective.sub(replace, timeFormat)
+
+
+
 class ISource(Interface):
     """
     A feed source.
@@ -58,29 +109,56 @@ class SourceMixin(object):
     L{ISource}.
 
     @ivar texts: Contains the texts from this class and all the base classes,
-        for the language set in the config.
+        per language.
     @type texts: C{dict}
+    @ivar priority: The priority of the notifications of this source. When a
+        feed is flooded, notifications of sources with a higher priority are
+        let through first.
+    @type priority: C{int}
     """
 
     implements(ISource)
 
     title = "Unknown source"
+    priority = 0
 
     TEXTS_NL = {
-            'locale': 'nl_NL.UTF-8',
             'time_format': '%-d %b, %-H:%M',
+            'months': (u'jan', u'feb', u'mrt', u'apr', u'mei', u'jun',
+                       u'jul', u'aug', u'sep', u'okt', u'nov', u'dec'),
+            'days': (u'ma', u'di', u'wo', u'do', u'vr', u'za', u'zo'),
             'via_template': u'via %s',
             }
     TEXTS_EN = {
-            'locale': 'en_GB.UTF-8',
             'time_format': '%b %-d, %-H:%M',
+            'months': (u'Jan', u'Feb', u'Mar', u'Apr', u'May', u'Jun',
+                       u'Jul', u'Aug', u'Sep', u'Oct', u'Nov', u'Dec'),
+            'days': (u'Mon', u'Tue', u'Wed', u'Thu', u'Fri', u'Sat', u'Sun'),
             'via_template': u'via %s',
             }
 
     texts = None
+    _feedTexts = None
+
+    @classmethod
+    def compileTexts(cls):
+        """
+        Set up the text labels for this class, for all languages.
+
+        This merges the C{TEXTS_NL} and C{TEXTS_EN} dictionaries of this class
+        and all its base classes into L{texts}.
+        """
+        texts = {}
+        for language in ('nl', 'en'):
+            texts[language] = {}
+            attr = 'TEXTS_' + language.upper()
+            reflect.accumulateClassDict(cls, attr, texts[language])
+        cls.texts = texts
+
 
     def installOn(self, other):
         self.feed = other
+        self._feedTexts = None
         other.powerUp(self, ISource)
 
 
@@ -94,56 +172,119 @@ class SourceMixin(object):
 
     def activate(self):
         """
-        When a source appears in memory, set up the text labels for its class.
+        When a source appears in memory, make sure its class has text labels.
+
+        The source classes in this module have their texts compiled on import.
+        """
+        if 'texts' not in self.__class__.__dict__:
+            self.compileTexts()
+        self._feedTexts = None
+
+
+    def getTexts(self):
+        """
+        Return the text labels for the language of this source's feed.
+
+        The feed and its labels are cached, and the labels are looked up again
+        when the language of the feed changes.
         """
-        if self.texts is None:
-            self.__class__.texts = {}
+        if self._feedTexts is not None:
+            feed, language, texts = self._feedTexts
+            if feed.language == language:
+                return texts
+        else:
+            feed = self.feed
+
+        language = feed.language
+        texts = self.texts[language]
+        self._feedTexts = (feed, language, texts)
+        return texts
 
-            for language in ('nl', 'en'):
-                texts = self.__class__.texts[language] = {}
-                attr = 'TEXTS_' + language.upper()
-                reflect.accumulateClassDict(self.__class__, attr, texts)
+
+    def getLanguage(self):
+        """
+        Return the language of this source's feed, as cached by L{getTexts}.
+        """
+        self.getTexts()
+        return self._feedTexts[1]
 
 
     def getTime(self, notification):
         """
         Render the timestamp of a notification, using the feed's language.
+
+        As the time format has minute resolution, the rendered time is cached
+        per language and format for the current minute.
         """
-        texts = self.texts[self.feed.language]
+        texts = self.getTexts()
+        timeFormat = texts['time_format']
+        minute = int(time.time()) // 60
+        key = (self.getLanguage(), timeFormat, minute)
 
-        # Set time in localized format
-        oldLocale = locale.getlocale(locale.LC_ALL)
-        if oldLocale == (None, None):
-            oldLocale = 'C'
-        else:
-            oldLocale = '.'.join(oldLocale)
-        locale.setlocale(locale.LC_ALL, texts['locale'])
-        timeStr = time.strftime(texts['time_format'])
-        locale.setlocale(locale.LC_ALL, oldLocale)
+        try:
+            return _timeCache[key]
+        except KeyError:
+            pass
 
+        for oldKey in [k for k in _timeCache if k[2] != minute]:
+            del _timeCache[oldKey]
+
+        timeStr = formatTime(timeFormat, time.localtime(minute * 60), texts)
+        _timeCache[key] = timeStr
         return timeStr
 
-    def _addVia(self, notification):
+
+    def _getMetaContext(self):
         """
-        Set notification metadata to a timestamp and via text.
+        Gather what is needed to set the metadata of notifications.
+
+        This is the rendered timestamp, the via template, and the via texts
+        of this source and of its language. When formatting a batch of
+        notifications, this is looked up once and passed to L{_addVia} for
+        each of them.
         """
-        texts = self.texts[self.feed.language]
+        texts = self.getTexts()
+        return (self.getTime(None), texts['via_template'],
+                self.via, texts.get('via'))
 
-        meta = [self.getTime(notification)]
-        via = self.via or notification.get('via', texts.get('via'))
+
+    def _addVia(self, notification, context=None):
+        """
+        Set notification metadata to a timestamp and via text, and set its
+        priority.
+
+        @param context: The metadata context as returned by
+            L{_getMetaContext}. If C{None}, it will be looked up here.
+        """
+        if context is None:
+            context = self._getMetaContext()
+        timeStr, viaTemplate, sourceVia, defaultVia = context
+
+        meta = [timeStr]
+        via = sourceVia or notification.get('via', defaultVia)
         if via is not None:
-            meta.append(texts['via_template'] % via)
+            meta.append(viaTemplate % via)
         notification['meta'] = u' '.join(meta)
 
+        if isinstance(notification, Notification):
+            notification.priority = self.priority
+
 
 
 class PubSubSourceMixin(SourceMixin):
     """
     Common code for XMPP Publish-Subscribe sources.
+
+    Sources either render payloads directly in C{format_payload}, or set
+    C{payloadParser} to render the parsed records in C{format_record}.
+
+    @ivar payloadParser: Callable to parse payloads into records, or C{None}.
     """
 
     implements(IPubSubEventProcessor)
 
+    payloadParser = None
+
     TEXTS_NL = {
             'alien': u'Een illegale alien',
             }
@@ -161,9 +302,9 @@ class PubSubSourceMixin(SourceMixin):
         self.subscription = None
 
 
-    def itemsReceived(self, event):
+    def itemsReceived(self, event, records=None):
         try:
-            notifications = self.format(event)
+            notifications = self.format(event, records)
             if notifications:
                 self.feed.processNotifications(notifications)
         except:
@@ -174,19 +315,54 @@ class PubSubSourceMixin(SourceMixin):
         raise NotImplementedError()
 
 
-    def format(self, event):
+    def getRoutingFilter(self):
+        return None
+
+
+    def format(self, event, records=None):
+        """
+        Render the items of an event into notifications.
+
+        The timestamp and via texts are looked up once per event, and the
+        notifications of all items are returned together, to be handed to
+        the feed in one go. Each notification gets the node and identifier
+        of the item it was rendered from as its origin.
+
+        @param records: The records parsed from the items using
+            C{payloadParser}. If C{None}, they will be parsed here.
+        """
+        if self.payloadParser is not None:
+            if records is None:
+                records = parseItems(event, self.payloadParser)
+            payloads = records
+            formatter = self.format_record
+        else:
+            payloads = []
+            for item in event.items:
+                try:
+                    payloads.append(item.elements().next())
+                except (StopIteration):
+                    payloads.append(None)
+            formatter = self.format_payload
+
         notifications = []
+        context = None
 
-        for item in event.items:
-            try:
-                element = item.elements().next()
-            except (StopIteration):
+        for item, payload in zip(event.items, payloads):
+            if payload is None:
                 continue
 
-            notification = self.format_payload(element)
+            notification = formatter(payload)
 
             if notification:
-                self._addVia(notification)
+                if context is None:
+                    context = self._getMetaContext()
+                self._addVia(notification, context)
+                itemIdentifier = item.getAttribute('id')
+                if (itemIdentifier is not None and
+                    isinstance(notification, Notification)):
+                    notification.origin = u'%s/%s' % (event.nodeIdentifier,
+                                                      itemIdentifier)
                 notifications.append(notification)
             else:
                 log.msg("Formatter returned None. Dropping.")
@@ -198,6 +374,10 @@ class PubSubSourceMixin(SourceMixin):
         raise NotImplementedError()
 
 
+    def format_record(self, record):
+        raise NotImplementedError()
+
+
 
 class Site(item.Item):
     title = attributes.text()
@@ -214,23 +394,238 @@ def getThingID(uri):
 
 
 
+class ThingPageParser(HTMLParser):
+    """
+    Incremental parser for the title and canonical URI of a page.
+
+    The title is the text of the first C{h1} up to its first child element,
+    the canonical URI is the C{href} of the first C{link} with C{rel="self"}.
+
+    @ivar title: The title, or C{None} if no C{h1} has been seen yet.
+    @type title: C{unicode}
+    @ivar selfURI: The canonical URI, or C{None} if not seen yet.
+    @type selfURI: C{unicode}
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.title = None
+        self.selfURI = None
+        self._titleParts = None
+
+
+    def isComplete(self):
+        """
+        Return whether both the title and canonical URI have been found.
+        """
+        return self.title is not None and self.selfURI is not None
+
+
+    def _endTitle(self):
+        self.title = ''.join(self._titleParts).decode('utf-8', 'replace')
+        self._titleParts = None
+
+
+    def handle_starttag(self, tag, attrs):
+        if self._titleParts is not None:
+            self._endTitle()
+        elif tag == 'h1' and self.title is None:
+            self._titleParts = []
+        elif tag == 'link' and self.selfURI is None:
+            attrs = dict(attrs)
+            if attrs.get('rel') == 'self' and attrs.get('href'):
+                self.selfURI = attrs['href'].decode('utf-8', 'replace')
+
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+
+
+    def handle_endtag(self, tag):
+        if self._titleParts is not None:
+            self._endTitle()
+
+
+    def handle_data(self, data):
+        if self._titleParts is not None:
+            self._titleParts.append(data)
+
+
+    def handle_charref(self, name):
+        if self._titleParts is not None:
+            try:
+                if name[:1] in 'xX':
+                    codepoint = int(name[1:], 16)
+                else:
+                    codepoint = int(name)
+                self._titleParts.append(unichr(codepoint).encode('utf-8'))
+            except ValueError:
+                self._titleParts.append('&#%s;' % name)
+
+
+    def handle_entityref(self, name):
+        if self._titleParts is not None:
+            if name in name2codepoint:
+                char = unichr(name2codepoint[name]).encode('utf-8')
+            else:
+                char = '&%s;' % name
+            self._titleParts.append(char)
+
+
+
+class ThingPageProtocol(protocol.Protocol):
+    """
+    Feed a response body to a L{ThingPageParser} until it is complete.
+
+    The download is stopped as soon as the parser has found both values, or
+    when C{maxSize} bytes have been received. The deferred then fires with
+    the parser, with whatever it found so far.
+    """
+
+    def __init__(self, finished, maxSize):
+        self.finished = finished
+        self.maxSize = maxSize
+        self.received = 0
+        self.parser = ThingPageParser()
+
+
+    def dataReceived(self, data):
+        if self.finished is None:
+            return
+
+        self.received += len(data)
+        try:
+            self.parser.feed(data)
+        except HTMLParseError:
+            log.err(None, "Failed to parse page")
+            self.abort()
+            return
+
+        if self.parser.isComplete() or self.received >= self.maxSize:
+            self.abort()
+
+
+    def abort(self):
+        """
+        Stop the download and fire the deferred with the parser.
+        """
+        if self.finished is not None:
+            finished, self.finished = self.finished, None
+            self.transport.stopProducing()
+            finished.callback(self.parser)
+
+
+    def connectionLost(self, reason):
+        if self.finished is not None:
+            finished, self.finished = self.finished, None
+            if reason.check(client.ResponseDone, http.PotentialDataLoss):
+                finished.callback(self.parser)
+            else:
+                finished.errback(reason)
+
+
+
+class _DiscardProtocol(protocol.Protocol):
+
+    def connectionMade(self):
+        self.transport.stopProducing()
+
+
+
+def discoverPage(uri, agent=None, maxSize=256 * 1024, timeout=30,
+                 clock=None):
+    """
+    Retrieve the canonical URI and title of a page.
+
+    The page is parsed while it comes in, and the download is stopped as
+    soon as both are found, or after C{maxSize} bytes.
+
+    @param uri: The URI of the page.
+    @type uri: C{str}
+    @param agent: The agent to retrieve the page with. Defaults to a
+        redirect following L{client.Agent}.
+    @param timeout: The number of seconds after which discovery is given up
+        with L{defer.TimeoutError}.
+    @return: Deferred that fires with a tuple of the canonical URI and the
+        title, each C{None} if not found.
+    """
+    if clock is None:
+        from twisted.internet import reactor as clock
+    if agent is None:
+        agent = client.RedirectAgent(client.Agent(clock))
+
+    def cb(response):
+        if response.code >= 400:
+            response.deliverBody(_DiscardProtocol())
+            raise error.Error(response.code, response.phrase)
+
+        finished = defer.Deferred(lambda _: proto.abort())
+        proto = ThingPageProtocol(finished, maxSize)
+        response.deliverBody(proto)
+        return finished
+
+    def parsed(parser):
+        if not timeoutCall.active():
+            raise defer.TimeoutError("Discovery of %r timed out" % uri)
+        timeoutCall.cancel()
+        return parser.selfURI, parser.title
+
+    def eb(failure):
+        if timeoutCall.active():
+            timeoutCall.cancel()
+            return failure
+        failure.trap(defer.CancelledError)
+        raise defer.TimeoutError("Discovery of %r timed out" % uri)
+
+    d = agent.request('GET', uri)
+    timeoutCall = clock.callLater(timeout, d.cancel)
+    d.addCallback(cb)
+    d.addCallback(parsed)
+    d.addErrback(eb)
+    return d
+
+
+
+class DiscoveredThing(item.Item):
+    """
+    Cached result of the discovery of a L{Thing}.
+
+    @ivar uri: The URI discovery was done on.
+    @ivar canonicalURI: The discovered canonical URI.
+    @ivar title: The discovered title.
+    """
+    uri = attributes.text(allowNone=False, indexed=True)
+    canonicalURI = attributes.text(allowNone=False)
+    title = attributes.text()
+
+
+
 class Thing(item.Item):
     title = attributes.text()
     uri = attributes.text(allowNone=False)
 
 
-    def discoverCreate(cls, store, uri):
-        """ Perform discovery on the URL to get the title, and then create a thing. """
-        d = client.getPage(uri)
-        def parsePage(content):
-            from lxml.html.soupparser import fromstring
-            tree = fromstring(content)
-            h1 = tree.find(".//h1")
-            title = unicode((h1 is not None and h1.text) or "?")
-            slf = tree.find(".//link[@rel=\"self\"]")
-            newuri = unicode((slf is not None and slf.attrib["href"]) or uri)
+    def discoverCreate(cls, store, uri, agent=None, clock=None):
+        """
+        Perform discovery on the URL to get the title, and then create a thing.
+
+        The results of discovery are kept in the store as L{DiscoveredThing}s,
+        so that adding a thing for the same URI again needs no download.
+        """
+        uri = unicode(uri)
+        cached = store.findFirst(DiscoveredThing, DiscoveredThing.uri == uri)
+        if cached is not None:
+            return defer.succeed(Thing(store=store, uri=cached.canonicalURI,
+                                       title=cached.title))
+
+        d = discoverPage(uri.encode('utf-8'), agent=agent, clock=clock)
+        def create((selfURI, title)):
+            newuri = selfURI or uri
+            title = title or u"?"
+            DiscoveredThing(store=store, uri=uri, canonicalURI=newuri,
+                            title=title)
             return Thing(store=store, uri=newuri, title=title)
-        d.addCallback(parsePage)
+        d.addCallback(create)
         return d
     discoverCreate = classmethod(discoverCreate)
 
@@ -253,6 +648,7 @@ class SimpleSource(PubSubSourceMixin, item.Item):
     subscription = attributes.reference()
     service = JIDAttribute()
     nodeIdentifier = attributes.text()
+    _feedTexts = attributes.inmemory()
 
     def format_payload(self, payload):
         elementMap = {'title': 'title',
@@ -260,7 +656,7 @@ class SimpleSource(PubSubSourceMixin, item.Item):
                       'image': 'icon',
                       }
 
-        notification = {}
+        notification = Notification()
         for child in payload.elements():
             if child.name in elementMap:
                 notification[elementMap[child.name]] = unicode(child)
@@ -278,6 +674,8 @@ class SimpleSource(PubSubSourceMixin, item.Item):
 
 
 class VoteSourceMixin(PubSubSourceMixin):
+    priority = 1
+
     TEXTS_NL = {
             'via': 'ikPoll',
             'voted': u'stemde op %s',
@@ -287,6 +685,13 @@ class VoteSourceMixin(PubSubSourceMixin):
             'voted': u'voted for %s',
             }
 
+    _answers = None
+
+    def activate(self):
+        PubSubSourceMixin.activate(self)
+        self._answers = None
+
+
     def renderTitle(self):
         return "%s on %s" % (self.title, (self.question and self.question.title) or "?")
 
@@ -299,14 +704,47 @@ class VoteSourceMixin(PubSubSourceMixin):
             return None
 
 
+    def _getAnswers(self, question, refresh=False):
+        """
+        Return the titles of the answers to a question, by answer id.
+
+        The answers rarely change during a poll, so they are cached. The
+        cache is checked with a fingerprint of the question id and the
+        number of children of the answers element.
+
+        @param refresh: Whether to rebuild the cache regardless of the
+            fingerprint, for when an answer was replaced by another.
+        @type refresh: C{bool}
+        """
+        answers = question.answers
+        fingerprint = (unicode(question.id), len(answers.children))
+        if (not refresh and self._answers is not None and
+            self._answers[0] == fingerprint):
+            return self._answers[1]
+
+        answerMap = {}
+        for element in answers.elements():
+            if (element.uri, element.name) == ('', 'item'):
+                answerID = unicode(element.answer_id)
+                if answerID not in answerMap:
+                    answerMap[answerID] = unicode(element.title)
+
+        self._answers = (fingerprint, answerMap)
+        return answerMap
+
+
     def _voteToAnswer(self, vote):
-        answerID = unicode(vote.vote.answer_id_ref)
-        for element in vote.question.answers.elements():
-            if ((element.uri, element.name) == ('', 'item') and
-                unicode(element.answer_id) == answerID):
-                    return unicode(element.title)
+        """
+        Return the title of the answer voted for.
 
-        return None
+        If the answer is not in the cached answers, they are looked up
+        again before giving up.
+        """
+        answerID = unicode(vote.vote.answer_id_ref)
+        answerMap = self._getAnswers(vote.question)
+        if answerID not in answerMap:
+            answerMap = self._getAnswers(vote.question, refresh=True)
+        return answerMap.get(answerID)
 
 
     def format_payload(self, payload):
@@ -314,16 +752,16 @@ class VoteSourceMixin(PubSubSourceMixin):
         answer = self._voteToAnswer(payload)
 
         if not title:
-            title = self.texts[self.feed.language]['alien']
+            title = self.getTexts()['alien']
 
-        template = getattr(self, 'template', None) or self.texts[self.feed.language]['voted']
+        template = getattr(self, 'template', None) or self.getTexts()['voted']
         subtitle = template % answer
 
-        notification = {
-                'title': title,
-                'subtitle': subtitle,
-                'icon': unicode(payload.person.image),
-                }
+        notification = Notification(
+                title=title,
+                subtitle=subtitle,
+                icon=unicode(payload.person.image),
+                )
 
         notification.update(self.format_vote(payload))
 
@@ -352,6 +790,8 @@ class VoteSource(VoteSourceMixin, item.Item):
     subscription = attributes.reference()
     question = attributes.reference()
     template = attributes.text()
+    _feedTexts = attributes.inmemory()
+    _answers = attributes.inmemory()
 
     def renderTitle(self):
         return "%s, question: %s" % (self.title, (self.question and self.question.title) or "?")
@@ -365,6 +805,8 @@ class PresenceSource(VoteSourceMixin, item.Item):
     via = attributes.text()
     subscription = attributes.reference()
     question = attributes.reference()
+    _feedTexts = attributes.inmemory()
+    _answers = attributes.inmemory()
 
     TEXTS_NL = {
             'present': u'is bij de ingang gesignaleerd',
@@ -376,7 +818,7 @@ class PresenceSource(VoteSourceMixin, item.Item):
             }
 
     def format_vote(self, payload):
-        texts = self.texts[self.feed.language]
+        texts = self.getTexts()
         if unicode(payload.person.title):
             subtitle = texts['present']
         else:
@@ -394,6 +836,8 @@ class IkMicSource(VoteSourceMixin, item.Item):
     via = attributes.text()
     subscription = attributes.reference()
     question = attributes.reference()
+    _feedTexts = attributes.inmemory()
+    _answers = attributes.inmemory()
 
     TEXTS_NL = {
             'via': 'ikMic',
@@ -410,7 +854,7 @@ class IkMicSource(VoteSourceMixin, item.Item):
             }
 
     def format_vote(self, payload):
-        choices = self.texts[self.feed.language]['interrupt']
+        choices = self.getTexts()['interrupt']
         return {"subtitle": random.choice(choices)}
 
 
@@ -436,18 +880,19 @@ class StatusSource(PubSubSourceMixin, item.Item):
     user = attributes.reference("""
     Reference to the thing the statuses are from.
     """)
+    _feedTexts = attributes.inmemory()
 
     def format_payload(self, payload):
         text = unicode(payload.status).strip()
         if not text or text == 'is':
             return None
 
-        return {
-            'title': unicode(payload.person.title),
-            'subtitle': text,
-            'icon': unicode(payload.person.image),
-            'via': self.site.title,
-            }
+        return Notification(
+            title=unicode(payload.person.title),
+            subtitle=text,
+            icon=unicode(payload.person.image),
+            via=self.site.title,
+            )
 
 
     def getNode(self):
@@ -465,8 +910,107 @@ class StatusSource(PubSubSourceMixin, item.Item):
 
 
 
+class _RetweetedStatus(object):
+    """
+    Retweets of a status, as tracked by L{RetweetCollapser}.
+    """
+
+    def __init__(self, original, started):
+        self.original = original
+        self.started = started
+        self.count = 0
+        self.published = None
+        self.call = None
+        self.picture = None
+
+
+
+class RetweetCollapser(object):
+    """
+    Collapses retweets of the same status into updates of one notification.
+
+    Instead of a notification per retweet, the notification of the original
+    status is published with the number of times it was retweeted. As the
+    notification has an item identifier derived from the status, every
+    update replaces the previous one. Updates of a status are published at
+    most once every L{updateInterval} seconds, with the count at that time.
+    Updates keep the picture of the first notification, if they do not have
+    one of their own.
+
+    @ivar render: Callable that takes the original status and its number of
+        retweets, and returns the notification for it.
+    @ivar publish: Callable that takes a notification and publishes it.
+    @ivar window: Number of seconds after the first retweet of a status
+        after which counting starts over.
+    @type window: C{float}
+    @ivar updateInterval: Minimum number of seconds between updates of the
+        notification of a status.
+    @type updateInterval: C{float}
+    @ivar maxStatuses: Maximum number of statuses to track retweets of.
+    @type maxStatuses: C{int}
+    """
+
+    window = 60 * 60
+    updateInterval = 10
+    maxStatuses = 1000
+
+    def __init__(self, render, publish, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self.render = render
+        self.publish = publish
+        self.clock = clock
+        self._statuses = collections.OrderedDict()
+
+
+    def retweeted(self, original):
+        """
+        Count a retweet of a status, and publish or schedule an update.
+
+        @param original: The status that was retweeted.
+        """
+        now = self.clock.seconds()
+        state = self._statuses.pop(original.id, None)
+        if state is None or now - state.started > self.window:
+            if state is not None and state.call is not None:
+                state.call.cancel()
+            state = _RetweetedStatus(original, now)
+
+        self._statuses[original.id] = state
+        if len(self._statuses) > self.maxStatuses:
+            self._statuses.popitem(last=False)
+
+        state.original = original
+        state.count += 1
+
+        if state.call is None:
+            if state.published is None:
+                delay = 0
+            else:
+                delay = state.published + self.updateInterval - now
+
+            if delay <= 0:
+                self._publish(state)
+            else:
+                state.call = self.clock.callLater(delay, self._publish, state)
+
+
+    def _publish(self, state):
+        state.call = None
+        state.published = self.clock.seconds()
+        notification = self.render(state.original, state.count)
+        if state.picture is None:
+            state.picture = notification.get('picture')
+        elif not notification.get('picture'):
+            notification['picture'] = state.picture
+        self.publish(notification)
+
+
+
 class TwitterSource(SourceMixin, item.Item):
     title = "Twitter"
+    priority = -1
 
     TEXTS_NL = {
             'via': 'Twitter',
@@ -475,16 +1019,139 @@ class TwitterSource(SourceMixin, item.Item):
             'via': 'Twitter',
             }
 
+    schemaVersion = 2
+
     feed = attributes.reference()
     enabled = attributes.boolean()
     via = attributes.text()
     terms = attributes.textlist()
     userIDs = attributes.textlist()
+    maxRate = attributes.integer("""
+    Maximum number of statuses per minute, or C{None} for no maximum.
+    """)
+    sampling = attributes.text("""
+    How to sample statuses over the maximum rate: C{u'uniform'}, or
+    preferring C{u'pictures'} or statuses from C{u'followed'} users.
+    """, default=u'uniform')
+    _feedTexts = attributes.inmemory()
+
+    burstSeconds = 10
+    sampleReserve = 0.5
+    collapseRetweets = True
+
+    def makeBucket(self, clock=None):
+        """
+        Create a token bucket for the maximum rate of this source.
+
+        The bucket holds the rate state across statuses, so it has to be
+        kept by the caller, as this item may be unloaded in between.
+
+        @return: The bucket, or C{None} if there is no maximum rate.
+        @rtype: L{TokenBucket}
+        """
+        if not self.maxRate:
+            return None
+
+        rate = self.maxRate / 60.0
+        capacity = max(2.0, rate * self.burstSeconds)
+        return TokenBucket(rate, capacity, clock)
+
+
+    def makeRetweetCollapser(self, clock=None):
+        """
+        Create a collapser for the retweets accepted by this source.
+
+        The collapser holds the retweet counts and pending updates across
+        statuses, so like the token bucket, it has to be kept by the caller.
+
+        @return: The collapser, or C{None} if L{collapseRetweets} is not set.
+        @rtype: L{RetweetCollapser}
+        """
+        if not self.collapseRetweets:
+            return None
+
+        return RetweetCollapser(self._formatRetweeted, self._publish, clock)
+
+
+    def match(self, status):
+        """
+        Check if a status matches the terms or user IDs of this source.
+        """
+        match, urls = self._matchStatus(status)
+        return match
+
+
+    def admit(self, status, bucket):
+        """
+        Check if a matching status is within the maximum rate of this source.
+
+        Unless L{sampling} is C{u'uniform'}, part of the burst capacity is
+        reserved for preferred statuses.
 
-    def onEntry(self, entry):
-        notification = self.format(entry)
-        if notification:
-            self.feed.processNotifications([notification])
+        @param bucket: The token bucket created with L{makeBucket}.
+        @type bucket: L{TokenBucket}
+        """
+        if self.sampling == u'uniform' or self._isPreferred(status):
+            reserve = 0
+        else:
+            reserve = bucket.capacity * self.sampleReserve
+
+        return bucket.consume(reserve)
+
+
+    def _isPreferred(self, status):
+        """
+        Check if a status is preferred when sampling.
+
+        Sampling happens before images are embedded, so only pictures
+        uploaded to Twitter itself are known at this point.
+        """
+        if self.sampling == u'pictures':
+            entities = getattr(status, 'entities', None)
+            return bool(getattr(entities, 'media', None))
+        elif self.sampling == u'followed':
+            return str(status.user.id) in (self.userIDs or ())
+        else:
+            return False
+
+
+    def onEntry(self, entry, retweets=None):
+        """
+        Format a status accepted by this source and pass it to the feed.
+
+        If a collapser is passed, retweets are passed to it, and it updates
+        the notification of the original status with the number of retweets.
+        The image the embedder found for the retweet is used for the
+        original status.
+
+        @param retweets: The collapser created with L{makeRetweetCollapser},
+            or C{None} to pass on retweets as they are.
+        @type retweets: L{RetweetCollapser}
+        """
+        retweeted = getattr(entry, 'retweeted_status', None)
+        if retweeted and retweets is not None:
+            if not getattr(retweeted, 'image_url', None):
+                retweeted.image_url = getattr(entry, 'image_url', None)
+            retweets.retweeted(retweeted)
+            return
+
+        texts, urls = self._gatherTexts(entry)
+        notification = self._formatStatus(entry, urls)
+        self._publish(notification)
+
+
+    def _publish(self, notification):
+        self.feed.processNotifications([notification])
+
+
+    def _formatRetweeted(self, status, count):
+        """
+        Format a retweeted status, with its number of retweets.
+        """
+        texts, urls = self._gatherTexts(status)
+        notification = self._formatStatus(status, urls)
+        notification['retweets'] = unicode(count)
+        return notification
 
 
     def _gatherTexts(self, status):
@@ -519,10 +1186,9 @@ class TwitterSource(SourceMixin, item.Item):
             pass
 
         for url in urls:
-            try:
-                texts.append(url.expanded_url)
-            except AttributeError:
-                pass
+            expandedURL = getattr(url, 'expanded_url', None)
+            if expandedURL:
+                texts.append(expandedURL)
 
         return texts, urls
 
@@ -556,6 +1222,45 @@ class TwitterSource(SourceMixin, item.Item):
             return False, urls
 
 
+    def _renderText(self, text, urls):
+        """
+        Render the plain text and HTML versions of the text of a status.
+
+        In a single pass over the text, the URL entities are replaced by
+        their display URL in the plain text version, and by a link to the URL
+        with the display URL as its text in the HTML version.
+
+        @return: The plain text and HTML versions of the text.
+        @rtype: C{tuple}
+        """
+        if not urls:
+            return text, text
+
+        entities = [(url.indices.start, url.indices.end, url)
+                    for url in urls
+                    if getattr(url, 'display_url', None)]
+        entities.sort(key=lambda entity: entity[0])
+
+        plain = []
+        html = []
+        position = 0
+        for start, end, url in entities:
+            head = text[position:start]
+            plain.append(head)
+            plain.append(url.display_url)
+            html.append(head)
+            html.append(u"<a href='%s'>%s</a>" % (
+                            escapeToXml(url.url, isattrib=1),
+                            escapeToXml(url.display_url)))
+            position = end
+
+        tail = text[position:]
+        plain.append(tail)
+        html.append(tail)
+
+        return u''.join(plain), u''.join(html)
+
+
     def format(self, status):
 
         match, urls = self._matchStatus(status)
@@ -563,37 +1268,27 @@ class TwitterSource(SourceMixin, item.Item):
         if not match:
             return None
 
-        notification = {
-            'title': status.user.screen_name,
-            'icon': status.user.profile_image_url,
-            'uri': ('https://twitter.com/%s/statuses/%d' %
-                    (status.user.screen_name.encode('utf-8'),
-                     status.id)),
-            }
+        return self._formatStatus(status, urls)
+
+
+    def _formatStatus(self, status, urls):
+        notification = Notification(
+            title=status.user.screen_name,
+            icon=status.user.profile_image_url,
+            uri=('https://twitter.com/%s/statuses/%d' %
+                 (status.user.screen_name.encode('utf-8'),
+                  status.id)),
+            )
 
         # Twitter Entities on retweets have incorrect indices. Use the
         # retweeted status for rendering the plain text and html.
         if getattr(status, 'retweeted_status', None):
-            notification['subtitle'] = status.retweeted_status.text
+            text = status.retweeted_status.text
         else:
-            notification['subtitle'] = status.text
+            text = status.text
 
-        urls.sort(key=lambda url: url.indices.start, reverse=True)
-        notification['html'] = notification['subtitle']
-        for url in urls:
-            if getattr(url, 'display_url'):
-                head = notification['subtitle'][0:url.indices.start]
-                tail = notification['subtitle'][url.indices.end:]
-                text = u''.join([head, url.display_url, tail])
-                notification['subtitle'] = text
-
-                headHTML = notification['html'][0:url.indices.start]
-                tailHTML = notification['html'][url.indices.end:]
-                linkHRef = escapeToXml(url.url, isattrib=1)
-                linkText = escapeToXml(url.display_url)
-                link = u"<a href='%s'>%s</a>" % (linkHRef, linkText)
-                html = u''.join([headHTML, link, tailHTML])
-                notification['html'] = html
+        notification['subtitle'], notification['html'] = self._renderText(text,
+                                                                          urls)
 
         # Prefix the retweeted status explicitly.
         if getattr(status, 'retweeted_status', None):
@@ -607,20 +1302,38 @@ class TwitterSource(SourceMixin, item.Item):
         if getattr(status, 'image_url', None):
             notification['picture'] = status.image_url
 
+        notification.itemIdentifier = u'status-%d' % status.id
+
         self._addVia(notification)
         return notification
 
 
     def renderTitle(self):
-        return "%s (%d terms, %d users)" % (self.title,
-                                            len(self.terms or []),
-                                            len(self.userIDs or []))
+        s = "%s (%d terms, %d users)" % (self.title,
+                                         len(self.terms or []),
+                                         len(self.userIDs or []))
+        if self.maxRate:
+            s += " (max. %d per minute)" % (self.maxRate,)
+        return s
+
+
+
+declareLegacyItem(TwitterSource.typeName, 1, dict(
+    feed=attributes.reference(),
+    enabled=attributes.boolean(),
+    via=attributes.text(),
+    terms=attributes.textlist(),
+    userIDs=attributes.textlist(),
+    ))
+
+registerAttributeCopyingUpgrader(TwitterSource, 1, 2)
 
 
 
 
 class RegDeskSource(PubSubSourceMixin, item.Item):
     title = "Registration desk"
+    priority = 1
 
     feed = attributes.reference()
     enabled = attributes.boolean()
@@ -629,6 +1342,7 @@ class RegDeskSource(PubSubSourceMixin, item.Item):
     event = attributes.reference("""
     Reference to the event.
     """)
+    _feedTexts = attributes.inmemory()
 
     TEXTS_NL = {
             'via': 'Registratiebalie',
@@ -647,13 +1361,13 @@ class RegDeskSource(PubSubSourceMixin, item.Item):
             }
 
     def format_payload(self, payload):
-        subtitle = random.choice(self.texts[self.feed.language]['regdesk'])
+        subtitle = random.choice(self.getTexts()['regdesk'])
 
         if payload.person:
-            return {'title': unicode(payload.person.title),
-                    'subtitle': subtitle,
-                    'icon': unicode(payload.person.image),
-                    }
+            return Notification(title=unicode(payload.person.title),
+                                subtitle=subtitle,
+                                icon=unicode(payload.person.image),
+                                )
 
     def renderTitle(self):
         return "%s for %s" % (self.title, (self.event and self.event.title) or "?")
@@ -675,6 +1389,7 @@ class RaceSource(PubSubSourceMixin, item.Item):
     race = attributes.reference("""
     Reference to the thing representing the race.
     """)
+    _feedTexts = attributes.inmemory()
 
     TEXTS_NL = {
             'via': 'Alleycat',
@@ -686,12 +1401,12 @@ class RaceSource(PubSubSourceMixin, item.Item):
             }
 
     def format_payload(self, payload):
-        subtitle = self.texts[self.feed.language]['race_finish'] % (unicode(payload.event),
+        subtitle = self.getTexts()['race_finish'] % (unicode(payload.event),
                                                                     unicode(payload.time))
 
-        return {'title': unicode(payload.person.title),
-                'subtitle': subtitle,
-                'icon': unicode(payload.person.image)}
+        return Notification(title=unicode(payload.person.title),
+                            subtitle=subtitle,
+                            icon=unicode(payload.person.image))
 
     def renderTitle(self):
         return "%s for the race %s" % (self.title, (self.race and self.race.title) or "?")
@@ -703,6 +1418,158 @@ class RaceSource(PubSubSourceMixin, item.Item):
 
 
 
+class ActivityRecord(object):
+    """
+    The parts of an Atom Activity Streams entry that sources render.
+
+    Records are created by L{parseActivity}, and shared by all sources of
+    a node. They should not be modified.
+
+    @ivar verbs: The verbs of the activity.
+    @type verbs: C{frozenset}
+    @ivar actorName: The name of the (first) author.
+    @type actorName: C{unicode}
+    @ivar actorNames: The names of all the Atom authors.
+    @type actorNames: C{tuple}
+    @ivar actorFigure: The URI of the figure of the (first) author.
+    @type actorFigure: C{unicode}
+    @ivar objectTypes: The object types of the object.
+    @type objectTypes: C{frozenset}
+    @ivar objectTitle: The title of the object.
+    @type objectTitle: C{unicode}
+    @ivar objectFigure: The URI of the figure of the object.
+    @type objectFigure: C{unicode}
+    @ivar objectMessage: The message of the object, e.g. of a commit.
+    @type objectMessage: C{unicode}
+    @ivar targetID: The identifier of the target.
+    @type targetID: C{unicode}
+    @ivar targetTitle: The title of the target.
+    @type targetTitle: C{unicode}
+    @ivar agentID: The identifier of the agent.
+    @type agentID: C{unicode}
+    """
+
+    __slots__ = ('verbs', 'actorName', 'actorNames', 'actorFigure',
+                 'objectTypes', 'objectTitle', 'objectFigure',
+                 'objectMessage', 'targetID', 'targetTitle', 'agentID')
+
+    def __init__(self, verbs=frozenset(), actorName=None, actorNames=(),
+                       actorFigure=None, objectTypes=frozenset(),
+                       objectTitle=None, objectFigure=None,
+                       objectMessage=None, targetID=None, targetTitle=None,
+                       agentID=None):
+        self.verbs = verbs
+        self.actorName = actorName
+        self.actorNames = actorNames
+        self.actorFigure = actorFigure
+        self.objectTypes = objectTypes
+        self.objectTitle = objectTitle
+        self.objectFigure = objectFigure
+        self.objectMessage = objectMessage
+        self.targetID = targetID
+        self.targetTitle = targetTitle
+        self.agentID = agentID
+
+
+
+def _scanEntity(element):
+    """
+    Collect the parts of an Activity Streams entity in a single pass.
+
+    @return: The first child element for each local name, the object types,
+        the URI of the first figure link and the Atom names.
+    @rtype: C{tuple}
+    """
+    children = {}
+    objectTypes = []
+    figure = None
+    names = []
+
+    for child in element.elements():
+        uri, name = child.uri, child.name
+        if name not in children:
+            children[name] = child
+
+        if uri == NS_ACTIVITY_SPEC:
+            if name == 'object-type':
+                objectTypes.append(unicode(child))
+        elif uri == NS_ATOM:
+            if name == 'name':
+                names.append(unicode(child))
+            elif (name == 'link' and figure is None and
+                  child.getAttribute('rel', 'alternate') == 'figure'):
+                figure = child.getAttribute('href')
+
+    return children, objectTypes, figure, names
+
+
+
+def parseActivity(payload):
+    """
+    Parse an Atom Activity Streams entry into an L{ActivityRecord}.
+
+    The children of the entry, and those of its author, object, target and
+    agent, are each walked only once.
+    """
+    verbs = []
+    actorName = None
+    actorNames = []
+    actorFigure = None
+    entities = {}
+
+    for element in payload.elements():
+        uri, name = element.uri, element.name
+        if name == 'verb':
+            if uri == NS_ACTIVITY_SPEC:
+                verbs.append(unicode(element))
+        elif name == 'author':
+            first = 'author' not in entities
+            if first:
+                entities['author'] = element
+            if first or uri == NS_ATOM:
+                children, _, figure, names = _scanEntity(element)
+                if first:
+                    if 'name' in children:
+                        actorName = unicode(children['name'])
+                    actorFigure = figure
+                if uri == NS_ATOM:
+                    actorNames.extend(names)
+        elif name in ('object', 'target', 'agent'):
+            if name not in entities:
+                entities[name] = element
+
+    objectTypes = ()
+    objectTitle = None
+    objectFigure = None
+    objectMessage = None
+    if 'object' in entities:
+        children, objectTypes, objectFigure, _ = _scanEntity(
+                                                    entities['object'])
+        if 'title' in children:
+            objectTitle = unicode(children['title'])
+        if 'message' in children:
+            objectMessage = unicode(children['message'])
+
+    targetID = None
+    targetTitle = None
+    if 'target' in entities:
+        children = _scanEntity(entities['target'])[0]
+        targetID = unicode(children.get('id'))
+        if 'title' in children:
+            targetTitle = unicode(children['title'])
+
+    agentID = None
+    if 'agent' in entities:
+        children = _scanEntity(entities['agent'])[0]
+        agentID = unicode(children.get('id'))
+
+    return ActivityRecord(frozenset(verbs), actorName, tuple(actorNames),
+                          actorFigure, frozenset(objectTypes), objectTitle,
+                          objectFigure, objectMessage, targetID, targetTitle,
+                          agentID)
+
+
+
 class ActivityStreamSourceMixin(PubSubSourceMixin):
     """
     Common code for Activity Stream via XMPP Publish-Subscribe sources.
@@ -772,72 +1639,80 @@ class ActivityStreamSourceMixin(PubSubSourceMixin):
 
     supportedVerbs = ()
     agentVerbs = frozenset()
+    verbRanks = None
+    payloadParser = staticmethod(parseActivity)
+
+    @classmethod
+    def compileTexts(cls):
+        """
+        Set up the text labels, and rank the supported verbs by position.
+        """
+        super(ActivityStreamSourceMixin, cls).compileTexts()
+        cls.verbRanks = dict((verb, rank)
+                             for rank, verb in enumerate(cls.supportedVerbs))
+
+
+    def getRoutingFilter(self):
+        """
+        Only route activities with one of the supported verbs.
+        """
+        return {'verbs': self.supportedVerbs}
+
 
     def format_payload(self, payload):
         """
         Render the payload into a notification.
+        """
+        return self.format_record(parseActivity(payload))
+
+
+    def format_record(self, record):
+        """
+        Render a parsed activity into a notification.
 
         If available, this uses the anyMeta specific 'figure' links to point to
         scaled-and-cropped versions of the image used for the actor (icon) or
         the object (picture).
         """
-        verbs = set([unicode(element)
-                 for element in payload.elements(NS_ACTIVITY_SPEC, 'verb')])
-
-        template = None
-        for verb in self.supportedVerbs:
-            if verb in verbs:
-                template = self.texts[self.feed.language]['activity_verbs'][verb]
-                break
+        ranks = self.verbRanks
+        verb = None
+        for candidate in record.verbs:
+            rank = ranks.get(candidate)
+            if rank is not None and (verb is None or rank < ranks[verb]):
+                verb = candidate
+
+        if verb is None:
+            return None
 
+        template = self.getTexts()['activity_verbs'][verb]
         if template is None:
             return None
 
-        if payload.agent and verb not in self.agentVerbs:
+        if record.agentID is not None and verb not in self.agentVerbs:
             return None
 
-        from twisted.words.xish.domish import generateElementsNamed
-        actorTitle = unicode(generateElementsNamed(payload.author.elements(),
-                                                   'name').next())
-
-        figureURI = None
-        for element in payload.author.elements(NS_ATOM, 'link'):
-            if element.getAttribute('rel', 'alternate') == 'figure':
-                figureURI = element.getAttribute('href')
-                break
-
-        if figureURI:
-            figureURI += '?width=80&height=80&filter=crop'
-
-        pictureURI = None
-        for element in payload.object.elements(NS_ACTIVITY_SPEC,
-                                               'object-type'):
-            if unicode(element) == TYPE_ATTACHMENT:
-                for element in payload.object.elements(NS_ATOM, 'link'):
-                    if element.getAttribute('rel', 'alternate') == 'figure':
-                        pictureURI = element.getAttribute('href')
-                        break
-                if pictureURI:
-                    pictureURI += '?width=480'
+        if record.actorName is None:
+            return None
 
         vars = {}
-        if payload.object and payload.object.title:
-            vars['object'] = unicode(payload.object.title)
+        if record.objectTitle is not None:
+            vars['object'] = record.objectTitle
 
-        if payload.target and payload.target.title:
-            vars['target'] = unicode(payload.target.title)
+        if record.targetTitle is not None:
+            vars['target'] = record.targetTitle
 
         subtitle = template % vars
 
-        notification = {
-                'title': actorTitle,
-                'subtitle': subtitle,
-                'via': self.getVia()
-                }
-        if figureURI:
-            notification['icon'] = figureURI
-        if pictureURI:
-            notification['picture'] = pictureURI
+        notification = Notification(
+                title=record.actorName,
+                subtitle=subtitle,
+                via=self.getVia()
+                )
+        if record.actorFigure:
+            notification['icon'] = (record.actorFigure +
+                                    '?width=80&height=80&filter=crop')
+        if record.objectFigure and TYPE_ATTACHMENT in record.objectTypes:
+            notification['picture'] = record.objectFigure + '?width=480'
 
         return notification
 
@@ -860,6 +1735,7 @@ class ActivityStreamSource(ActivityStreamSourceMixin, item.Item):
     actor = attributes.reference("""
     Reference to the thing representing the actor of the activities.
     """)
+    _feedTexts = attributes.inmemory()
 
     supportedVerbs = (
                 NS_ANYMETA_ACTIVITY + 'status-update',
@@ -898,6 +1774,7 @@ class ActivityStreamSource(ActivityStreamSourceMixin, item.Item):
 
 class IkCamSource(ActivityStreamSourceMixin, item.Item):
     title = "IkCam pictures"
+    priority = 1
 
     feed = attributes.reference()
     enabled = attributes.boolean()
@@ -909,6 +1786,7 @@ class IkCamSource(ActivityStreamSourceMixin, item.Item):
     creator = attributes.reference("""
     Reference to the creator of the pictures.
     """)
+    _feedTexts = attributes.inmemory()
 
     ikCamVerb = NS_ANYMETA_ACTIVITY + 'ikcam'
 
@@ -926,34 +1804,29 @@ class IkCamSource(ActivityStreamSourceMixin, item.Item):
             }
 
 
-    def format_payload(self, payload):
+    def format_record(self, record):
         """
-        Render the payload into a notification.
+        Render a parsed activity into a notification.
 
-        If available, this uses the anyMeta specific 'figure' links to point to
-        scaled-and-cropped versions of the image used for the actor (icon) or
-        the object (picture).
+        If available, this uses the anyMeta specific 'figure' link to point to
+        a scaled version of the picture.
         """
-        texts = self.texts[self.feed.language]
+        texts = self.getTexts()
 
-        verbs = set([unicode(element)
-                 for element in payload.elements(NS_ACTIVITY_SPEC, 'verb')])
-
-        if self.ikCamVerb not in verbs:
+        if self.ikCamVerb not in record.verbs:
             return None
 
         # filter out ikcam notifications from other agents
-        if payload.agent and self.creator and unicode(payload.agent.id) != self.creator.uri:
+        if (record.agentID is not None and self.creator and
+            record.agentID != self.creator.uri):
             return None
 
         # filter out ikcam notifications from other events
-        if payload.target and self.event and unicode(payload.target.id) != self.event.uri:
+        if (record.targetID is not None and self.event and
+            record.targetID != self.event.uri):
             return None
 
-        from twisted.words.xish.domish import generateElementsQNamed
-        actors = generateElementsQNamed(payload.elements(), 'author', NS_ATOM)
-        names = reduce(lambda x, y: x+y, [list(generateElementsQNamed(actor.elements(), 'name', NS_ATOM)) for actor in actors], [])
-        actorTitles = [unicode(element) for element in names]
+        actorTitles = record.actorNames
 
         if not actorTitles:
             return
@@ -962,22 +1835,31 @@ class IkCamSource(ActivityStreamSourceMixin, item.Item):
         else:
             subtitle = texts['ikcam_picture_plural']
 
-        if payload.target:
-            subtitle += texts['ikcam_event'] % unicode(payload.target.title)
+        if record.targetID is not None:
+            subtitle += texts['ikcam_event'] % record.targetTitle
 
-        pictureURI = None
-        for element in payload.object.elements(NS_ATOM, 'link'):
-            if element.getAttribute('rel', 'alternate') == 'figure':
-                pictureURI = element.getAttribute('href')
-                break
+        pictureURI = record.objectFigure
         if pictureURI:
             pictureURI += '?width=480'
 
-        return {'title': unicode(implodeNames(actorTitles, self.feed.language)),
-                'subtitle': subtitle,
-                'icon': u'http://docs.mediamatic.nl/images/ikcam-80x80.png',
-                'picture': pictureURI,
-                }
+        return Notification(
+                title=unicode(implodeNames(actorTitles, self.getLanguage())),
+                subtitle=subtitle,
+                icon=u'http://docs.mediamatic.nl/images/ikcam-80x80.png',
+                picture=pictureURI,
+                )
+
+
+    def getRoutingFilter(self):
+        """
+        Only route ikCam activities by the creator at the event, if set.
+        """
+        routingFilter = {'verbs': [self.ikCamVerb]}
+        if self.creator:
+            routingFilter['agentID'] = [None, self.creator.uri]
+        if self.event:
+            routingFilter['targetID'] = [None, self.event.uri]
+        return routingFilter
 
 
     def getNode(self):
@@ -1017,18 +1899,17 @@ class CommitsSource(ActivityStreamSourceMixin, item.Item):
     subscription = attributes.reference()
     service = JIDAttribute()
     nodeIdentifier = attributes.text()
+    _feedTexts = attributes.inmemory()
 
     supportedVerbs = (
             ACTIVITY_COMMIT,
             )
 
-    def format_payload(self, payload):
-        try:
-            notification = ActivityStreamSourceMixin.format_payload(self, payload)
-            msg = unicode(payload.object.message).split('\n')[0]
+    def format_record(self, record):
+        notification = ActivityStreamSourceMixin.format_record(self, record)
+        if notification is not None and record.objectMessage is not None:
+            msg = record.objectMessage.split('\n')[0]
             notification['subtitle'] += ': %s' % msg
-        except Exception, e:
-            log.err(e)
         return notification
 
 
@@ -1060,6 +1941,7 @@ class WoWSource(ActivityStreamSourceMixin, item.Item):
     agent = attributes.reference("""
     Reference to the thing representing the agent of the activities.
     """)
+    _feedTexts = attributes.inmemory()
 
     supportedVerbs = (
                 NS_ACTIVITY_SCHEMA + 'post',
@@ -1076,11 +1958,23 @@ class WoWSource(ActivityStreamSourceMixin, item.Item):
             return (getPubSubService(self.agent.uri), u'activity')
 
 
-    def format_payload(self, payload):
-        if not payload.agent or unicode(payload.agent.id) != self.agent.uri:
+    def getRoutingFilter(self):
+        """
+        Only route activities by the agent with one of the supported verbs.
+        """
+        routingFilter = ActivityStreamSourceMixin.getRoutingFilter(self)
+        if self.agent is not None:
+            routingFilter['agentID'] = [self.agent.uri]
+        else:
+            routingFilter['agentID'] = []
+        return routingFilter
+
+
+    def format_record(self, record):
+        if record.agentID is None or record.agentID != self.agent.uri:
             return None
 
-        return ActivityStreamSourceMixin.format_payload(self, payload)
+        return ActivityStreamSourceMixin.format_record(self, record)
 
 
     def renderTitle(self):
@@ -1106,6 +2000,7 @@ class CheckinsSource(ActivityStreamSourceMixin, item.Item):
     site = attributes.reference("""
     Reference to the site representing where activities occur.
     """)
+    _feedTexts = attributes.inmemory()
 
     supportedVerbs = (
                 NS_ACTIVITY_SCHEMA + 'checkin',
@@ -1130,12 +2025,28 @@ class CheckinsSource(ActivityStreamSourceMixin, item.Item):
 
 
 
+_lastSeparators = {'en': u' and ',
+                   'nl': u' en '}
+
 def implodeNames(names, lang):
-    lastsep = {'en': ' and ',
-               'nl': ' en '}[lang]
-    if len(names) < 3:
+    """
+    Join names into an enumeration, like C{u'a, b and c'}.
+
+    The names are visited once, and the result is joined in one go.
+    """
+    lastsep = _lastSeparators[lang]
+    last = len(names) - 1
+    if last < 2:
         return lastsep.join(names)
-    return ', '.join(names[:-1]) + lastsep + names[-1]
+
+    parts = []
+    for index, name in enumerate(names):
+        if index == last:
+            parts.append(lastsep)
+        elif index:
+            parts.append(u', ')
+        parts.append(name)
+    return u''.join(parts)
 
 
 
@@ -1157,3 +2068,15 @@ allSources = [
 """
 The global list of all sources.
 """
+
+
+
+def _compileTexts(cls):
+    """
+    Compile the text labels of a source class and all its subclasses.
+    """
+    cls.compileTexts()
+    for subclass in cls.__subclasses__():
+        _compileTexts(subclass)
+
+_compileTexts(SourceMixin)
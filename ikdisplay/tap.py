@@ -16,7 +16,7 @@ from axiom.store import Store
 
 from twittytwister.twitter import TwitterFeed, TwitterMonitor
 
-from ikdisplay import aggregator, twitter, xmpp
+from ikdisplay import aggregator, archive, journal, twitter, xmpp
 from ikdisplay.web import Index, APIResource
 
 class Options(usage.Options):
@@ -52,9 +52,41 @@ class Options(usage.Options):
             ('twitter-oauth-token-secret', None, None,
                 'Twitter OAuth token secret'),
 
+            ('twitter-streams', None, 1,
+                'Number of Twitter streaming connections to partition the '
+                'filter over', int),
+
             ('embedly-key', None, None,
                 'embed.ly API key'),
 
+            ('journal-dir', None, None,
+                'Directory to keep a journal of incoming events in'),
+            ('journal-max-size', None, 1024,
+                'Maximum size of the journal in MiB', int),
+            ('journal-max-age', None, 7 * 24,
+                'Maximum age of journal segments in hours', int),
+
+            ('archive-dir', None, None,
+                'Directory to archive delivered notifications in'),
+            ('dedupe-window', None, 0,
+                'Number of recent notifications per feed to drop duplicates '
+                'of, or 0 to publish duplicates', int),
+            ('dedupe-age', None, 60,
+                'Number of minutes to drop duplicates of a notification for, '
+                'or 0 for no limit', int),
+            ('flood-rate', None, 0,
+                'Maximum number of notifications per minute per feed, before '
+                'the rest is summarized, or 0 for no maximum', int),
+            ('flood-burst', None, 13,
+                'Number of notifications per feed to let through at once, '
+                'when over the maximum rate', int),
+            ('publish-concurrency', None, 4,
+                'Number of publish requests in flight at once, with the rest '
+                'queued by priority, or 0 to publish right away', int),
+            ('publish-queue', None, 1000,
+                'Maximum number of queued publish requests, before the '
+                'lowest priority ones are dropped', int),
+
             ('web-port', None, 'tcp:8080',
                 'Web service port'),
 
@@ -64,6 +96,11 @@ class Options(usage.Options):
 
     optFlags = [
             ('verbose', 'v', 'Log traffic'),
+            ('journal-sync', None,
+                'Flush the journal to disk with fsync on every commit'),
+            ('twitter-status-stall', None,
+                'Reconnect Twitter streams that stop delivering statuses '
+                'while still sending keep-alives'),
             ]
 
     def postOptions(self):
@@ -86,6 +123,9 @@ class Options(usage.Options):
             except jid.invalidFormat:
                 raise usage.UsageError("Invalid publish-subscribe service JID")
 
+        if self['twitter-streams'] < 1:
+            raise usage.UsageError("Need at least one Twitter stream")
+
         try:
             self['twitter-oauth-consumer'] = OAuthConsumer(
                 key=self['twitter-oauth-consumer-key'],
@@ -136,6 +176,17 @@ def makeService(config):
     # The Admin Secret
     pw = config['admin-secret']
 
+    #
+    # The Journal
+    #
+    if config['journal-dir']:
+        eventJournal = journal.Journal(config['journal-dir'])
+        eventJournal.maxSize = config['journal-max-size'] * 1024 * 1024
+        eventJournal.maxAge = config['journal-max-age'] * 60 * 60
+        eventJournal.sync = bool(config['journal-sync'])
+        eventJournal.setServiceParent(s)
+    else:
+        eventJournal = None
 
     #
     # The XMPP
@@ -145,6 +196,7 @@ def makeService(config):
 
     # Set up PubSubClient for receiving notifications.
     pc = xmpp.PubSubDispatcher(store)
+    pc.journal = eventJournal
     pc.setHandlerParent(xmppService)
 
 
@@ -155,22 +207,65 @@ def makeService(config):
                               passwd=config.get('twitter-password'),
                               consumer=config.get('twitter-oauth-consumer'),
                               token=config.get('twitter-oauth-token'))
-    twitterFeed.protocol = twitter.VerboseTwitterStream
-    tm = TwitterMonitor(api=twitterFeed.filter, delegate=None, args=None)
-    tm.setName('twitter')
-    tm.setServiceParent(store)
+    def twitterProtocol(delegate):
+        protocol = twitter.VerboseTwitterStream(delegate)
+        protocol.checkStatuses = bool(config['twitter-status-stall'])
+        return protocol
+    twitterFeed.protocol = twitterProtocol
+    monitors = []
+    for index in xrange(config['twitter-streams']):
+        tm = TwitterMonitor(api=twitterFeed.filter, delegate=None, args=None)
+        tm.setName('twitter-%d' % index)
+        tm.setServiceParent(store)
+        monitors.append(tm)
 
     embedder = twitter.Embedder(config)
-    td = twitter.TwitterDispatcher(store, tm, embedder)
+    td = twitter.TwitterDispatcher(store, monitors, embedder)
+    td.journal = eventJournal
+
+    if eventJournal is not None:
+        eventJournal.handlers[xmpp.JOURNAL_PUBSUB] = pc.replayItems
+        eventJournal.handlers[twitter.JOURNAL_TWITTER] = td.replayDatagram
 
     #
     # The Aggregator
     #
     agg = aggregator.PubSubAggregator(config['service'])
     agg.pubsubHandler = pc
+    if config['dedupe-window']:
+        agg.deduplicator = aggregator.Deduplicator(
+            config['dedupe-window'], config['dedupe-age'] * 60 or None)
+    if config['flood-rate']:
+        agg.floodControl = aggregator.FloodControl(agg.publishNotifications,
+                                                   config['flood-rate'] / 60.0,
+                                                   config['flood-burst'])
+        agg.floodControl.store = store
+    if config['publish-concurrency']:
+        agg.scheduler = aggregator.LaneScheduler(agg.publishNotifications,
+                                                 config['publish-concurrency'],
+                                                 config['publish-queue'])
+    if config['archive-dir']:
+        notificationArchive = archive.NotificationArchive(
+            config['archive-dir'])
+        notificationArchive.setServiceParent(s)
+        agg.archive = notificationArchive
+    else:
+        notificationArchive = None
     agg.setName('aggregator')
     agg.setServiceParent(service.IService(store))
 
+    #
+    # The History
+    #
+    history = aggregator.AggregatorFromNotifier()
+    history.archive = notificationArchive
+    history.pubsubHandler = pc
+    history.service = config['service']
+    history.feeds = [feed.handle for feed in store.query(aggregator.Feed)]
+    history.setName('history')
+    history.setServiceParent(s)
+    agg.history = history
+
 
     #
     # The Web
@@ -178,7 +273,11 @@ def makeService(config):
     rootResource = resource.Resource()
     rootResource.putChild('', Index(pw))
     rootResource.putChild('static', static.File("ikdisplay/web/static"))
-    rootResource.putChild('api', APIResource(store, pc, td, pw))
+    rootResource.putChild('api', APIResource(store, pc, td, pw,
+                                               notificationArchive,
+                                               agg.deduplicator,
+                                               agg.scheduler,
+                                               history))
 
     ws = strports.service(config['web-port'], server.Site(rootResource))
     ws.setServiceParent(s)
@@ -188,11 +287,15 @@ def makeService(config):
     #
     namespace = {
         'aggregator': agg,
+        'archive': notificationArchive,
+        'dispatcher': td,
         'embedder': embedder,
+        'history': history,
+        'journal': eventJournal,
         'pubsub': pc,
         'root': rootResource,
         'store': store,
-        'twitter': tm,
+        'twitter': monitors,
         'web': ws,
         }
 
@@ -3,9 +3,12 @@ Tests for L{ikdisplay.aggregator}.
 """
 
 from twisted.application import service
+from twisted.internet import defer, task
 from twisted.trial import unittest
+from twisted.words.protocols.jabber import error
 from axiom.store import Store
-from ikdisplay import aggregator
+from ikdisplay import aggregator, archive, xmpp
+from ikdisplay.notification import Notification
 
 class TestAggregator(service.Service):
     """
@@ -46,3 +49,711 @@ class FeedTest(unittest.TestCase):
 
         self.assertEquals(notification,
                           agg.notifications[u'mediamatic'][-1])
+
+
+
+class FloodControlTest(unittest.TestCase):
+    """
+    Tests for L{aggregator.FloodControl}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.published = []
+        self.floodControl = aggregator.FloodControl(
+            lambda feed, notifications: self.published.append((feed,
+                                                               notifications)),
+            rate=0.1, burst=4, clock=self.clock)
+
+
+    def notifications(self, count, priority=0, subtitle=u'test'):
+        notifications = []
+        for i in xrange(count):
+            notification = Notification(title=u'%d' % i, subtitle=subtitle)
+            notification.priority = priority
+            notifications.append(notification)
+        return notifications
+
+
+    def test_filterNotifications(self):
+        """
+        Notifications within the burst are let through, and the rest are
+        summarized after the summary interval.
+        """
+        result = self.floodControl.filterNotifications(
+            u'test', self.notifications(6, subtitle=u'#Event and #other'))
+        self.assertEquals(4, len(result))
+        self.assertEquals([], self.published)
+
+        self.floodControl.filterNotifications(
+            u'test', self.notifications(1, subtitle=u'#event'))
+        self.clock.advance(self.floodControl.summaryInterval)
+
+        self.assertEquals(1, len(self.published))
+        feed, [summary] = self.published[0]
+        self.assertEquals(u'test', feed)
+        self.assertEquals(u'and 3 more', summary['title'])
+        self.assertEquals(u'about #event, #other', summary['subtitle'])
+        self.assertEquals({u'test': 4}, self.floodControl.passed)
+        self.assertEquals({u'test': 3}, self.floodControl.held)
+
+
+    def test_rate(self):
+        """
+        After the burst, notifications are let through at the rate.
+        """
+        self.floodControl.filterNotifications(u'test', self.notifications(4))
+        self.clock.advance(10)
+        result = self.floodControl.filterNotifications(u'test',
+                                                       self.notifications(2))
+        self.assertEquals(1, len(result))
+        self.clock.advance(self.floodControl.summaryInterval)
+
+
+    def test_perFeed(self):
+        """
+        Each feed has its own rate.
+        """
+        self.floodControl.filterNotifications(u'test', self.notifications(4))
+        result = self.floodControl.filterNotifications(u'other',
+                                                       self.notifications(4))
+        self.assertEquals(4, len(result))
+
+
+    def test_priority(self):
+        """
+        Notifications with a positive priority are always let through, and
+        those with a negative priority only within the reserve.
+        """
+        low = self.notifications(3, priority=-1)
+        normal = self.notifications(1)
+        high = self.notifications(2, priority=1)
+
+        result = self.floodControl.filterNotifications(u'test', low + normal)
+        self.assertEquals(normal + low[:1], result)
+
+        result = self.floodControl.filterNotifications(u'test', normal + high)
+        self.assertEquals(high, result)
+
+        self.clock.advance(self.floodControl.summaryInterval)
+        self.assertEquals(u'and 3 more', self.published[0][1][0]['title'])
+
+
+    def test_updateExempt(self):
+        """
+        Updates of items that were let through before are always let
+        through, without using up the rate.
+        """
+        notifications = self.notifications(4)
+        for i, notification in enumerate(notifications):
+            notification.itemIdentifier = u'status-%d' % i
+        self.floodControl.filterNotifications(u'test', notifications)
+
+        update = Notification(title=u'0', retweets=u'2')
+        update.itemIdentifier = u'status-0'
+        other = Notification(title=u'9')
+        other.itemIdentifier = u'status-9'
+        result = self.floodControl.filterNotifications(u'test',
+                                                       [update, other])
+        self.assertEquals([update], result)
+        self.assertEquals({u'test': 5}, self.floodControl.passed)
+        self.floodControl.stop()
+
+
+    def test_summaryMeta(self):
+        """
+        Summaries have the time they were made as meta data.
+        """
+        self.clock.advance(14 * 24 * 60 * 60)
+        self.floodControl.filterNotifications(u'test', self.notifications(5))
+        self.floodControl.stop()
+        self.assertTrue(
+            self.published[0][1][0]['meta'].startswith(u'Jan 15, '))
+
+
+    def test_summaryLanguage(self):
+        """
+        Summaries are in the language of the feed.
+        """
+        store = Store()
+        aggregator.Feed(store=store, handle=u'test', language=u'nl')
+        self.floodControl.store = store
+        self.clock.advance(14 * 24 * 60 * 60)
+        self.floodControl.filterNotifications(
+            u'test', self.notifications(5, subtitle=u'#event'))
+        self.floodControl.stop()
+
+        summary = self.published[0][1][0]
+        self.assertEquals(u'en nog 1', summary['title'])
+        self.assertEquals(u'over #event', summary['subtitle'])
+        self.assertTrue(summary['meta'].startswith(u'15 jan, '))
+
+
+    def test_stop(self):
+        """
+        When stopped, summaries of held back notifications are published.
+        """
+        self.floodControl.filterNotifications(u'test', self.notifications(5))
+        self.floodControl.stop()
+        self.assertEquals(u'and 1 more', self.published[0][1][0]['title'])
+        self.assertEquals([], self.clock.calls)
+
+
+
+class LaneSchedulerTest(unittest.TestCase):
+    """
+    Tests for L{aggregator.LaneScheduler}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.published = []
+        self.scheduler = aggregator.LaneScheduler(self.publish, maxPending=1,
+                                                  maxQueued=3,
+                                                  clock=self.clock)
+
+
+    def publish(self, feed, notifications):
+        d = defer.Deferred()
+        self.published.append((feed, notifications, d))
+        return d
+
+
+    def notification(self, title, priority=0):
+        notification = Notification(title=title)
+        notification.priority = priority
+        return notification
+
+
+    def titles(self):
+        return [[notification['title'] for notification in notifications]
+                for _, notifications, _ in self.published]
+
+
+    def test_enqueue(self):
+        """
+        Notifications are published right away if nothing is pending.
+        """
+        self.scheduler.enqueue(u'test', [self.notification(u'1')])
+        self.assertEquals([[u'1']], self.titles())
+        self.assertEquals(u'test', self.published[0][0])
+
+
+    def test_synchronous(self):
+        """
+        Publishes that fail right away do not nest, and free their slot.
+        """
+        def publish(feed, notifications):
+            self.assertEquals(1, self.scheduler.pending)
+            raise ValueError()
+
+        self.scheduler.maxQueued = 5000
+        for i in xrange(3001):
+            self.scheduler.enqueue(u'test', [self.notification(u'%d' % i)])
+
+        self.scheduler.publish = publish
+        self.published[0][2].callback(None)
+
+        self.assertEquals(0, self.scheduler.pending)
+        self.assertEquals(0, self.scheduler.queued)
+        self.assertEquals(3000, len(self.flushLoggedErrors(ValueError)))
+
+
+    def test_priority(self):
+        """
+        Queued notifications are published highest priority first, split
+        into lanes by priority.
+        """
+        self.scheduler.enqueue(u'test', [self.notification(u'first')])
+        self.scheduler.enqueue(u'test', [self.notification(u'low', -1),
+                                         self.notification(u'normal')])
+        self.scheduler.enqueue(u'test', [self.notification(u'high', 1)])
+
+        for i in xrange(3):
+            self.published[-1][2].callback(None)
+
+        self.assertEquals([[u'first'], [u'high'], [u'normal'], [u'low']],
+                          self.titles())
+
+
+    def test_shed(self):
+        """
+        When too many batches are queued, the oldest of the lowest priority
+        is shed.
+        """
+        self.scheduler.enqueue(u'test', [self.notification(u'first')])
+        self.scheduler.enqueue(u'test', [self.notification(u'low1', -1)])
+        self.scheduler.enqueue(u'test', [self.notification(u'low2', -1)])
+        self.scheduler.enqueue(u'test', [self.notification(u'high', 1)])
+        self.scheduler.enqueue(u'test', [self.notification(u'normal')])
+
+        for i in xrange(3):
+            self.published[-1][2].callback(None)
+
+        self.assertEquals([[u'first'], [u'high'], [u'normal'], [u'low2']],
+                          self.titles())
+        self.assertEquals(1, self.scheduler.getMetrics()[-1]['shed'])
+
+
+    def test_publishFailed(self):
+        """
+        Failures to publish are logged, and the next batch is published.
+        """
+        self.scheduler.enqueue(u'test', [self.notification(u'1')])
+        self.scheduler.enqueue(u'test', [self.notification(u'2')])
+        self.published[0][2].errback(ValueError())
+
+        self.assertEquals([[u'1'], [u'2']], self.titles())
+        self.assertEquals(1, len(self.flushLoggedErrors(ValueError)))
+
+
+    def test_getMetrics(self):
+        """
+        The time batches spent queued is measured per lane.
+        """
+        self.scheduler.enqueue(u'test', [self.notification(u'first')])
+        self.scheduler.enqueue(u'test', [self.notification(u'high', 1)])
+        self.clock.advance(2)
+        self.scheduler.enqueue(u'test', [self.notification(u'high', 1)])
+        self.clock.advance(1)
+        self.published[-1][2].callback(None)
+        self.clock.advance(1)
+        self.published[-1][2].callback(None)
+
+        self.assertEquals({0: {'queued': 0, 'published': 1, 'shed': 0,
+                               'meanDelay': 0, 'maxDelay': 0},
+                           1: {'queued': 0, 'published': 2, 'shed': 0,
+                               'meanDelay': 2.5, 'maxDelay': 3}},
+                          self.scheduler.getMetrics())
+
+
+
+class PubSubAggregatorTest(unittest.TestCase):
+    """
+    Tests for L{aggregator.PubSubAggregator}.
+    """
+
+    def setUp(self):
+        self.published = []
+        self.agg = aggregator.PubSubAggregator(u'pubsub.example.org')
+        self.agg.pubsubHandler = self
+
+
+    def publishNotifications(self, service, nodeIdentifier, notifications):
+        self.published.append((service, nodeIdentifier, notifications))
+        return defer.succeed(None)
+
+
+    def test_processNotifications(self):
+        """
+        Notifications are published to the node of the feed.
+        """
+        notifications = [{'title': u'Test'}]
+        self.agg.processNotifications(u'test', notifications)
+        self.assertEquals([(u'pubsub.example.org', u'test', notifications)],
+                          self.published)
+
+
+    def test_processNotificationsArchive(self):
+        """
+        If there is an archive, published notifications are added to it.
+        """
+        self.agg.archive = archive.NotificationArchive(self.mktemp(),
+                                                       task.Clock())
+        self.agg.processNotifications(u'test', [{'title': u'Test'}])
+
+        entries = self.agg.archive.getLast(u'test', 10)
+        self.assertEquals([{'title': u'Test'}],
+                          [notification for _, notification in entries])
+
+
+    def test_processNotificationsHistory(self):
+        """
+        If there is a history, published notifications are added to it.
+        """
+        self.agg.history = aggregator.AggregatorFromNotifier()
+        self.agg.processNotifications(u'test', [{'title': u'Test'}])
+
+        d = self.agg.history.getHistory(u'test')
+        d.addCallback(self.assertEquals, [{'title': u'Test'}])
+        return d
+
+
+    def test_publishNotificationsFailed(self):
+        """
+        Notifications that failed to publish are logged, and not archived or
+        added to the history.
+        """
+        def publish(service, nodeIdentifier, items):
+            return defer.fail(error.StanzaError('not-authorized'))
+
+        self.agg.pubsubHandler = xmpp.PubSubDispatcher(Store())
+        self.agg.pubsubHandler.publish = publish
+        self.agg.archive = archive.NotificationArchive(self.mktemp(),
+                                                       task.Clock())
+        self.agg.history = aggregator.AggregatorFromNotifier()
+
+        self.agg.publishNotifications(u'test', [Notification(title=u'Test')])
+
+        self.assertEquals(1, len(self.flushLoggedErrors(error.StanzaError)))
+        self.assertEquals([], self.agg.archive.getLast(u'test', 10))
+        self.assertEquals({}, self.agg.history.history)
+
+
+    def test_processNotificationsDeduplicate(self):
+        """
+        If there is a deduplicator, duplicate notifications are not
+        published.
+        """
+        self.agg.deduplicator = aggregator.Deduplicator()
+        self.agg.processNotifications(u'test', [{'title': u'Test'}])
+        self.agg.processNotifications(u'test', [{'title': u'Test'}])
+        self.agg.processNotifications(u'test', [{'title': u'Test'},
+                                                {'title': u'Other'}])
+        self.assertEquals([[{'title': u'Test'}], [{'title': u'Other'}]],
+                          [notifications
+                           for _, _, notifications in self.published])
+
+
+    def test_processNotificationsFloodControl(self):
+        """
+        If there is flood control, notifications over the rate are not
+        published.
+        """
+        self.agg.floodControl = aggregator.FloodControl(
+            self.agg.publishNotifications, rate=1, burst=2,
+            clock=task.Clock())
+        self.agg.processNotifications(u'test', [{'title': u'1'},
+                                                {'title': u'2'},
+                                                {'title': u'3'}])
+        self.assertEquals([[{'title': u'1'}, {'title': u'2'}]],
+                          [notifications
+                           for _, _, notifications in self.published])
+
+        self.agg.stopService()
+        self.assertEquals([u'and 1 more'],
+                          [summary['title'] for summary in self.published[1][2]])
+
+
+    def test_processNotificationsScheduler(self):
+        """
+        If there is a scheduler, notifications are queued for publishing.
+        """
+        scheduled = []
+        self.agg.scheduler = aggregator.LaneScheduler(
+            lambda feed, notifications: scheduled.append(notifications),
+            clock=task.Clock())
+        self.agg.processNotifications(u'test', [{'title': u'Test'}])
+
+        self.assertEquals([[{'title': u'Test'}]], scheduled)
+        self.assertEquals([], self.published)
+
+
+
+class TestNotifier(object):
+    """
+    A notifier that stores all notifications in sequence.
+    """
+
+    def __init__(self):
+        self.notifications = []
+
+
+    def notify(self, notification):
+        self.notifications.append(notification)
+
+
+
+class FingerprintTest(unittest.TestCase):
+    """
+    Tests for L{aggregator.fingerprint}.
+    """
+
+    def test_normalized(self):
+        """
+        Differences in case and whitespace do not change the fingerprint.
+        """
+        self.assertEquals(
+            aggregator.fingerprint({'title': u'Test User',
+                                    'subtitle': u'roze  koeken\nftw '}),
+            aggregator.fingerprint({'title': u'test user',
+                                    'subtitle': u'Roze koeken ftw'}))
+
+
+    def test_metaVia(self):
+        """
+        The time and source of a notification are not part of the
+        fingerprint.
+        """
+        self.assertEquals(
+            aggregator.fingerprint(Notification(title=u'Test',
+                                                meta=u'12:00', via=u'a')),
+            aggregator.fingerprint({'title': u'Test', 'via': u'b'}))
+
+
+    def test_fields(self):
+        """
+        Content in different fields has a different fingerprint.
+        """
+        self.assertNotEquals(aggregator.fingerprint({'title': u'Test'}),
+                             aggregator.fingerprint({'subtitle': u'Test'}))
+        self.assertNotEquals(
+            aggregator.fingerprint({'title': u'Test', 'uri': u'http://a/'}),
+            aggregator.fingerprint({'title': u'Test', 'uri': u'http://b/'}))
+
+
+
+class DeduplicatorTest(unittest.TestCase):
+    """
+    Tests for L{aggregator.Deduplicator}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.deduplicator = aggregator.Deduplicator(windowSize=2, maxAge=60,
+                                                    clock=self.clock)
+
+
+    def filter(self, feed, *titles):
+        notifications = [Notification(title=title) for title in titles]
+        result = self.deduplicator.filterNotifications(feed, notifications)
+        return [notification['title'] for notification in result]
+
+
+    def test_filterNotifications(self):
+        """
+        Notifications with content seen before are dropped, also within a
+        batch.
+        """
+        self.assertEquals([u'1', u'2'], self.filter(u'test', u'1', u'2', u'1'))
+        self.assertEquals([u'3'], self.filter(u'test', u'2', u'3'))
+
+
+    def test_origin(self):
+        """
+        Notifications with the same content from different incoming items
+        are not duplicates, those from the same item are.
+        """
+        def vote(origin):
+            notification = Notification(title=u'Alice',
+                                        subtitle=u'voted for Yes')
+            notification.origin = origin
+            return notification
+
+        result = self.deduplicator.filterNotifications(
+            u'test', [vote(u'vote/1/a'), vote(u'vote/2/b'), vote(u'vote/1/a')])
+        self.assertEquals([u'vote/1/a', u'vote/2/b'],
+                          [notification.origin for notification in result])
+
+
+    def test_perFeed(self):
+        """
+        Duplicates are only dropped within the same feed.
+        """
+        self.assertEquals([u'1'], self.filter(u'test', u'1'))
+        self.assertEquals([u'1'], self.filter(u'other', u'1'))
+
+
+    def test_window(self):
+        """
+        Only the most recently seen fingerprints are remembered.
+        """
+        self.filter(u'test', u'1', u'2')
+        self.assertEquals([u'3'], self.filter(u'test', u'1', u'3'))
+        self.assertEquals([u'2'], self.filter(u'test', u'2'))
+
+
+    def test_maxAge(self):
+        """
+        Fingerprints first seen longer than the maximum age ago are
+        forgotten, also when seen again in between.
+        """
+        self.filter(u'test', u'1')
+        self.clock.advance(60)
+        self.assertEquals([], self.filter(u'test', u'1'))
+        self.clock.advance(1)
+        self.assertEquals([u'1'], self.filter(u'test', u'1'))
+        self.assertEquals([], self.filter(u'test', u'1'))
+
+
+    def test_maxAgeNone(self):
+        """
+        Without a maximum age, fingerprints are kept until pushed out.
+        """
+        self.deduplicator = aggregator.Deduplicator(maxAge=None,
+                                                    clock=self.clock)
+        self.filter(u'test', u'1')
+        self.clock.advance(86400)
+        self.assertEquals([], self.filter(u'test', u'1'))
+
+
+    def test_getMetrics(self):
+        """
+        The numbers of checked and dropped notifications are kept per feed.
+        """
+        self.filter(u'test', u'1', u'1')
+        self.filter(u'test', u'1')
+        self.filter(u'other', u'1')
+        self.assertEquals({u'test': {'checked': 3, 'hits': 2},
+                           u'other': {'checked': 1, 'hits': 0}},
+                          self.deduplicator.getMetrics())
+
+
+
+class AggregatorFromNotifierTest(unittest.TestCase):
+    """
+    Tests for L{aggregator.AggregatorFromNotifier}.
+    """
+
+    def setUp(self):
+        self.notifier = TestNotifier()
+        self.agg = aggregator.AggregatorFromNotifier(self.notifier)
+        self.agg.maxHistory = 3
+        self.fetches = {}
+
+
+    def fetchNotifications(self, service, nodeIdentifier, maxItems):
+        d = defer.Deferred()
+        self.fetches[nodeIdentifier] = (service, maxItems, d)
+        return d
+
+
+    def titles(self, notifications):
+        return [notification['title'] for notification in notifications]
+
+
+    def test_processNotifications(self):
+        """
+        Notifications are passed to the notifier and kept in the history of
+        their feed.
+        """
+        self.agg.startService()
+        self.agg.processNotifications(u'test', [{'title': u'1'},
+                                                {'title': u'2'}])
+        self.agg.processNotifications(u'other', [{'title': u'o1'}])
+        self.agg.processNotifications(u'test', [{'title': u'3'},
+                                                {'title': u'4'}])
+        self.assertEquals([u'1', u'2', u'o1', u'3', u'4'],
+                          self.titles(self.notifier.notifications))
+        d = self.agg.getHistory(u'test')
+        d.addCallback(self.titles)
+        d.addCallback(self.assertEquals, [u'2', u'3', u'4'])
+        return d
+
+
+    def test_processNotificationsNoNotifier(self):
+        """
+        Without a notifier, notifications are only kept in the history.
+        """
+        self.agg = aggregator.AggregatorFromNotifier()
+        self.agg.startService()
+        self.agg.processNotifications(u'test', [{'title': u'1'}])
+        d = self.agg.getHistory(u'test')
+        d.addCallback(self.titles)
+        d.addCallback(self.assertEquals, [u'1'])
+        return d
+
+
+    def test_restoreFromArchive(self):
+        """
+        At startup, the last archived notifications of each feed are
+        restored, oldest first.
+        """
+        clock = task.Clock()
+        self.agg.archive = archive.NotificationArchive(self.mktemp(), clock)
+        self.agg.archive.addNotifications(u'a', [{'title': u'a1'}])
+        clock.advance(1)
+        self.agg.archive.addNotifications(u'b', [{'title': u'b1'},
+                                                 {'title': u'b2'}])
+        clock.advance(1)
+        self.agg.archive.addNotifications(u'a', [{'title': u'a2'}])
+
+        self.agg.startService()
+        d = defer.gatherResults([self.agg.getHistory(u'a'),
+                                 self.agg.getHistory(u'b')])
+        d.addCallback(lambda results: map(self.titles, results))
+        d.addCallback(self.assertEquals, [[u'a1', u'a2'], [u'b1', u'b2']])
+        return d
+
+
+    def test_processNotificationsUpdate(self):
+        """
+        Updates of an item replace the notification of that item in the
+        history.
+        """
+        def makeNotification(title, itemIdentifier=None):
+            notification = Notification(title=title)
+            notification.itemIdentifier = itemIdentifier
+            return notification
+
+        self.agg.startService()
+        self.agg.processNotifications(u'test', [makeNotification(u'1', u'a'),
+                                                makeNotification(u'2')])
+        self.agg.processNotifications(u'test', [makeNotification(u'3', u'a'),
+                                                makeNotification(u'4', u'a')])
+        d = self.agg.getHistory(u'test')
+        d.addCallback(self.titles)
+        d.addCallback(self.assertEquals, [u'4', u'2'])
+        return d
+
+
+    def test_restoreFromArchiveUpdates(self):
+        """
+        Archived updates of an item are restored as a single notification.
+        """
+        clock = task.Clock()
+        self.agg.archive = archive.NotificationArchive(self.mktemp(), clock)
+        for title in (u'1', u'2', u'3'):
+            notification = Notification(title=title)
+            notification.itemIdentifier = u'status-1'
+            self.agg.archive.addNotifications(u'a', [notification])
+
+        self.agg.startService()
+        d = self.agg.getHistory(u'a')
+        d.addCallback(self.titles)
+        d.addCallback(self.assertEquals, [u'3'])
+        return d
+
+
+    def test_restoreFromPubSub(self):
+        """
+        Without an archive, the notifications of the feeds are requested in
+        parallel, and the history waits for the responses.
+        """
+        self.agg.pubsubHandler = self
+        self.agg.service = u'pubsub.example.org'
+        self.agg.feeds = [u'a', u'b']
+        self.agg.startService()
+
+        self.assertEquals([u'a', u'b'], sorted(self.fetches))
+        self.assertEquals((u'pubsub.example.org', 3), self.fetches[u'a'][:2])
+
+        d = self.agg.getHistory(u'a')
+        self.agg.processNotifications(u'a', [{'title': u'new'}])
+        self.fetches[u'b'][2].callback([{'title': u'b1'}])
+        self.assertNoResult(d)
+        self.fetches[u'a'][2].callback([{'title': u'a1'}, {'title': u'a2'}])
+
+        d.addCallback(self.titles)
+        d.addCallback(self.assertEquals, [u'a1', u'a2', u'new'])
+        return d
+
+
+    def test_restoreFromPubSubFailure(self):
+        """
+        Failing to retrieve the notifications of a feed is logged, and the
+        other feeds are still restored.
+        """
+        self.agg.pubsubHandler = self
+        self.agg.feeds = [u'a', u'b']
+        self.agg.startService()
+
+        self.fetches[u'a'][2].errback(ValueError())
+        self.fetches[u'b'][2].callback([{'title': u'b1'}])
+
+        self.assertEquals(1, len(self.flushLoggedErrors(ValueError)))
+        d = defer.gatherResults([self.agg.getHistory(u'a'),
+                                 self.agg.getHistory(u'b')])
+        d.addCallback(lambda results: map(self.titles, results))
+        d.addCallback(self.assertEquals, [[], [u'b1']])
+        return d
@@ -0,0 +1,200 @@
+"""
+Tests for L{ikdisplay.archive}.
+"""
+
+import os
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from ikdisplay import archive
+from ikdisplay.notification import Notification
+
+class NotificationArchiveTest(unittest.TestCase):
+    """
+    Tests for L{archive.NotificationArchive}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.path = self.mktemp()
+        self.archive = archive.NotificationArchive(self.path, self.clock)
+        self.archive.startService()
+        self.addCleanup(self.archive.stopService)
+
+
+    def addNotifications(self, handle, count, start=0):
+        notifications = [Notification(title=u'Title %d' % i,
+                                      subtitle=u'test')
+                         for i in xrange(start, start + count)]
+        self.archive.addNotifications(handle, notifications)
+        return notifications
+
+
+    def titles(self, entries):
+        return [notification['title'] for timestamp, notification in entries]
+
+
+    def test_addNotificationsBuffered(self):
+        """
+        Added notifications are written together after the flush delay.
+        """
+        self.addNotifications(u'test', 2)
+        self.assertFalse(os.path.exists(self.path))
+
+        self.clock.advance(self.archive.flushDelay)
+        self.assertEquals(['0000000000000000.data',
+                           '0000000000000000.index'],
+                          sorted(os.listdir(os.path.join(self.path, 'test'))))
+
+
+    def test_getLast(self):
+        """
+        The last notifications are returned with their time, oldest first.
+        """
+        notifications = self.addNotifications(u'test', 3)
+        self.clock.advance(5)
+        notifications.extend(self.addNotifications(u'test', 2, start=3))
+
+        entries = self.archive.getLast(u'test', 4)
+        self.assertEquals([1000, 1000, 1005, 1005],
+                          [timestamp for timestamp, _ in entries])
+        self.assertEquals(notifications[1:],
+                          [notification for _, notification in entries])
+
+
+    def test_getLastFew(self):
+        """
+        If less notifications have been archived, all of them are returned.
+        """
+        self.addNotifications(u'test', 2)
+        self.assertEquals([u'Title 0', u'Title 1'],
+                          self.titles(self.archive.getLast(u'test', 10)))
+
+
+    def test_getLastItemIdentifier(self):
+        """
+        The item identifiers of notifications are archived with them.
+        """
+        notification = Notification(title=u'Test')
+        notification.itemIdentifier = u"status-1 & 'more'"
+        self.archive.addNotifications(u'test', [notification,
+                                                Notification(title=u'Other')])
+
+        entries = self.archive.getLast(u'test', 10)
+        self.assertEquals([u"status-1 & 'more'", None],
+                          [notification.itemIdentifier
+                           for _, notification in entries])
+        self.assertEquals([{'title': u'Test'}, {'title': u'Other'}],
+                          [notification for _, notification in entries])
+
+
+    def test_getLastUnknown(self):
+        """
+        Feeds without archived notifications have no last notifications.
+        """
+        self.assertEquals([], self.archive.getLast(u'unknown', 10))
+
+
+    def test_getLastSegments(self):
+        """
+        The last notifications are read across segments.
+        """
+        self.archive.segmentSize = 1
+        for i in xrange(4):
+            self.addNotifications(u'test', 1, start=i)
+            self.archive.flush()
+
+        self.assertEquals(4, len(os.listdir(os.path.join(self.path,
+                                                         'test'))) // 2)
+        self.assertEquals([u'Title 1', u'Title 2', u'Title 3'],
+                          self.titles(self.archive.getLast(u'test', 3)))
+
+
+    def test_getSince(self):
+        """
+        Notifications archived at or after the given time are returned.
+        """
+        self.archive.segmentSize = 1
+        for i in xrange(6):
+            self.addNotifications(u'test', 1, start=i)
+            self.archive.flush()
+            self.clock.advance(10)
+
+        self.assertEquals([u'Title 3', u'Title 4', u'Title 5'],
+                          self.titles(self.archive.getSince(u'test', 1025)))
+        self.assertEquals([u'Title 3', u'Title 4', u'Title 5'],
+                          self.titles(self.archive.getSince(u'test', 1030)))
+        self.assertEquals([], self.archive.getSince(u'test', 2000))
+
+
+    def test_feeds(self):
+        """
+        Notifications are archived per feed.
+        """
+        self.addNotifications(u'test', 1)
+        self.addNotifications(u'other/feed', 1, start=1)
+        self.assertEquals([u'Title 0'],
+                          self.titles(self.archive.getLast(u'test', 10)))
+        self.assertEquals([u'Title 1'],
+                          self.titles(self.archive.getLast(u'other/feed', 10)))
+
+
+    def test_getHandles(self):
+        """
+        The handles of feeds with archived notifications are returned.
+        """
+        self.addNotifications(u'test', 1)
+        self.archive.flush()
+        self.addNotifications(u'other/feed', 1)
+        self.assertEquals([u'other/feed', u'test'], self.archive.getHandles())
+
+
+    def test_fields(self):
+        """
+        All fields, including those set to C{None}, are archived.
+        """
+        notification = Notification(title=u'Caf\xe9 <1>', via=None,
+                                    meta=u'Mar 5, 9:07')
+        self.archive.addNotifications(u'test', [notification])
+        timestamp, result = self.archive.getLast(u'test', 1)[0]
+        self.assertEquals(notification, result)
+
+
+    def test_newSegmentOnRestart(self):
+        """
+        After a restart, notifications are appended in a new segment.
+        """
+        self.addNotifications(u'test', 1)
+        self.archive.stopService()
+
+        self.archive = archive.NotificationArchive(self.path, self.clock)
+        self.addNotifications(u'test', 1, start=1)
+        self.archive.flush()
+
+        self.assertEquals([u'Title 0', u'Title 1'],
+                          self.titles(self.archive.getLast(u'test', 10)))
+        self.assertEquals(4, len(os.listdir(os.path.join(self.path, 'test'))))
+
+
+    def test_partialIndex(self):
+        """
+        Index entries that were partly written, or that point past the end of
+        the data, are ignored.
+        """
+        self.addNotifications(u'test', 2)
+        self.archive.stopService()
+
+        path = os.path.join(self.path, 'test', '0000000000000000')
+        f = open(path + '.data', 'r+b')
+        f.truncate(os.path.getsize(path + '.data') - 1)
+        f.close()
+        f = open(path + '.index', 'ab')
+        f.write('\x00' * 5)
+        f.close()
+
+        self.assertEquals([u'Title 0'],
+                          self.titles(self.archive.getLast(u'test', 10)))
+        self.assertEquals([u'Title 0'],
+                          self.titles(self.archive.getSince(u'test', 0)))
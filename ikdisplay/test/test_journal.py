@@ -0,0 +1,210 @@
+"""
+Tests for L{ikdisplay.journal}.
+"""
+
+import os
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from ikdisplay import journal
+
+class JournalTest(unittest.TestCase):
+    """
+    Tests for L{journal.Journal}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.path = self.mktemp()
+        self.journal = journal.Journal(self.path, self.clock)
+        self.journal.sync = False
+        self.journal.startService()
+        self.addCleanup(self.journal.stopService)
+
+
+    def segments(self):
+        return sorted(os.listdir(self.path))
+
+
+    def test_appendGroupCommit(self):
+        """
+        Appended records are written together after the commit delay.
+        """
+        self.journal.append('test', 'one')
+        self.journal.append('test', 'two')
+        self.assertEquals([], self.segments())
+
+        self.clock.advance(self.journal.commitDelay)
+        self.assertEquals(['0000000000000000.journal'], self.segments())
+        self.assertEquals([(1000, 'test', 'one'), (1000, 'test', 'two')],
+                          list(self.journal.records()))
+
+
+    def test_records(self):
+        """
+        Records have their kind, time and data, in the order appended.
+        """
+        self.journal.append('pubsub', '<items/>')
+        self.clock.advance(5)
+        self.journal.append('twitter', '{"text": "\xc3\xa9"}')
+        self.assertEquals([(1000, 'pubsub', '<items/>'),
+                           (1005, 'twitter', '{"text": "\xc3\xa9"}')],
+                          list(self.journal.records()))
+
+
+    def test_recordsSince(self):
+        """
+        Records from before the given time are skipped.
+        """
+        self.journal.append('test', 'one')
+        self.clock.advance(5)
+        self.journal.append('test', 'two')
+        self.assertEquals([(1005, 'test', 'two')],
+                          list(self.journal.records(since=1001)))
+
+
+    def test_recordsCorrupt(self):
+        """
+        Reading a segment stops at a record with a wrong checksum.
+        """
+        self.journal.append('test', 'one')
+        self.journal.append('test', 'two')
+        self.journal.commit()
+
+        path = os.path.join(self.path, self.segments()[0])
+        f = open(path, 'r+b')
+        f.seek(-1, os.SEEK_END)
+        f.write('X')
+        f.close()
+
+        self.assertEquals([(1000, 'test', 'one')],
+                          list(self.journal.records()))
+
+
+    def test_recordsTruncated(self):
+        """
+        A record that was only partly written is skipped.
+        """
+        self.journal.append('test', 'one')
+        self.journal.append('test', 'two')
+        self.journal.commit()
+
+        path = os.path.join(self.path, self.segments()[0])
+        f = open(path, 'r+b')
+        f.truncate(os.path.getsize(path) - 2)
+        f.close()
+
+        self.assertEquals([(1000, 'test', 'one')],
+                          list(self.journal.records()))
+
+
+    def test_newSegmentOnStart(self):
+        """
+        Every start of the journal begins a new segment.
+        """
+        self.journal.append('test', 'one')
+        self.journal.stopService()
+
+        self.journal.startService()
+        self.journal.append('test', 'two')
+        self.journal.commit()
+
+        self.assertEquals(['0000000000000000.journal',
+                           '0000000000000001.journal'], self.segments())
+        self.assertEquals(['one', 'two'],
+                          [data for _, _, data in self.journal.records()])
+
+
+    def test_segmentSize(self):
+        """
+        A new segment is started when the current one is full.
+        """
+        self.journal.segmentSize = 50
+        for i in xrange(4):
+            self.journal.append('test', 'x' * 20)
+            self.journal.commit()
+
+        self.assertEquals(2, len(self.segments()))
+        self.assertEquals(4, len(list(self.journal.records())))
+
+
+    def test_pruneSize(self):
+        """
+        The oldest segments are removed when over the maximum size.
+        """
+        self.journal.segmentSize = 1
+        for i in xrange(4):
+            self.journal.append('test', str(i) * 20)
+            self.journal.commit()
+
+        self.journal.maxSize = 100
+        self.journal.prune()
+
+        self.assertEquals(['0000000000000002.journal',
+                           '0000000000000003.journal'], self.segments())
+
+
+    def test_pruneAge(self):
+        """
+        Segments last written longer than the maximum age ago are removed.
+        """
+        self.journal.segmentSize = 1
+        for i in xrange(3):
+            self.journal.append('test', str(i))
+            self.journal.commit()
+
+        path = os.path.join(self.path, self.segments()[0])
+        os.utime(path, (1000, 1000))
+        for name in self.segments()[1:]:
+            path = os.path.join(self.path, name)
+            os.utime(path, (5000, 5000))
+
+        self.journal.maxAge = 3600
+        self.clock.advance(4000)
+
+        self.assertEquals(['0000000000000001.journal',
+                           '0000000000000002.journal'], self.segments())
+
+
+    def test_replay(self):
+        """
+        Records are passed to the handler for their kind.
+        """
+        replayed = []
+        self.journal.handlers['test'] = replayed.append
+        self.journal.append('test', 'one')
+        self.journal.append('other', 'ignored')
+        self.journal.append('test', 'two')
+
+        d = self.journal.replay()
+
+        def cb(count):
+            self.assertEquals(['one', 'two'], replayed)
+            self.assertEquals(2, count)
+        d.addCallback(cb)
+        return d
+
+
+    def test_replayHandlerFails(self):
+        """
+        Records that fail to replay are logged and skipped.
+        """
+        def handler(data):
+            if data == 'bad':
+                raise ValueError(data)
+            replayed.append(data)
+
+        replayed = []
+        self.journal.handlers['test'] = handler
+        self.journal.append('test', 'bad')
+        self.journal.append('test', 'good')
+
+        d = self.journal.replay()
+
+        def cb(count):
+            self.assertEquals(['good'], replayed)
+            self.assertEquals(1, len(self.flushLoggedErrors(ValueError)))
+        d.addCallback(cb)
+        return d
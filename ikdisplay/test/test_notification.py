@@ -0,0 +1,247 @@
+"""
+Tests for L{ikdisplay.notification}.
+"""
+
+from twisted.trial import unittest
+
+from wokkel.generic import parseXml
+
+from ikdisplay import notification
+from ikdisplay.notification import Notification
+
+class NotificationTest(unittest.TestCase):
+    """
+    Tests for L{Notification}.
+    """
+
+    def setUp(self):
+        self.notification = Notification(title=u'Test', subtitle=u'test')
+
+
+    def test_getItem(self):
+        """
+        Fields that have been set can be looked up as keys.
+        """
+        self.assertEqual(u'Test', self.notification['title'])
+        self.assertEqual(u'Test', self.notification.title)
+
+
+    def test_getItemMissing(self):
+        """
+        Fields that have not been set are absent.
+        """
+        self.assertRaises(KeyError, lambda: self.notification['icon'])
+        self.assertNotIn('icon', self.notification)
+        self.assertEqual(u'default', self.notification.get('icon', u'default'))
+
+
+    def test_setItem(self):
+        """
+        Known fields can be set as keys.
+        """
+        self.notification['icon'] = u'http://example.org/icon.png'
+        self.assertEqual(u'http://example.org/icon.png',
+                         self.notification.icon)
+
+
+    def test_setItemUnknown(self):
+        """
+        Unknown fields cannot be set.
+        """
+        def setItem():
+            self.notification['unknown'] = u'value'
+        self.assertRaises(KeyError, setItem)
+        self.assertRaises(AttributeError, setattr, self.notification,
+                          'unknown', u'value')
+
+
+    def test_none(self):
+        """
+        Fields explicitly set to C{None} are present.
+        """
+        self.notification['via'] = None
+        self.assertIn('via', self.notification)
+        self.assertIdentical(None, self.notification.get('via', u'default'))
+
+
+    def test_delItem(self):
+        """
+        Deleted fields are absent.
+        """
+        self.notification['via'] = u'Test'
+        del self.notification['via']
+        self.assertNotIn('via', self.notification)
+        self.assertRaises(KeyError, self.notification.__delitem__, 'via')
+
+
+    def test_items(self):
+        """
+        Items are returned in field order.
+        """
+        self.notification['meta'] = u'Mar 5, 9:07'
+        self.notification['icon'] = u'http://example.org/icon.png'
+        self.assertEqual([('title', u'Test'),
+                          ('subtitle', u'test'),
+                          ('icon', u'http://example.org/icon.png'),
+                          ('meta', u'Mar 5, 9:07')],
+                         self.notification.items())
+        self.assertEqual(4, len(self.notification))
+
+
+    def test_empty(self):
+        """
+        Notifications without fields are false, like empty dicts.
+        """
+        self.assertFalse(Notification())
+        self.assertTrue(self.notification)
+
+
+    def test_equalDict(self):
+        """
+        Notifications compare equal to dicts with the same items.
+        """
+        self.assertEqual({'title': u'Test', 'subtitle': u'test'},
+                         self.notification)
+        self.assertEqual(self.notification,
+                         {'title': u'Test', 'subtitle': u'test'})
+        self.assertNotEqual({'title': u'Test'}, self.notification)
+        self.assertEqual(Notification(self.notification), self.notification)
+
+
+    def test_update(self):
+        """
+        Fields can be updated from dicts and keywords.
+        """
+        self.notification.update({'subtitle': u'other'}, via=u'Test Source')
+        self.assertEqual({'title': u'Test',
+                          'subtitle': u'other',
+                          'via': u'Test Source'},
+                         self.notification.asDict())
+
+
+    def test_copy(self):
+        """
+        Copies can be changed without affecting the original.
+        """
+        copy = self.notification.copy()
+        copy['title'] = u'Copy'
+        self.assertEqual(u'Test', self.notification['title'])
+
+
+    def test_copyItemIdentifier(self):
+        """
+        Copies have the same item identifier, which is not a field.
+        """
+        self.notification.itemIdentifier = u'status-1'
+        copy = self.notification.copy()
+        self.assertEqual(u'status-1', copy.itemIdentifier)
+        self.assertNotIn('itemIdentifier', copy)
+
+
+    def test_slots(self):
+        """
+        Notifications have no instance dictionary.
+        """
+        self.assertFalse(hasattr(self.notification, '__dict__'))
+
+
+    def test_getSerialized(self):
+        """
+        Serialized forms are cached.
+        """
+        calls = []
+        def serializer(notification):
+            calls.append(notification)
+            return u', '.join(notification.values())
+
+        self.assertEqual(u'Test, test',
+                         self.notification.getSerialized(serializer))
+        self.assertEqual(u'Test, test',
+                         self.notification.getSerialized(serializer))
+        self.assertEqual(1, len(calls))
+
+
+    def test_getSerializedChanged(self):
+        """
+        The cached serialized forms are dropped when a field changes.
+        """
+        def serializer(notification):
+            return u', '.join(notification.values())
+
+        self.notification.getSerialized(serializer)
+        self.notification['subtitle'] = u'changed'
+        self.assertEqual(u'Test, changed',
+                         self.notification.getSerialized(serializer))
+
+
+
+class RenderXmlTest(unittest.TestCase):
+    """
+    Tests for L{notification.renderXml} and L{Notification.toXml}.
+    """
+
+    def test_renderXml(self):
+        """
+        Fields are rendered as escaped child elements, in field order.
+        """
+        n = Notification(subtitle=u'A & B <3', title=u'Caf\xe9', via=None)
+        xml = notification.renderXml(n)
+        self.assertEquals(u"<notification xmlns='%s'>"
+                          u"<title>Caf\xe9</title>"
+                          u"<subtitle>A &amp; B &lt;3</subtitle>"
+                          u"<via/>"
+                          u"</notification>" % notification.NS_NOTIFICATION,
+                          xml)
+
+        element = parseXml(xml.encode('utf-8'))
+        self.assertEquals(u'A & B <3', unicode(element.subtitle))
+
+
+    def test_renderXmlDict(self):
+        """
+        Notifications as plain dicts can be rendered too.
+        """
+        xml = notification.notificationToXml({'title': u'Test'})
+        self.assertEquals(u"<notification xmlns='%s'><title>Test</title>"
+                          u"</notification>" % notification.NS_NOTIFICATION,
+                          xml)
+
+
+    def test_toXmlCached(self):
+        """
+        The serialization is cached until the notification changes.
+        """
+        n = Notification(title=u'Test')
+        xml = n.toXml()
+        self.assertIdentical(xml, n.toXml())
+        self.assertIdentical(xml, notification.notificationToXml(n))
+
+        n['subtitle'] = u'test'
+        self.assertIn(u'<subtitle>test</subtitle>', n.toXml())
+
+
+
+class ParseNotificationTest(unittest.TestCase):
+    """
+    Tests for L{notification.parseNotification}.
+    """
+
+    def test_roundTrip(self):
+        """
+        Parsing the XML serialization yields an equal notification.
+        """
+        n = Notification(title=u'Caf\xe9', subtitle=u'A & B', via=None)
+        result = notification.parseNotification(n.toXml().encode('utf-8'))
+        self.assertIsInstance(result, Notification)
+        self.assertEquals(n, result)
+
+
+    def test_unknown(self):
+        """
+        Unknown elements are ignored.
+        """
+        xml = ("<notification xmlns='%s'><title>Test</title>"
+               "<unknown>value</unknown></notification>" %
+               notification.NS_NOTIFICATION)
+        self.assertEquals({'title': u'Test'},
+                          notification.parseNotification(xml))
@@ -0,0 +1,54 @@
+"""
+Tests for L{ikdisplay.ratelimit}.
+"""
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from ikdisplay import ratelimit
+
+class TokenBucketTest(unittest.TestCase):
+    """
+    Tests for L{ratelimit.TokenBucket}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.bucket = ratelimit.TokenBucket(1, 3, self.clock)
+
+
+    def test_consumeBurst(self):
+        """
+        Up to capacity tokens can be taken at once.
+        """
+        results = [self.bucket.consume() for i in xrange(4)]
+        self.assertEqual([True, True, True, False], results)
+
+
+    def test_consumeRefill(self):
+        """
+        The bucket is refilled at the given rate.
+        """
+        for i in xrange(3):
+            self.bucket.consume()
+        self.clock.advance(1)
+        self.assertTrue(self.bucket.consume())
+        self.assertFalse(self.bucket.consume())
+
+
+    def test_consumeRefillCapacity(self):
+        """
+        The bucket is never refilled beyond its capacity.
+        """
+        self.clock.advance(10)
+        results = [self.bucket.consume() for i in xrange(4)]
+        self.assertEqual([True, True, True, False], results)
+
+
+    def test_consumeReserve(self):
+        """
+        Tokens in the reserve can only be taken without a reserve.
+        """
+        self.assertTrue(self.bucket.consume(reserve=2))
+        self.assertFalse(self.bucket.consume(reserve=2))
+        self.assertTrue(self.bucket.consume())
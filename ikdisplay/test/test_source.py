@@ -2,17 +2,25 @@
 Tests for L{ikdisplay.source}.
 """
 
+import time
+
 from zope.interface import verify
 
+from twisted.internet import defer, task
+from twisted.python import failure
 from twisted.trial import unittest
+from twisted.web import client, error
 from twisted.words.xish import domish
 
 from wokkel.generic import parseXml
 from wokkel import pubsub
 
+from axiom import store
+
 from twittytwister.streaming import Entities, Indices, Media, Status, URL, User
 
 from ikdisplay import aggregator, source, xmpp
+from ikdisplay.notification import Notification
 
 class TestPubSubSource(source.PubSubSourceMixin):
     TEXTS_NL = {
@@ -43,6 +51,36 @@ class TestFeed(object):
 
 
 
+class FormatTimeTest(unittest.TestCase):
+    """
+    Tests for L{source.formatTime}.
+    """
+
+    def setUp(self):
+        self.texts = source.SourceMixin.texts
+        self.timeTuple = time.struct_time((2010, 3, 5, 9, 7, 0, 4, 64, 0))
+
+
+    def formatTime(self, language):
+        texts = self.texts[language]
+        return source.formatTime(texts['time_format'], self.timeTuple, texts)
+
+
+    def test_dutch(self):
+        self.assertEquals(u'5 mrt, 9:07', self.formatTime('nl'))
+
+
+    def test_english(self):
+        self.assertEquals(u'Mar 5, 9:07', self.formatTime('en'))
+
+
+    def test_padded(self):
+        result = source.formatTime('%a %d-%Y %H:%M 100%%', self.timeTuple,
+                                   self.texts['en'])
+        self.assertEquals(u'Fri 05-2010 09:07 100%', result)
+
+
+
 class PubSubSourceMixinTest(unittest.TestCase):
 
     def setUp(self):
@@ -68,6 +106,48 @@ class PubSubSourceMixinTest(unittest.TestCase):
         self.assertEquals(1, len(notifications))
 
 
+    def test_getTexts(self):
+        """
+        The texts include those of the base classes, in the feed's language.
+        """
+        texts = self.source.getTexts()
+        self.assertEquals(u'Test Source', texts['via'])
+        self.assertEquals(u'via %s', texts['via_template'])
+
+
+    def test_getTextsLanguageChanged(self):
+        """
+        When the language of the feed changes, so do the texts.
+        """
+        self.source.getTexts()
+        self.feed.language = 'nl'
+        self.assertEquals(u'Test Bron', self.source.getTexts()['via'])
+        self.assertEquals('nl', self.source.getLanguage())
+
+
+    def test_compileTexts(self):
+        """
+        Source classes have their own texts, also when defined later.
+        """
+        self.assertIn('via', TestPubSubSource.texts['en'])
+        self.assertNotIn('via', source.PubSubSourceMixin.texts['en'])
+        self.assertIn('activity_verbs', source.IkCamSource.texts['nl'])
+
+
+    def test_getTime(self):
+        """
+        The time is rendered for the current minute and cached.
+        """
+        self.patch(time, 'time', lambda: 1267780027.5)
+        texts = self.source.texts['en']
+        expected = source.formatTime(texts['time_format'],
+                                     time.localtime(1267780020), texts)
+
+        self.assertEquals(expected, self.source.getTime({}))
+        self.assertIn(('en', texts['time_format'], 21129667),
+                      source._timeCache)
+
+
     def test_formatVia(self):
         notifications = self.source.format(self.event)
         self.assertTrue(notifications[0]['meta'].endswith(u' via Test Source'))
@@ -82,6 +162,46 @@ class PubSubSourceMixinTest(unittest.TestCase):
         self.assertTrue(notifications[0]['meta'].endswith(u' via Other'))
 
 
+    def test_formatOrigin(self):
+        """
+        Notifications have the node and identifier of their item as origin.
+        """
+        self.source.format_payload = lambda payload: Notification(title=u'T')
+        items = [pubsub.Item(u'1', domish.Element((None, 'test'))),
+                 pubsub.Item(payload=domish.Element((None, 'test')))]
+        event = pubsub.ItemsEvent(None, None, 'vote/160225', items, None)
+
+        notifications = self.source.format(event)
+        self.assertEquals([u'vote/160225/1', None],
+                          [n.origin for n in notifications])
+
+
+    def test_receiveItemsBatch(self):
+        """
+        All items of an event are formatted against the same metadata and
+        handed to the feed in one call.
+        """
+        calls = []
+        self.feed.processNotifications = calls.append
+
+        times = []
+        getTime = self.source.getTime
+        def countingGetTime(notification):
+            times.append(notification)
+            return getTime(notification)
+        self.source.getTime = countingGetTime
+
+        items = [pubsub.Item(payload=domish.Element((None, 'test')))
+                 for i in xrange(3)]
+        event = pubsub.ItemsEvent(None, None, 'vote/160225', items, None)
+        self.source.itemsReceived(event)
+
+        self.assertEquals(1, len(calls))
+        self.assertEquals(3, len(calls[0]))
+        self.assertEquals(1, len(times))
+        self.assertEquals(1, len(set([n['meta'] for n in calls[0]])))
+
+
 def formatPayload(src, xml):
     """
     Hook up a newly created source to a feed and call format_payload.
@@ -120,6 +240,197 @@ class GetThingIDTest(unittest.TestCase):
 
 
 
+THING_PAGE = [
+    '<html><head><title>Eurosonic</title>\n',
+    '<link rel="alternate" href="http://example.org/other"/>\n',
+    '<link rel="self" href="http://example.org/id/528"/>\n',
+    '</head><body><h1>Eurosonic &amp; Noorder',
+    'slag &#233;</h1>\n',
+    '<p>Lots of text.</p>\n' * 10,
+    '</body></html>',
+    ]
+
+class FakeBodyTransport(object):
+    stopped = False
+
+    def stopProducing(self):
+        self.stopped = True
+
+
+
+class FakeResponse(object):
+    """
+    Response that delivers its body in chunks, until stopped.
+    """
+
+    def __init__(self, chunks, code=200):
+        self.chunks = chunks
+        self.code = code
+        self.phrase = 'OK'
+        self.finish = True
+        self.delivered = []
+        self.transport = FakeBodyTransport()
+
+
+    def deliverBody(self, protocol):
+        protocol.makeConnection(self.transport)
+        for chunk in self.chunks:
+            if self.transport.stopped:
+                return
+            self.delivered.append(chunk)
+            protocol.dataReceived(chunk)
+        if self.finish and not self.transport.stopped:
+            protocol.connectionLost(failure.Failure(client.ResponseDone()))
+
+
+
+class FakeAgent(object):
+
+    def __init__(self, response=None):
+        self.response = response
+        self.requests = []
+
+
+    def request(self, method, uri):
+        self.requests.append((method, uri))
+        if self.response is None:
+            return defer.Deferred()
+        else:
+            return defer.succeed(self.response)
+
+
+
+class ThingDiscoveryTest(unittest.TestCase):
+    """
+    Tests for L{source.Thing.discoverCreate} and L{source.discoverPage}.
+    """
+
+    def setUp(self):
+        self.store = store.Store()
+        self.clock = task.Clock()
+        self.response = FakeResponse(THING_PAGE)
+        self.agent = FakeAgent(self.response)
+
+
+    def discoverCreate(self, uri='http://example.org/528'):
+        return source.Thing.discoverCreate(self.store, uri, agent=self.agent,
+                                           clock=self.clock)
+
+
+    def test_discoverCreate(self):
+        """
+        The thing gets the first title and the canonical URI of the page.
+        """
+        d = self.discoverCreate()
+
+        def cb(thing):
+            self.assertEquals(u'http://example.org/id/528', thing.uri)
+            self.assertEquals(u'Eurosonic & Noorderslag \xe9', thing.title)
+            self.assertIdentical(self.store, thing.store)
+        d.addCallback(cb)
+        return d
+
+
+    def test_stopEarly(self):
+        """
+        Once both values are found, the rest of the page is not downloaded.
+        """
+        d = self.discoverCreate()
+
+        def cb(thing):
+            self.assertTrue(self.response.transport.stopped)
+            self.assertEquals(THING_PAGE[:5], self.response.delivered)
+            self.assertFalse(self.clock.getDelayedCalls())
+        d.addCallback(cb)
+        return d
+
+
+    def test_maxSize(self):
+        """
+        Pages without the values are only downloaded up to the maximum size.
+        """
+        self.response.chunks = ['<p>%s</p>' % ('x' * 1000)] * 1000
+        d = source.discoverPage('http://example.org/528', agent=self.agent,
+                                maxSize=10000, clock=self.clock)
+
+        def cb(result):
+            self.assertEquals((None, None), result)
+            self.assertTrue(self.response.transport.stopped)
+            self.assertEquals(10, len(self.response.delivered))
+        d.addCallback(cb)
+        return d
+
+
+    def test_defaults(self):
+        """
+        Without title or canonical URI, the defaults are used.
+        """
+        self.response.chunks = ['<html><body><p>Nothing</p></body></html>']
+        d = self.discoverCreate()
+
+        def cb(thing):
+            self.assertEquals(u'http://example.org/528', thing.uri)
+            self.assertEquals(u'?', thing.title)
+        d.addCallback(cb)
+        return d
+
+
+    def test_timeout(self):
+        """
+        Discovery is given up after the timeout.
+        """
+        self.agent.response = None
+        d = self.discoverCreate()
+        self.clock.advance(30)
+        self.assertFailure(d, defer.TimeoutError)
+        return d
+
+
+    def test_timeoutBody(self):
+        """
+        A stalled download is stopped after the timeout.
+        """
+        self.response.chunks = THING_PAGE[:2]
+        self.response.finish = False
+        d = self.discoverCreate()
+        self.clock.advance(30)
+        self.assertTrue(self.response.transport.stopped)
+        self.assertFailure(d, defer.TimeoutError)
+        return d
+
+
+    def test_errorStatus(self):
+        """
+        Error responses are not parsed.
+        """
+        self.response.code = 404
+        d = self.discoverCreate()
+        self.assertFailure(d, error.Error)
+
+        def cb(_):
+            self.assertEquals([], self.response.delivered)
+            self.assertEquals(0, self.store.count(source.Thing))
+        d.addCallback(cb)
+        return d
+
+
+    def test_cached(self):
+        """
+        Discovery results are kept in the store, and reused.
+        """
+        d = self.discoverCreate()
+        d.addCallback(lambda _: self.discoverCreate())
+
+        def cb(thing):
+            self.assertEquals(1, len(self.agent.requests))
+            self.assertEquals(u'http://example.org/id/528', thing.uri)
+            self.assertEquals(u'Eurosonic & Noorderslag \xe9', thing.title)
+            self.assertEquals(2, self.store.count(source.Thing))
+        d.addCallback(cb)
+        return d
+
+
+
 class SimpleSourceTest(unittest.TestCase, PubSubSourceTests):
     """
     Tests for L{ikdisplay.source.SimpleSource}.
@@ -233,6 +544,76 @@ class VoteSourceTest(unittest.TestCase, PubSubSourceTests):
                           notification['subtitle'])
 
 
+    def votePayload(self, answerID, answers):
+        items = ''.join(["""
+      <item>
+        <answer_id>%s</answer_id>
+        <title>%s</title>
+      </item>""" % answer for answer in answers])
+
+        return parseXml("""
+<rsp>
+  <vote>
+    <answer_id_ref>%s</answer_id_ref>
+  </vote>
+  <person>
+    <title>Fred Pook</title>
+    <image/>
+  </person>
+  <question>
+    <id>160225</id>
+    <answers>%s
+    </answers>
+  </question>
+</rsp>""" % (answerID, items))
+
+
+    def test_voteToAnswerCached(self):
+        """
+        The answers are cached while the question's answer set is unchanged.
+        """
+        self.source.activate()
+        answers = [('1', 'Yes'), ('2', 'No')]
+        payload = self.votePayload('2', answers)
+        self.assertEquals(u'No', self.source._voteToAnswer(payload))
+        answerMap = self.source._answers[1]
+
+        payload = self.votePayload('1', answers)
+        self.assertEquals(u'Yes', self.source._voteToAnswer(payload))
+        self.assertIdentical(answerMap, self.source._answers[1])
+
+
+    def test_voteToAnswerChanged(self):
+        """
+        A change in the number of answers refreshes the cached answers.
+        """
+        self.source.activate()
+        payload = self.votePayload('1', [('1', 'Yes')])
+        self.assertEquals(u'Yes', self.source._voteToAnswer(payload))
+
+        payload = self.votePayload('3', [('1', 'Yes'), ('3', 'Maybe')])
+        self.assertEquals(u'Maybe', self.source._voteToAnswer(payload))
+
+
+    def test_voteToAnswerReplaced(self):
+        """
+        An answer replaced by another, keeping the number of answers, is
+        found by refreshing the cached answers.
+        """
+        self.source.activate()
+        payload = self.votePayload('1', [('1', 'Yes'), ('2', 'No')])
+        self.assertEquals(u'Yes', self.source._voteToAnswer(payload))
+
+        payload = self.votePayload('3', [('1', 'Yes'), ('3', 'Maybe')])
+        self.assertEquals(u'Maybe', self.source._voteToAnswer(payload))
+
+
+    def test_voteToAnswerUnknown(self):
+        self.source.activate()
+        payload = self.votePayload('4', [('1', 'Yes')])
+        self.assertIdentical(None, self.source._voteToAnswer(payload))
+
+
 
 class PresenceSourceTest(unittest.TestCase, PubSubSourceTests):
     """
@@ -544,6 +925,35 @@ class TwitterSourceTest(unittest.TestCase):
                               u'stpeter.im/journal/1496.h\u2026</a>',
                           notification['html'])
 
+    def test_formatDisplayURLNoDisplayURL(self):
+        """
+        URL entities without a display URL are left as they are.
+        """
+        self.status.text = u'Links: http://t.co/1 http://t.co/2'
+
+        self.status.entities = Entities()
+        first = URL()
+        first.url = "http://t.co/1"
+        first.display_url = None
+        first.indices = Indices()
+        first.indices.start = 7
+        first.indices.end = 20
+        second = URL()
+        second.url = "http://t.co/2"
+        second.display_url = "example.org/2"
+        second.indices = Indices()
+        second.indices.start = 21
+        second.indices.end = 34
+        self.status.entities.urls = [second, first]
+
+        notification = self.source.format(self.status)
+        self.assertEquals(u'Links: http://t.co/1 example.org/2',
+                          notification['subtitle'])
+        self.assertEquals(u"Links: http://t.co/1 "
+                            u"<a href='http://t.co/2'>example.org/2</a>",
+                          notification['html'])
+
+
     def test_formatMatchPermutation(self):
         """
         Space separated terms match statuses in other permutations.
@@ -609,6 +1019,224 @@ class TwitterSourceTest(unittest.TestCase):
                 notification['uri'])
 
 
+    def test_match(self):
+        """
+        Statuses match if they contain a term.
+        """
+        self.source.terms = ['test']
+        self.assertTrue(self.source.match(self.status))
+        self.source.terms = ['other']
+        self.assertFalse(self.source.match(self.status))
+
+
+    def test_makeBucketNoMaximum(self):
+        """
+        Without a maximum rate, there is no bucket.
+        """
+        self.assertIdentical(None, self.source.makeBucket(task.Clock()))
+
+
+    def test_admitMaxRate(self):
+        """
+        Statuses over the maximum rate are not admitted.
+        """
+        clock = task.Clock()
+        self.source.maxRate = 6
+        bucket = self.source.makeBucket(clock)
+
+        results = [self.source.admit(self.status, bucket) for i in xrange(3)]
+        self.assertEqual([True, True, False], results)
+
+        clock.advance(10)
+        self.assertTrue(self.source.admit(self.status, bucket))
+
+
+    def test_admitSamplingFollowed(self):
+        """
+        Statuses from followed users can use the reserved capacity.
+        """
+        self.source.maxRate = 6
+        self.source.sampling = u'followed'
+        self.source.userIDs = ['2426271']
+        bucket = self.source.makeBucket(task.Clock())
+
+        other = Status()
+        other.id = 2
+        other.text = u'Test'
+        other.user = User()
+        other.user.id = 1
+        other.user.screen_name = u'other'
+
+        results = [self.source.admit(other, bucket),
+                   self.source.admit(other, bucket),
+                   self.source.admit(self.status, bucket)]
+        self.assertEqual([True, False, True], results)
+
+
+    def test_admitSamplingPictures(self):
+        """
+        Statuses with pictures can use the reserved capacity.
+        """
+        self.source.maxRate = 6
+        self.source.sampling = u'pictures'
+        bucket = self.source.makeBucket(task.Clock())
+
+        picture = Status()
+        picture.id = 2
+        picture.text = u'Test'
+        picture.user = self.status.user
+        picture.entities = Entities()
+        picture.entities.media = [Media()]
+
+        results = [self.source.admit(self.status, bucket),
+                   self.source.admit(self.status, bucket),
+                   self.source.admit(picture, bucket)]
+        self.assertEqual([True, False, True], results)
+
+
+    def test_formatItemIdentifier(self):
+        """
+        Notifications are published as an item named after the status.
+        """
+        notification = self.source.format(self.status)
+        self.assertEqual(u'status-1', notification.itemIdentifier)
+
+
+    def test_formatPriority(self):
+        """
+        Notifications have the priority of the source.
+        """
+        notification = self.source.format(self.status)
+        self.assertEqual(-1, notification.priority)
+
+
+    def collectNotifications(self):
+        calls = []
+        self.patch(aggregator.Feed, 'processNotifications',
+                   lambda feed, notifications: calls.append(notifications))
+        return calls
+
+
+    def retweet(self, id):
+        status = Status()
+        status.id = id
+        status.text = u'RT @ralphm: Test'
+        status.user = User()
+        status.user.id = id
+        status.user.screen_name = u'user%d' % id
+        status.user.profile_image_url = self.status.user.profile_image_url
+        status.retweeted_status = self.status
+        return status
+
+
+    def test_onEntryRetweets(self):
+        """
+        Retweets update the notification of the original status with the
+        number of retweets, at most once every update interval.
+        """
+        clock = task.Clock()
+        retweets = self.source.makeRetweetCollapser(clock)
+        calls = self.collectNotifications()
+
+        for id in xrange(2, 5):
+            self.source.onEntry(self.retweet(id), retweets)
+
+        self.assertEqual(1, len(calls))
+        notification = calls[0][0]
+        self.assertEqual(u'ralphm', notification['title'])
+        self.assertEqual(u'Test', notification['subtitle'])
+        self.assertEqual(u'1', notification['retweets'])
+        self.assertEqual(u'status-1', notification.itemIdentifier)
+
+        clock.advance(retweets.updateInterval)
+        self.assertEqual(2, len(calls))
+        notification = calls[1][0]
+        self.assertEqual(u'3', notification['retweets'])
+        self.assertEqual(u'status-1', notification.itemIdentifier)
+
+        clock.advance(retweets.updateInterval)
+        self.assertEqual(2, len(calls))
+
+
+    def test_onEntryRetweetsPicture(self):
+        """
+        The picture embedded for the first retweet is kept in updates.
+        """
+        clock = task.Clock()
+        retweets = self.source.makeRetweetCollapser(clock)
+        calls = self.collectNotifications()
+
+        retweet = self.retweet(2)
+        retweet.image_url = u'http://example.org/image.jpg'
+        self.source.onEntry(retweet, retweets)
+        self.status.image_url = None
+        self.source.onEntry(self.retweet(3), retweets)
+        clock.advance(retweets.updateInterval)
+
+        self.assertEqual([u'http://example.org/image.jpg'] * 2,
+                         [notifications[0]['picture']
+                          for notifications in calls])
+        self.assertEqual(u'2', calls[1][0]['retweets'])
+
+
+    def test_onEntryRetweetsWindow(self):
+        """
+        Counting retweets starts over after the window.
+        """
+        clock = task.Clock()
+        retweets = self.source.makeRetweetCollapser(clock)
+        calls = self.collectNotifications()
+
+        self.source.onEntry(self.retweet(2), retweets)
+        clock.advance(retweets.window + 1)
+        self.source.onEntry(self.retweet(3), retweets)
+
+        self.assertEqual([u'1', u'1'],
+                         [notifications[0]['retweets']
+                          for notifications in calls])
+
+
+    def test_onEntryRetweetsNotCollapsed(self):
+        """
+        Without collapsing, retweets are passed on as they are.
+        """
+        calls = self.collectNotifications()
+
+        self.source.onEntry(self.retweet(2))
+        notification = calls[0][0]
+        self.assertEqual(u'user2', notification['title'])
+        self.assertEqual(u'RT @ralphm: Test', notification['subtitle'])
+        self.assertNotIn('retweets', notification)
+        self.assertEqual(u'status-2', notification.itemIdentifier)
+
+
+    def test_makeRetweetCollapserNotCollapsed(self):
+        """
+        Without collapsing, no collapser is made.
+        """
+        self.patch(source.TwitterSource, 'collapseRetweets', False)
+        self.assertIdentical(None, self.source.makeRetweetCollapser())
+
+
+
+class ImplodeNamesTest(unittest.TestCase):
+    """
+    Tests for L{source.implodeNames}.
+    """
+
+    def test_one(self):
+        self.assertEquals(u'a', source.implodeNames([u'a'], 'en'))
+
+
+    def test_two(self):
+        self.assertEquals(u'a en b', source.implodeNames([u'a', u'b'], 'nl'))
+
+
+    def test_many(self):
+        self.assertEquals(u'a, b, c and d',
+                          source.implodeNames((u'a', u'b', u'c', u'd'), 'en'))
+
+
 
 class IkCamSourceTest(unittest.TestCase, PubSubSourceTests):
     """
@@ -685,6 +1313,31 @@ class IkCamSourceTest(unittest.TestCase, PubSubSourceTests):
         self.assertEquals(u'http://ixion.local/figure/613?width=480', notification['picture'])
 
 
+    def test_formatPayloadManyAuthors(self):
+        """
+        Group portraits with many authors list them all.
+        """
+        authors = ''.join(["""
+  <author>
+    <name>Person %d</name>
+  </author>""" % i for i in xrange(300)])
+        xml = """
+<entry xmlns="http://www.w3.org/2005/Atom">
+  <verb xmlns="http://activitystrea.ms/spec/1.0/">http://mediamatic.nl/ns/anymeta/2010/activitystreams/ikcam</verb>
+  <object xmlns="http://activitystrea.ms/spec/1.0/">
+    <id xmlns="http://www.w3.org/2005/Atom">http://ixion.local/id/613</id>
+  </object>%s
+</entry>""" % authors
+
+        notification = formatPayload(self.source, xml)
+        self.assertTrue(notification['title'].startswith(
+            u'Person 0, Person 1, Person 2, '))
+        self.assertTrue(notification['title'].endswith(
+            u', Person 298 and Person 299'))
+        self.assertEquals(299, len(notification['title'].split(u', ')))
+        self.assertEquals(u'took a group portrait', notification['subtitle'])
+
+
     def test_formatPayloadMultiple(self):
         xml = """
 <entry xmlns="http://www.w3.org/2005/Atom">
@@ -758,6 +1411,145 @@ class RaceSourceTest(unittest.TestCase, PubSubSourceTests):
 
 
 
+ACTIVITY_LIKE = """
+<entry xmlns="http://www.w3.org/2005/Atom">
+  <id>http://dwaal.local/activity/80/16</id>
+  <verb xmlns="http://activitystrea.ms/spec/1.0/">http://activitystrea.ms/schema/1.0/like</verb>
+  <object xmlns="http://activitystrea.ms/spec/1.0/">
+    <id xmlns="http://www.w3.org/2005/Atom">http://dwaal.local/id/99</id>
+    <title xmlns="http://www.w3.org/2005/Atom">Test artikel</title>
+    <object-type>http://mediamatic.nl/ns/anymeta/2008/kind/attachment</object-type>
+    <link xmlns="http://www.w3.org/2005/Atom" rel="figure" href="http://dwaal.local/figure/99"/>
+  </object>
+  <target xmlns="http://activitystrea.ms/spec/1.0/">
+    <id xmlns="http://www.w3.org/2005/Atom">http://dwaal.local/id/83</id>
+    <title xmlns="http://www.w3.org/2005/Atom">Test evenement</title>
+  </target>
+  <agent xmlns="http://activitystrea.ms/spec/1.0/">
+    <id xmlns="http://www.w3.org/2005/Atom">http://dwaal.local/id/1</id>
+  </agent>
+  <author>
+    <name>Ralph Meijer</name>
+    <link rel="figure" href="http://dwaal.local/figure/80"/>
+  </author>
+  <author>
+    <name>Birgit Meijer</name>
+  </author>
+</entry>"""
+
+class ParseActivityTest(unittest.TestCase):
+    """
+    Tests for L{source.parseActivity}.
+    """
+
+    def test_parse(self):
+        record = source.parseActivity(parseXml(ACTIVITY_LIKE))
+        self.assertEquals(frozenset([source.NS_ACTIVITY_SCHEMA + 'like']),
+                          record.verbs)
+        self.assertEquals(u'Ralph Meijer', record.actorName)
+        self.assertEquals((u'Ralph Meijer', u'Birgit Meijer'),
+                          record.actorNames)
+        self.assertEquals(u'http://dwaal.local/figure/80', record.actorFigure)
+        self.assertEquals(frozenset([source.TYPE_ATTACHMENT]),
+                          record.objectTypes)
+        self.assertEquals(u'Test artikel', record.objectTitle)
+        self.assertEquals(u'http://dwaal.local/figure/99',
+                          record.objectFigure)
+        self.assertIdentical(None, record.objectMessage)
+        self.assertEquals(u'http://dwaal.local/id/83', record.targetID)
+        self.assertEquals(u'Test evenement', record.targetTitle)
+        self.assertEquals(u'http://dwaal.local/id/1', record.agentID)
+
+
+    def test_parseMinimal(self):
+        record = source.parseActivity(parseXml("""
+<entry xmlns="http://www.w3.org/2005/Atom">
+  <verb xmlns="http://activitystrea.ms/spec/1.0/">http://activitystrea.ms/schema/1.0/post</verb>
+</entry>"""))
+        self.assertIdentical(None, record.actorName)
+        self.assertEquals((), record.actorNames)
+        self.assertIdentical(None, record.objectTitle)
+        self.assertIdentical(None, record.targetID)
+        self.assertIdentical(None, record.agentID)
+
+
+    def test_formatRecordVerbRank(self):
+        """
+        The first of the supported verbs determines the rendering.
+        """
+        site = source.Site(uri=u'http://dwaal.local/', title=u'Dwaal')
+        src = source.ActivityStreamSource(site=site)
+        src.activate()
+        src.feed = aggregator.Feed(handle=u'mediamatic', language=u'en')
+
+        record = source.ActivityRecord(
+                verbs=frozenset([source.NS_ACTIVITY_SCHEMA + 'like',
+                                 source.NS_ACTIVITY_SCHEMA + 'post']),
+                actorName=u'Ralph Meijer',
+                objectTitle=u'Test artikel')
+        notification = src.format_record(record)
+        self.assertEquals(u'posted Test artikel', notification['subtitle'])
+
+        record.verbs |= frozenset([source.NS_ANYMETA_ACTIVITY +
+                                   'status-update'])
+        self.assertIdentical(None, src.format_record(record))
+
+
+    def test_getRoutingFilter(self):
+        """
+        Activity Streams sources route on their supported verbs.
+        """
+        src = source.ActivityStreamSource()
+        self.assertEquals({'verbs': src.supportedVerbs},
+                          src.getRoutingFilter())
+
+
+    def test_getRoutingFilterWoW(self):
+        """
+        The WoW source also routes on its agent.
+        """
+        agent = source.Thing(uri=u'http://dwaal.local/id/1')
+        src = source.WoWSource(agent=agent)
+        self.assertEquals([u'http://dwaal.local/id/1'],
+                          src.getRoutingFilter()['agentID'])
+
+
+    def test_getRoutingFilterIkCam(self):
+        """
+        The ikCam source routes on its verb, creator and event.
+        """
+        creator = source.Thing(uri=u'http://dwaal.local/id/1')
+        src = source.IkCamSource(creator=creator)
+        routingFilter = src.getRoutingFilter()
+        self.assertEquals([src.ikCamVerb], routingFilter['verbs'])
+        self.assertEquals([None, u'http://dwaal.local/id/1'],
+                          routingFilter['agentID'])
+        self.assertNotIn('targetID', routingFilter)
+
+
+    def test_formatRecords(self):
+        """
+        Sources render the records passed along with the event.
+        """
+        site = source.Site(uri=u'http://dwaal.local/', title=u'Dwaal')
+        src = source.ActivityStreamSource(site=site)
+        src.activate()
+        src.feed = aggregator.Feed(handle=u'mediamatic', language=u'en')
+
+        payload = parseXml(ACTIVITY_LIKE)
+        event = pubsub.ItemsEvent(None, None, 'activity',
+                                  [pubsub.Item(payload=payload)], None)
+        records = [source.parseActivity(payload)]
+
+        notifications = src.format(event, records)
+        self.assertEquals(1, len(notifications))
+        self.assertEquals(u'liked Test artikel',
+                          notifications[0]['subtitle'])
+        self.assertEquals(u'http://dwaal.local/figure/99?width=480',
+                          notifications[0]['picture'])
+
+
+
 class ActivityStreamSourceTest(unittest.TestCase, PubSubSourceTests):
     """
     Tests for L{ikdisplay.source.ActivityStreamSource}.
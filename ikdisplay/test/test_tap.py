@@ -0,0 +1,89 @@
+"""
+Tests for L{ikdisplay.tap}.
+"""
+
+from twisted.internet import task
+from twisted.python import usage
+from twisted.trial import unittest
+
+from ikdisplay import archive, tap
+from ikdisplay.notification import Notification
+
+class OptionsTest(unittest.TestCase):
+    """
+    Tests for L{tap.Options}.
+    """
+
+    def setUp(self):
+        self.options = tap.Options()
+        self.args = ['--jid', 'aggregator@example.org',
+                     '--secret', 'secret',
+                     '--service', 'pubsub.example.org',
+                     '--twitter-user', 'test',
+                     '--twitter-password', 'test']
+
+
+    def test_twitterStreams(self):
+        """
+        The filter can be partitioned over several Twitter streams.
+        """
+        self.options.parseOptions(self.args + ['--twitter-streams', '2'])
+        self.assertEqual(2, self.options['twitter-streams'])
+
+
+    def test_twitterStreamsNone(self):
+        """
+        At least one Twitter stream is needed.
+        """
+        self.assertRaises(usage.UsageError, self.options.parseOptions,
+                          self.args + ['--twitter-streams', '0'])
+
+
+    def test_twitterStatusStall(self):
+        """
+        Status stall detection is off unless asked for.
+        """
+        self.options.parseOptions(self.args)
+        self.assertFalse(self.options['twitter-status-stall'])
+        self.options = tap.Options()
+        self.options.parseOptions(self.args + ['--twitter-status-stall'])
+        self.assertTrue(self.options['twitter-status-stall'])
+
+
+
+class MakeServiceTest(unittest.TestCase):
+    """
+    Tests for L{tap.makeService}.
+    """
+
+    def setUp(self):
+        self.options = tap.Options()
+        self.args = ['--jid', 'aggregator@example.org',
+                     '--secret', 'secret',
+                     '--service', 'pubsub.example.org',
+                     '--twitter-user', 'test',
+                     '--twitter-password', 'test',
+                     '--dbdir', self.mktemp()]
+
+
+    def test_historyRestored(self):
+        """
+        At startup, the history of each feed is restored from the archive.
+        """
+        path = self.mktemp()
+        notificationArchive = archive.NotificationArchive(path, task.Clock())
+        notificationArchive.addNotifications(u'test',
+                                             [Notification(title=u'First'),
+                                              Notification(title=u'Second')])
+        notificationArchive.stopService()
+
+        self.options.parseOptions(self.args + ['--archive-dir', path])
+        history = tap.makeService(self.options).getServiceNamed('history')
+        history.startService()
+        self.addCleanup(history.stopService)
+
+        d = history.getHistory(u'test')
+        d.addCallback(lambda notifications: [notification['title']
+                                             for notification in notifications])
+        d.addCallback(self.assertEqual, [u'First', u'Second'])
+        return d
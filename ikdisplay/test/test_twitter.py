@@ -2,15 +2,19 @@
 Tests for L{ikdisplay.twitter}.
 """
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.trial import unittest
+from twisted.words.protocols.jabber import error
+from twisted.words.xish import domish
+
+from wokkel import pubsub
 
 from axiom.store import Store
 
-from twittytwister.streaming import Status, Entities, Media, URL
+from twittytwister.streaming import Entities, Indices, Media, Status, URL, User
 
 from ikdisplay.source import TwitterSource
-from ikdisplay import twitter
+from ikdisplay import aggregator, twitter
 
 class FakeMonitor(object):
     """
@@ -27,6 +31,40 @@ class FakeMonitor(object):
 
 
 
+class FakeEmbedder(object):
+    """
+    Fake Embedder that collects the statuses to augment.
+
+    Unless L{deliver} is set, the returned deferreds never fire, so that
+    statuses are not delivered.
+    """
+    deliver = False
+
+    def __init__(self):
+        self.entries = []
+
+    def augmentStatusWithImage(self, entry):
+        self.entries.append(entry)
+        if self.deliver:
+            return defer.succeed(entry)
+        else:
+            return defer.Deferred()
+
+
+
+class FakeJournal(object):
+    """
+    Fake Journal that collects appended records.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def append(self, kind, data):
+        self.records.append((kind, data))
+
+
+
 class TwitterDispatcherTest(unittest.TestCase):
     """
     Tests for L{ikdisplay.twitter.TwitterDispatcher}.
@@ -35,8 +73,8 @@ class TwitterDispatcherTest(unittest.TestCase):
     def setUp(self):
         self.monitor = FakeMonitor()
         self.store = Store()
-        self.dispatcher = twitter.TwitterDispatcher(self.store, self.monitor,
-                                                    None)
+        self.dispatcher = twitter.TwitterDispatcher(self.store,
+                                                    [self.monitor], None)
 
 
     def test_initSetFilters(self):
@@ -47,8 +85,8 @@ class TwitterDispatcherTest(unittest.TestCase):
         source.enabled = True
         source.terms = ['ikdisplay']
         source.userIDs = ['2426271']
-        self.dispatcher = twitter.TwitterDispatcher(self.store, self.monitor,
-                                                    None)
+        self.dispatcher = twitter.TwitterDispatcher(self.store,
+                                                    [self.monitor], None)
         self.assertEqual(self.dispatcher.onEntry, self.monitor.delegate)
         self.assertEqual([], self.monitor.connects)
 
@@ -126,6 +164,628 @@ class TwitterDispatcherTest(unittest.TestCase):
         self.assertEqual([], self.monitor.connects)
 
 
+    def _makeStatus(self):
+        user = User()
+        user.id = 2426271
+        user.screen_name = u'ralphm'
+        status = Status()
+        status.id = 1
+        status.user = user
+        status.text = u'Test'
+        return status
+
+
+    def test_onEntryDuplicate(self):
+        """
+        Statuses received over multiple connections are delivered once.
+        """
+        TwitterSource(store=self.store, enabled=True, terms=[], userIDs=[])
+        embedder = FakeEmbedder()
+        self.dispatcher.embedder = embedder
+        status = self._makeStatus()
+
+        self.dispatcher.onEntry(status)
+        self.dispatcher.onEntry(status)
+
+        self.assertEqual([1], [entry.id for entry in embedder.entries])
+
+
+    def test_onEntryJournal(self):
+        """
+        The datagrams of statuses are journaled once, after dropping
+        duplicates.
+        """
+        journal = FakeJournal()
+        self.dispatcher.journal = journal
+        self.dispatcher.embedder = FakeEmbedder()
+        status = self._makeStatus()
+        status.datagram = '{"id": 1, "text": "Test"}'
+
+        self.dispatcher.onEntry(status)
+        self.dispatcher.onEntry(status)
+
+        self.assertEqual([(twitter.JOURNAL_TWITTER, status.datagram)],
+                         journal.records)
+
+
+    def test_onEntryJournalReplayed(self):
+        """
+        Replayed statuses, without a datagram, are not journaled again.
+        """
+        journal = FakeJournal()
+        self.dispatcher.journal = journal
+        self.dispatcher.embedder = FakeEmbedder()
+
+        self.dispatcher.onEntry(self._makeStatus())
+
+        self.assertEqual([], journal.records)
+
+
+    def test_onEntryCompact(self):
+        """
+        Received statuses are passed on as compact statuses.
+        """
+        TwitterSource(store=self.store, enabled=True, terms=[], userIDs=[])
+        embedder = FakeEmbedder()
+        self.dispatcher.embedder = embedder
+        status = self._makeStatus()
+
+        self.dispatcher.onEntry(status)
+
+        self.assertIsInstance(embedder.entries[0], twitter.CompactStatus)
+
+
+    def test_onEntryNotAccepted(self):
+        """
+        Statuses not accepted by any source are not embedded.
+        """
+        TwitterSource(store=self.store, enabled=True, terms=[u'other'],
+                      userIDs=[])
+        embedder = FakeEmbedder()
+        self.dispatcher.embedder = embedder
+
+        self.dispatcher.onEntry(self._makeStatus())
+
+        self.assertEqual([], embedder.entries)
+
+
+    def test_onEntryOverRate(self):
+        """
+        Statuses over the maximum rate of all sources are not embedded.
+        """
+        TwitterSource(store=self.store, enabled=True, terms=[], userIDs=[],
+                      maxRate=6)
+        embedder = FakeEmbedder()
+        self.dispatcher.embedder = embedder
+
+        for statusID in xrange(1, 4):
+            status = self._makeStatus()
+            status.id = statusID
+            self.dispatcher.onEntry(status)
+
+        self.assertEqual([1, 2], [entry.id for entry in embedder.entries])
+
+
+    def test_onEntryOverRateDropped(self):
+        """
+        Statuses over the maximum rate are counted per source, and the rate
+        state is kept by the dispatcher until the maximum rate changes.
+        """
+        source = TwitterSource(store=self.store, enabled=True, terms=[],
+                               userIDs=[], maxRate=6)
+        self.dispatcher.embedder = FakeEmbedder()
+
+        for statusID in xrange(1, 4):
+            status = self._makeStatus()
+            status.id = statusID
+            self.dispatcher.onEntry(status)
+
+        self.assertEqual({source.storeID: 1}, self.dispatcher.dropped)
+
+        source.maxRate = 12
+        status = self._makeStatus()
+        status.id = 4
+        self.dispatcher.onEntry(status)
+        self.assertEqual(4, self.dispatcher.embedder.entries[-1].id)
+
+
+    def test_onEntryRetweets(self):
+        """
+        Retweet counts are kept by the dispatcher, per source, so that they
+        do not depend on the source item staying loaded.
+        """
+        notifications = []
+        self.patch(aggregator.Feed, 'processNotifications',
+                   lambda feed, batch: notifications.extend(batch))
+        feed = aggregator.Feed(store=self.store, handle=u'test',
+                               language=u'en')
+        source = TwitterSource(store=self.store, enabled=True, terms=[],
+                               userIDs=[], feed=feed)
+        clock = task.Clock()
+        self.dispatcher.clock = clock
+        self.dispatcher.embedder = FakeEmbedder()
+        self.dispatcher.embedder.deliver = True
+        original = self._makeStatus()
+
+        for statusID in xrange(2, 5):
+            status = self._makeStatus()
+            status.id = statusID
+            status.retweeted_status = original
+            self.dispatcher.onEntry(status)
+            source.activate()
+
+        collapser = self.dispatcher._collapsers[source.storeID]
+        clock.advance(collapser.updateInterval)
+
+        self.assertEqual([u'1', u'3'],
+                         [notification['retweets']
+                          for notification in notifications])
+
+
+
+class TwitterDispatcherPartitionTest(unittest.TestCase):
+    """
+    Tests for partitioning filters in L{ikdisplay.twitter.TwitterDispatcher}.
+    """
+
+    def setUp(self):
+        self.monitors = [FakeMonitor(), FakeMonitor(), FakeMonitor()]
+        self.store = Store()
+        self.source = TwitterSource(store=self.store)
+        self.source.enabled = True
+        self.source.terms = [u'term%d' % i for i in xrange(20)]
+        self.source.userIDs = [u'%d' % i for i in xrange(20)]
+        self.dispatcher = twitter.TwitterDispatcher(self.store, self.monitors,
+                                                    None)
+
+
+    def test_setFiltersPartitioned(self):
+        """
+        Each term and user ID is assigned to exactly one monitor.
+        """
+        terms = []
+        userIDs = []
+        for monitor in self.monitors:
+            terms.extend(monitor.args['track'].split(','))
+            userIDs.extend(monitor.args['follow'].split(','))
+            self.assertEqual(self.dispatcher.onEntry, monitor.delegate)
+
+        self.assertEqual(sorted(self.source.terms), sorted(terms))
+        self.assertEqual(sorted(self.source.userIDs), sorted(userIDs))
+
+
+    def test_setFiltersStable(self):
+        """
+        The assignment of terms does not depend on the other terms.
+        """
+        partition = self.dispatcher._getPartition(u'term0')
+        self.source.terms = [u'term0']
+        self.dispatcher.setFilters()
+        self.assertEqual(u'term0', self.monitors[partition].args['track'])
+
+
+    def test_refreshFiltersOnlyAffected(self):
+        """
+        Only the monitor a new term is assigned to reconnects.
+        """
+        partition = self.dispatcher._getPartition(u'new')
+        self.source.terms = self.source.terms + [u'new']
+        self.dispatcher.refreshFilters()
+
+        for index, monitor in enumerate(self.monitors):
+            if index == partition:
+                self.assertEqual([True], monitor.connects)
+            else:
+                self.assertEqual([], monitor.connects)
+
+
+
+class StreamTimerTest(unittest.TestCase):
+    """
+    Tests for L{twitter.StreamTimer}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.timer = twitter.StreamTimer(self.clock)
+
+
+    def keepAlive(self):
+        self.timer.dataReceived()
+        self.timer.keepAliveReceived()
+
+
+    def test_checkStallNoData(self):
+        """
+        Without any data for three keep-alive intervals, the stream stalled.
+        """
+        self.clock.advance(90)
+        self.assertIdentical(None, self.timer.checkStall())
+        self.clock.advance(1)
+        self.assertEqual("no data for 91 seconds", self.timer.checkStall())
+
+
+    def test_checkStallKeepAlive(self):
+        """
+        Keep-alives prevent a stall.
+        """
+        for i in xrange(10):
+            self.clock.advance(30)
+            self.keepAlive()
+            self.assertIdentical(None, self.timer.checkStall())
+
+
+    def test_checkStallAdaptive(self):
+        """
+        The data timeout follows the keep-alive interval, with a minimum.
+        """
+        for i in xrange(20):
+            self.clock.advance(5)
+            self.keepAlive()
+
+        self.assertEqual(self.timer.minDataTimeout,
+                         self.timer.getDataTimeout())
+        self.clock.advance(46)
+        self.assertEqual("no data for 46 seconds", self.timer.checkStall())
+
+
+    def test_checkStallStatuses(self):
+        """
+        If enabled, a stream that stops delivering statuses stalls, despite
+        keep-alives.
+        """
+        self.timer.checkStatuses = True
+        for i in xrange(10):
+            self.clock.advance(1)
+            self.timer.dataReceived()
+            self.timer.statusReceived()
+
+        for i in xrange(10):
+            self.clock.advance(30)
+            self.keepAlive()
+        self.assertIdentical(None, self.timer.checkStall())
+
+        self.clock.advance(1)
+        self.assertEqual("no statuses for 301 seconds",
+                         self.timer.checkStall())
+
+
+    def test_checkStallStatusesDisabled(self):
+        """
+        By default, a stream that only sends keep-alives does not stall.
+        """
+        for i in xrange(10):
+            self.clock.advance(1)
+            self.timer.dataReceived()
+            self.timer.statusReceived()
+
+        for i in xrange(20):
+            self.clock.advance(30)
+            self.keepAlive()
+        self.assertIdentical(None, self.timer.checkStall())
+
+
+    def test_getMetrics(self):
+        """
+        The metrics show the time since the last data, status and keep-alive.
+        """
+        self.clock.advance(10)
+        self.timer.dataReceived()
+        self.timer.statusReceived()
+        self.clock.advance(5)
+        self.keepAlive()
+        self.clock.advance(2)
+
+        metrics = self.timer.getMetrics()
+        self.assertEqual(17, metrics['connected'])
+        self.assertEqual(2, metrics['sinceData'])
+        self.assertEqual(7, metrics['sinceStatus'])
+        self.assertEqual(2, metrics['sinceKeepAlive'])
+        self.assertIdentical(None, metrics['statusTimeout'])
+
+
+
+class VerboseTwitterStreamTest(unittest.TestCase):
+    """
+    Tests for L{twitter.VerboseTwitterStream}.
+    """
+
+    def setUp(self):
+        self.statuses = []
+        self.protocol = twitter.VerboseTwitterStream(self.statuses.append)
+        self.protocol.clock = task.Clock()
+        self.protocol.connectionMade()
+        self.addCleanup(self.protocol.connectionLost, None)
+
+
+    def test_datagramReceivedNotStatus(self):
+        """
+        Datagrams that are not statuses do not count as statuses.
+        """
+        self.protocol.datagramReceived('{"delete": {"status": {"id": 1}}}')
+        self.protocol.datagramReceived('{"limit": {"track": 10}}')
+        self.protocol.datagramReceived('invalid')
+
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+        self.assertEqual([], self.statuses)
+        self.assertIdentical(None, self.protocol.timer.lastStatus)
+
+
+
+class PropertyToDomishTest(unittest.TestCase):
+    """
+    Tests for L{twitter.propertyToDomish}.
+    """
+
+    def test_status(self):
+        """
+        Set properties are rendered as children, nested ones recursively.
+        """
+        status = Status()
+        status.id = u'1'
+        status.text = u'Hello <world>'
+        status.user = User()
+        status.user.screen_name = u'ikdisplay'
+
+        element = twitter.propertyToDomish(status)
+        self.assertEqual(twitter.NS_TWITTER, element.uri)
+        self.assertEqual(u'1', unicode(element.id))
+        self.assertEqual(u'Hello <world>', unicode(element.text))
+        self.assertEqual(twitter.NS_TWITTER, element.user.uri)
+        self.assertEqual(u'ikdisplay', unicode(element.user.screen_name))
+
+
+    def test_empty(self):
+        """
+        Empty properties are rendered as empty elements.
+        """
+        status = Status()
+        status.id = u'1'
+        status.text = u''
+
+        element = twitter.propertyToDomish(status)
+        self.assertEqual([], element.text.children)
+
+
+    def test_cached(self):
+        """
+        The serializer for a property class is reused.
+        """
+        status = Status()
+        status.id = u'1'
+
+        twitter.propertyToDomish(status)
+        serialize = twitter._serializers[Status]
+        twitter.propertyToDomish(status)
+        self.assertIdentical(serialize, twitter._serializers[Status])
+
+
+
+class TwitterPubSubClientTest(unittest.TestCase):
+    """
+    Tests for L{twitter.TwitterPubSubClient}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.publishes = []
+        self.items = []
+        self.client = twitter.TwitterPubSubClient(None, 'twitter')
+        self.client.clock = self.clock
+        self.client.publish = self.publish
+        self.client.batchSize = 2
+        self.client.maxInFlight = 2
+        self.client._initialized = True
+
+
+    def publish(self, service, nodeIdentifier, items):
+        d = defer.Deferred()
+        self.publishes.append((d, [item['id'] for item in items]))
+        self.items.extend(items)
+        return d
+
+
+    def onEntries(self, ids):
+        for id in ids:
+            status = Status()
+            status.id = id
+            status.text = u'Status %s' % id
+            self.client.onEntry(status)
+
+
+    def test_onEntryBatches(self):
+        """
+        Items are published in batches, with a limited number in flight.
+        """
+        self.onEntries(['1', '2', '3', '4', '5'])
+        self.assertEqual([['1'], ['2']],
+                         [ids for d, ids in self.publishes])
+        self.assertEqual(2, self.client.inFlight)
+
+        self.publishes[0][0].callback(None)
+        self.assertEqual([['1'], ['2'], ['3', '4']],
+                         [ids for d, ids in self.publishes])
+
+
+    def test_retryOrder(self):
+        """
+        Failed batches are retried in order, before newer items.
+        """
+        self.onEntries(['1', '2', '3'])
+        self.publishes[1][0].errback(Exception())
+        self.onEntries(['4'])
+        self.publishes[0][0].errback(Exception())
+        self.assertEqual(2, len(self.flushLoggedErrors(Exception)))
+        self.assertEqual(2, len(self.publishes))
+
+        self.clock.advance(self.client.retryDelay)
+        self.assertEqual([['1', '2'], ['3', '4']],
+                         [ids for d, ids in self.publishes[2:]])
+
+
+    def test_maxQueueDrop(self):
+        """
+        Without a spool file, the oldest items are dropped when full.
+        """
+        self.client.maxQueue = 2
+        self.onEntries(['1', '2', '3', '4', '5', '6', '7', '8'])
+        self.assertEqual(4, self.client.dropped)
+        self.assertEqual(['7', '8'],
+                         [item['id'] for item in self.client.queue])
+
+
+    def test_maxQueueSpool(self):
+        """
+        With a spool file, items over the maximum are read back in order.
+        """
+        self.client.spoolPath = self.mktemp()
+        self.client.maxQueue = 2
+        self.onEntries(['1', '2', '3', '4', '5', '6', '7', '8'])
+        self.assertEqual(4, self.client.spooled)
+        self.assertEqual(0, self.client.dropped)
+
+        published = []
+        while self.publishes:
+            d, ids = self.publishes.pop(0)
+            published.extend(ids)
+            d.callback(None)
+
+        self.assertEqual(['1', '2', '3', '4', '5', '6', '7', '8'], published)
+        self.assertEqual(0, self.client.spooled)
+
+
+    def test_maxQueueSpoolNamespace(self):
+        """
+        Items read back from the spool file are published as the items they
+        were, in the publish-subscribe namespace.
+        """
+        self.client.spoolPath = self.mktemp()
+        self.client.maxQueue = 2
+        self.onEntries(['1', '2', '3', '4', '5'])
+        while self.publishes:
+            self.publishes.pop(0)[0].callback(None)
+
+        rendered = []
+        for item in self.items:
+            element = domish.Element((pubsub.NS_PUBSUB, 'publish'))
+            element.addChild(item)
+            rendered.append(element.toXml())
+
+        expected = []
+        for id in ['1', '2', '3', '4', '5']:
+            status = Status()
+            status.id = id
+            status.text = u'Status %s' % id
+            element = domish.Element((pubsub.NS_PUBSUB, 'publish'))
+            element.addChild(pubsub.Item(id, twitter.propertyToDomish(status)))
+            expected.append(element.toXml())
+
+        self.assertEqual(expected, rendered)
+
+
+    def test_rejectedDropped(self):
+        """
+        Batches rejected with a permanent error are dropped, not retried.
+        """
+        self.onEntries(['1', '2', '3'])
+        self.publishes[0][0].errback(error.StanzaError('bad-request'))
+        self.assertEqual(1, len(self.flushLoggedErrors(error.StanzaError)))
+        self.assertEqual(1, self.client.dropped)
+        self.assertEqual([['1'], ['2'], ['3']],
+                         [ids for d, ids in self.publishes])
+
+
+
+class CompactStatusTest(unittest.TestCase):
+    """
+    Tests for L{twitter.compactStatus}.
+    """
+
+    def setUp(self):
+        user = User()
+        user.id = 2426271
+        user.screen_name = u'ralphm'
+        user.profile_image_url = u'http://a2.twimg.com/profile_images/1.png'
+
+        url = URL()
+        url.url = u'http://t.co/123456'
+        url.display_url = u'example.org'
+        url.indices = Indices()
+        url.indices.start = 5
+        url.indices.end = 23
+
+        self.status = Status()
+        self.status.id = 1
+        self.status.text = u'Test http://t.co/123456'
+        self.status.user = user
+        self.status.lang = u'en'
+        self.status.entities = Entities()
+        self.status.entities.urls = [url]
+
+
+    def test_fields(self):
+        """
+        The used fields are copied.
+        """
+        entry = twitter.compactStatus(self.status)
+        self.assertEqual(1, entry.id)
+        self.assertEqual(u'Test http://t.co/123456', entry.text)
+        self.assertEqual(u'en', entry.lang)
+        self.assertEqual(2426271, entry.user.id)
+        self.assertEqual(u'ralphm', entry.user.screen_name)
+        self.assertEqual(u'http://a2.twimg.com/profile_images/1.png',
+                         entry.user.profile_image_url)
+        self.assertIdentical(None, entry.retweeted_status)
+        self.assertIdentical(None, entry.image_url)
+
+
+    def test_entities(self):
+        """
+        URL entities are copied with their indices.
+        """
+        entry = twitter.compactStatus(self.status)
+        self.assertEqual([], entry.entities.media)
+        url = entry.entities.urls[0]
+        self.assertEqual(u'http://t.co/123456', url.url)
+        self.assertEqual(u'example.org', url.display_url)
+        self.assertIdentical(None, url.expanded_url)
+        self.assertEqual((5, 23), (url.indices.start, url.indices.end))
+
+
+    def test_noEntities(self):
+        """
+        A status without entities gets empty lists of entities.
+        """
+        del self.status.entities
+        entry = twitter.compactStatus(self.status)
+        self.assertEqual([], entry.entities.urls)
+        self.assertEqual([], entry.entities.media)
+
+
+    def test_retweeted(self):
+        """
+        The retweeted status is compacted, too.
+        """
+        retweeted = Status()
+        retweeted.id = 2
+        retweeted.text = u'Original'
+        retweeted.user = User()
+        retweeted.user.screen_name = u'other'
+        self.status.retweeted_status = retweeted
+
+        entry = twitter.compactStatus(self.status)
+        self.assertEqual(2, entry.retweeted_status.id)
+        self.assertEqual(u'other', entry.retweeted_status.user.screen_name)
+
+
+    def test_slots(self):
+        """
+        No other attributes can be stored on a compact status.
+        """
+        entry = twitter.compactStatus(self.status)
+        self.assertRaises(AttributeError, setattr, entry, 'raw', {})
+
+
 
 class EmbedderTest(unittest.TestCase):
     """
@@ -1,10 +1,12 @@
 """
 Tests for L{ikdisplay.web}.
 """
+from twisted.internet import task
 from twisted.trial import unittest
 
 from axiom import store
-from ikdisplay import source, web
+from ikdisplay import aggregator, archive, source, web
+from ikdisplay.notification import Notification
 
 class APIResourceTest(unittest.TestCase):
     """
@@ -17,6 +19,7 @@ class APIResourceTest(unittest.TestCase):
         self.calls = []
         self.observers = []
         self.refreshes = 0
+        self.routeRefreshes = 0
         self.question = source.Thing(store=self.store,
                                      uri=u'http://any.nu/id/47074')
         self.vote = source.VoteSource(store=self.store,
@@ -38,6 +41,14 @@ class APIResourceTest(unittest.TestCase):
         self.refreshes += 1
 
 
+    def refreshRoutes(self):
+        self.routeRefreshes += 1
+
+
+    def getStreamMetrics(self):
+        return [{'sinceData': 1}, None]
+
+
     def test_api_updateItemNodeUnchanged(self):
         """
         If the pubsub node is unchanged, don't resubscribe.
@@ -49,6 +60,7 @@ class APIResourceTest(unittest.TestCase):
         self.resource.api_updateItem(FakeRequest())
 
         self.assertEquals([], self.calls)
+        self.assertEquals(1, self.routeRefreshes)
 
 
     def test_api_updateItemNodeChanged(self):
@@ -81,6 +93,39 @@ class APIResourceTest(unittest.TestCase):
         self.assertEquals(['add'], self.calls)
 
 
+    def test_api_updateItemInteger(self):
+        """
+        Integer attributes keep 0, and an empty value clears them.
+        """
+        twitterSource = source.TwitterSource(store=self.store, maxRate=10)
+
+        class FakeRequest(object):
+            args = {u'id': [twitterSource.storeID],
+                    u'maxRate': [u'0']}
+
+        self.resource.api_updateItem(FakeRequest())
+        self.assertEquals(0, twitterSource.maxRate)
+
+        FakeRequest.args[u'maxRate'] = [u' ']
+        self.resource.api_updateItem(FakeRequest())
+        self.assertIdentical(None, twitterSource.maxRate)
+
+
+    def test_api_updateItemIntegerInvalid(self):
+        """
+        Values of integer attributes that are not a number are rejected.
+        """
+        twitterSource = source.TwitterSource(store=self.store, maxRate=10)
+
+        class FakeRequest(object):
+            args = {u'id': [twitterSource.storeID],
+                    u'maxRate': [u'ten']}
+
+        self.assertRaises(web.InvalidArgument,
+                          self.resource.api_updateItem, FakeRequest())
+        self.assertEquals(10, twitterSource.maxRate)
+
+
     def test_api_updateItemDisable(self):
         """
         If the pubsub source is disabled, unsubscribe.
@@ -132,3 +177,100 @@ class APIResourceTest(unittest.TestCase):
         self.assertEquals([], self.calls)
         self.assertEquals(1, self.refreshes)
 
+
+    def test_api_twitterStreams(self):
+        """
+        The Twitter stream metrics are those of the dispatcher.
+        """
+        class FakeRequest(object):
+            args = {}
+
+        result = self.resource.api_twitterStreams(FakeRequest())
+        self.assertEquals([{'sinceData': 1}, None], result)
+
+
+    def test_api_notifications(self):
+        """
+        The last archived notifications of a feed are returned with their time.
+        """
+        class FakeRequest(object):
+            args = {'handle': ['test'],
+                    'count': ['1']}
+
+        self.resource.archive = archive.NotificationArchive(self.mktemp(),
+                                                            task.Clock())
+        self.resource.archive.addNotifications(
+            u'test', [Notification(title=u'First'),
+                      Notification(title=u'Second')])
+
+        result = self.resource.api_notifications(FakeRequest())
+        self.assertEquals([{'title': u'Second', '_time': 0}], result)
+
+
+    def test_api_notificationsNoArchive(self):
+        """
+        Without an archive, there are no archived notifications.
+        """
+        class FakeRequest(object):
+            args = {'handle': ['test']}
+
+        self.assertRaises(web.NotFound,
+                          self.resource.api_notifications, FakeRequest())
+
+
+    def test_api_history(self):
+        """
+        The history of a feed is returned once it has been restored.
+        """
+        class FakeRequest(object):
+            args = {'handle': ['test']}
+
+        self.resource.history = aggregator.AggregatorFromNotifier()
+        self.resource.history.processNotifications(
+            u'test', [Notification(title=u'Test')])
+
+        d = self.resource.api_history(FakeRequest())
+        d.addCallback(self.assertEquals, [{'title': u'Test'}])
+        return d
+
+
+    def test_api_historyNoHistory(self):
+        """
+        Without a history, there is no history to return.
+        """
+        class FakeRequest(object):
+            args = {'handle': ['test']}
+
+        self.assertRaises(web.NotFound,
+                          self.resource.api_history, FakeRequest())
+
+
+    def test_api_dedupe(self):
+        """
+        The deduplication metrics are those of the deduplicator.
+        """
+        class FakeRequest(object):
+            args = {}
+
+        self.resource.deduplicator = aggregator.Deduplicator()
+        self.resource.deduplicator.filterNotifications(
+            u'test', [{'title': u'Test'}, {'title': u'Test'}])
+
+        result = self.resource.api_dedupe(FakeRequest())
+        self.assertEquals({u'test': {'checked': 2, 'hits': 1}}, result)
+
+
+    def test_api_lanes(self):
+        """
+        The publishing lane metrics are those of the scheduler.
+        """
+        class FakeRequest(object):
+            args = {}
+
+        self.resource.scheduler = aggregator.LaneScheduler(
+            lambda feed, notifications: None, clock=task.Clock())
+        self.resource.scheduler.enqueue(u'test', [{'title': u'Test'}])
+
+        result = self.resource.api_lanes(FakeRequest())
+        self.assertEquals({0: {'queued': 0, 'published': 1, 'shed': 0,
+                               'meanDelay': 0, 'maxDelay': 0}}, result)
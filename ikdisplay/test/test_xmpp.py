@@ -2,6 +2,8 @@
 Tests for L{ikdisplay.xmpp}.
 """
 
+import os
+
 from zope.interface import implements
 
 from twisted.internet import defer, task
@@ -14,7 +16,10 @@ from twisted.words.xish import domish, utility
 from axiom import attributes, item, store
 
 from wokkel import pubsub
-from ikdisplay import source, xmpp
+from wokkel.generic import parseXml
+
+from ikdisplay import journal, source, xmpp
+from ikdisplay.notification import Notification
 
 class GetPubSubServiceTest(unittest.TestCase):
 
@@ -81,6 +86,139 @@ class TestObserver(source.PubSubSourceMixin, item.Item):
 
 
 
+def countingParser(payload):
+    countingParser.calls += 1
+    return payload.name
+
+countingParser.calls = 0
+
+
+
+class TestParsingObserver(source.PubSubSourceMixin, item.Item):
+    """
+    A publish-subscribe observer that stores all parsed records in sequence.
+    """
+
+    implements(xmpp.IPubSubEventProcessor)
+    subscription = attributes.reference()
+    service = attributes.inmemory()
+    nodeIdentifier = attributes.inmemory()
+    records = attributes.inmemory()
+
+    payloadParser = staticmethod(countingParser)
+
+    def activate(self):
+        self.records = []
+
+
+    def itemsReceived(self, event, records=None):
+        self.records.append(records)
+
+
+    def getNode(self):
+        return (self.service, self.nodeIdentifier)
+
+
+
+class TestRecord(object):
+
+    def __init__(self, verbs, agentID=None):
+        self.verbs = frozenset(verbs)
+        self.agentID = agentID
+
+
+
+class TestRoutedObserver(object):
+    """
+    Observer that collects records, accepting those matching a filter.
+    """
+    payloadParser = None
+
+    def __init__(self, routingFilter):
+        self.routingFilter = routingFilter
+        self.records = []
+
+
+    def getRoutingFilter(self):
+        return self.routingFilter
+
+
+    def itemsReceived(self, event, records=None):
+        self.records.append(records)
+
+
+
+class PubSubRoutesTest(unittest.TestCase):
+    """
+    Tests for L{xmpp.PubSubRoutes}.
+    """
+
+    def setUp(self):
+        self.records = {'post': TestRecord(['post']),
+                        'like': TestRecord(['post', 'like'], 'agent1'),
+                        'other': TestRecord(['other'], 'agent2')}
+        payloads = []
+        for name in ('post', 'like', 'other'):
+            payloads.append(pubsub.Item(payload=domish.Element((None, name))))
+        self.event = pubsub.ItemsEvent(None, None, 'activity', payloads, None)
+
+
+    def parser(self, payload):
+        return self.records[payload.name]
+
+
+    def deliver(self, *observers):
+        for observer in observers:
+            observer.payloadParser = self.parser
+        routes = xmpp.PubSubRoutes(observers)
+        routes.deliver(self.event)
+
+
+    def test_deliverUnfiltered(self):
+        """
+        Observers without a filter get all records.
+        """
+        observer = TestRoutedObserver(None)
+        self.deliver(observer)
+        self.assertEquals([[self.records['post'], self.records['like'],
+                            self.records['other']]], observer.records)
+
+
+    def test_deliverVerbs(self):
+        """
+        A record matches if one of its verbs is accepted.
+        """
+        observer = TestRoutedObserver({'verbs': ['like', 'share']})
+        self.deliver(observer)
+        self.assertEquals([[None, self.records['like'], None]],
+                          observer.records)
+
+
+    def test_deliverAll(self):
+        """
+        A record must match all entries of the filter.
+        """
+        observer1 = TestRoutedObserver({'verbs': ['post'],
+                                        'agentID': [None]})
+        observer2 = TestRoutedObserver({'verbs': ['post', 'other'],
+                                        'agentID': ['agent1', 'agent2']})
+        self.deliver(observer1, observer2)
+        self.assertEquals([[self.records['post'], None, None]],
+                          observer1.records)
+        self.assertEquals([[None, self.records['like'],
+                            self.records['other']]], observer2.records)
+
+
+    def test_deliverNoMatch(self):
+        """
+        Observers are not called if none of the records match.
+        """
+        observer = TestRoutedObserver({'agentID': []})
+        self.deliver(observer)
+        self.assertEquals([], observer.records)
+
+
+
 class PubSubDispatcherTest(unittest.TestCase):
 
     def setUp(self):
@@ -484,6 +622,26 @@ class PubSubDispatcherTest(unittest.TestCase):
         self.assertEquals(1, len(self.observer.events))
 
 
+    def test_itemsReceivedParseOnce(self):
+        """
+        Observers with the same parser share the records of a single parse.
+        """
+        observers = [TestParsingObserver(store=self.store,
+                                         service=self.serviceJID,
+                                         nodeIdentifier=self.nodeIdentifier)
+                     for i in xrange(2)]
+        for observer in observers:
+            self.client.addObserver(observer)
+        self.clock.advance(5)
+
+        countingParser.calls = 0
+        self.client.itemsReceived(self.event)
+
+        self.assertEquals(1, countingParser.calls)
+        for observer in observers:
+            self.assertEquals([['rsp']], observer.records)
+
+
     def test_itemsReceivedNotifyUnknownUnsubscribe(self):
         """
         Items received from unknown nodes cause unsubscription.
@@ -510,6 +668,194 @@ class PubSubDispatcherTest(unittest.TestCase):
         self.assertEquals([], self.calls)
 
 
+    def test_itemsReceivedJournal(self):
+        """
+        Received items are recorded in the journal, and can be replayed.
+        """
+        path = self.mktemp()
+        os.mkdir(path)
+        testJournal = journal.Journal(path, self.clock)
+        self.client.journal = testJournal
+        self.client.addObserver(self.observer)
+        self.clock.advance(5)
+        self.client.itemsReceived(self.event)
+
+        records = list(testJournal.records())
+        self.assertEquals(1, len(records))
+        timestamp, kind, data = records[0]
+        self.assertEquals(xmpp.JOURNAL_PUBSUB, kind)
+
+        self.client.replayItems(data)
+        self.assertEquals(2, len(self.observer.events))
+        event = self.observer.events[-1]
+        self.assertEquals(self.serviceJID, event.sender)
+        self.assertEquals(self.nodeIdentifier, event.nodeIdentifier)
+        self.assertEquals(self.jid, event.recipient)
+        self.assertEquals(1, len(event.items))
+        self.assertEquals(u'test', unicode(event.items[0].rsp.status))
+
+
+    def test_itemsReceivedJournalUnknown(self):
+        """
+        Items from unknown nodes are not recorded in the journal.
+        """
+        path = self.mktemp()
+        os.mkdir(path)
+        testJournal = journal.Journal(path, self.clock)
+        self.client.journal = testJournal
+        self.event.nodeIdentifier = u'unknown'
+        self.client.addObserver(self.observer)
+        self.clock.advance(5)
+        self.client.itemsReceived(self.event)
+        self.clock.advance(5)
+        self.assertEquals([], list(testJournal.records()))
+
+
+    def test_replayItemsUnknown(self):
+        """
+        Replayed items for nodes that are no longer subscribed are ignored.
+        """
+        self.calls = []
+        data = xmpp.serializeItemsEvent(self.event)
+        self.client.replayItems(data)
+        self.assertEquals([], self.calls)
+
+
+    def test_publishNotifications(self):
+        """
+        Notifications are published as their XML serialization.
+        """
+        published = []
+        def publish(service, nodeIdentifier, items):
+            published.append((service, nodeIdentifier, items))
+            return defer.succeed(None)
+        self.client.publish = publish
+
+        notification = Notification(title=u'Test <User>', subtitle=u'test')
+        self.client.publishNotifications(self.serviceJID, u'feed',
+                                         [notification])
+
+        service, nodeIdentifier, items = published[-1]
+        self.assertEquals(u'feed', nodeIdentifier)
+        self.assertEquals(1, len(items))
+        payload = parseXml(items[0].toXml().encode('utf-8'))
+        payload = payload.elements().next()
+        self.assertEquals((xmpp.NS_NOTIFICATION, 'notification'),
+                          (payload.uri, payload.name))
+        self.assertEquals(u'Test <User>', unicode(payload.title))
+        self.assertEquals(u'test', unicode(payload.subtitle))
+
+
+    def test_publishNotificationsItemIdentifier(self):
+        """
+        Notifications with an item identifier are published with that
+        identifier.
+        """
+        published = []
+        def publish(service, nodeIdentifier, items):
+            published.extend(items)
+            return defer.succeed(None)
+        self.client.publish = publish
+
+        notification = Notification(title=u'Test')
+        notification.itemIdentifier = u'status-1'
+        self.client.publishNotifications(self.serviceJID, u'feed',
+                                         [notification, {'title': u'Test'}])
+
+        self.assertEquals([u'status-1', None],
+                          [item.getAttribute('id') for item in published])
+
+
+    def test_publishNotificationsRetry(self):
+        """
+        When the node is created first, the same items are published again.
+        """
+        published = []
+        def publish(service, nodeIdentifier, items):
+            published.append(items)
+            if len(published) == 1:
+                return defer.fail(error.StanzaError('item-not-found'))
+            else:
+                return defer.succeed(None)
+        self.client.publish = publish
+        self.client.createNode = lambda service, nodeIdentifier: \
+                                     defer.succeed(nodeIdentifier)
+
+        notification = Notification(title=u'Test User', subtitle=u'test')
+        self.client.publishNotifications(self.serviceJID, u'feed',
+                                         [notification])
+
+        self.assertEquals(2, len(published))
+        self.assertIdentical(published[0], published[1])
+        self.assertEquals(notification.toXml(), published[1][0].children[0])
+
+
+    def test_publishNotificationsDeferred(self):
+        """
+        The returned Deferred fires when the notifications have been
+        published, also after creating the node.
+        """
+        published = []
+        def publish(service, nodeIdentifier, items):
+            published.append(items)
+            if len(published) == 1:
+                return defer.fail(error.StanzaError('item-not-found'))
+            else:
+                return defer.succeed(None)
+        created = defer.Deferred()
+        self.client.publish = publish
+        self.client.createNode = lambda service, nodeIdentifier: created
+
+        d = self.client.publishNotifications(self.serviceJID, u'feed',
+                                             [Notification(title=u'Test')])
+        self.assertNoResult(d)
+        created.callback(u'feed')
+        self.assertEquals(2, len(published))
+        return d
+
+
+    def test_publishNotificationsFailed(self):
+        """
+        The returned Deferred errbacks when publishing failed.
+        """
+        def publish(service, nodeIdentifier, items):
+            return defer.fail(error.StanzaError('not-authorized'))
+        self.client.publish = publish
+
+        d = self.client.publishNotifications(self.serviceJID, u'feed',
+                                             [Notification(title=u'Test')])
+        self.assertFailure(d, error.StanzaError)
+        return d
+
+
+    def test_fetchNotifications(self):
+        """
+        Published notifications are retrieved once the connection is up,
+        with the identifier of their item.
+        """
+        requests = []
+        def items(service, nodeIdentifier, maxItems=None):
+            requests.append((service, nodeIdentifier, maxItems))
+            notification = Notification(title=u'Test User', subtitle=None)
+            item = pubsub.Item(u'status-1')
+            item.addChild(parseXml(notification.toXml().encode('utf-8')))
+            return defer.succeed([item, pubsub.Item()])
+        self.client.items = items
+
+        d = self.client.fetchNotifications(self.serviceJID, u'feed', 5)
+        self.assertEquals([], requests)
+        self.client.connectionInitialized()
+        self.assertEquals([(self.serviceJID, u'feed', 5)], requests)
+
+        def cb(notifications):
+            self.assertEquals([{'title': u'Test User', 'subtitle': None}],
+                              notifications)
+            self.assertEquals(u'status-1', notifications[0].itemIdentifier)
+
+        d.addCallback(cb)
+        return d
+
+
 
 
 class TestNotifier(object):
@@ -1,29 +1,371 @@
+from collections import deque
+import os
 import re
 import simplejson as json
+import struct
+import zlib
 
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, task
 from twisted.python import log
 from twisted.web import client
+from twisted.words.protocols.jabber import error
 from twisted.words.xish import domish
 
 from wokkel import pubsub
+from wokkel.generic import parseXml
 
 from twittytwister import streaming
 
 NS_TWITTER = 'http://mediamatic.nl/ns/ikdisplay/2009/twitter'
 
+JOURNAL_TWITTER = 'twitter'
+
+class CompactIndices(object):
+    """
+    Start and end indices of an entity in the text of a status.
+    """
+    __slots__ = ('start', 'end')
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+
+
+class CompactURL(object):
+    """
+    URL or media entity of a status.
+    """
+    __slots__ = ('url', 'display_url', 'expanded_url', 'media_url', 'indices')
+
+    def __init__(self, url=None, display_url=None, expanded_url=None,
+                       media_url=None, indices=None):
+        self.url = url
+        self.display_url = display_url
+        self.expanded_url = expanded_url
+        self.media_url = media_url
+        self.indices = indices
+
+
+
+class CompactEntities(object):
+    """
+    The URL and media entities of a status.
+    """
+    __slots__ = ('urls', 'media')
+
+    def __init__(self, urls=(), media=()):
+        self.urls = list(urls)
+        self.media = list(media)
+
+
+
+class CompactUser(object):
+    """
+    The author of a status.
+    """
+    __slots__ = ('id', 'screen_name', 'profile_image_url')
+
+    def __init__(self, id=None, screen_name=None, profile_image_url=None):
+        self.id = id
+        self.screen_name = screen_name
+        self.profile_image_url = profile_image_url
+
+
+
+class CompactStatus(object):
+    """
+    Compact representation of a status.
+
+    This holds only the fields of a L{streaming.Status} that are used for
+    embedding, matching and formatting, with the same attribute names, so
+    that the full object graph of the status does not need to be kept alive.
+
+    @ivar image_url: The URL of an image found by the L{Embedder}.
+    """
+    __slots__ = ('id', 'text', 'user', 'in_reply_to_screen_name',
+                 'retweeted_status', 'entities', 'lang', 'image_url')
+
+    def __init__(self, id=None, text=None, user=None,
+                       in_reply_to_screen_name=None, retweeted_status=None,
+                       entities=None, lang=None, image_url=None):
+        self.id = id
+        self.text = text
+        self.user = user or CompactUser()
+        self.in_reply_to_screen_name = in_reply_to_screen_name
+        self.retweeted_status = retweeted_status
+        self.entities = entities or CompactEntities()
+        self.lang = lang
+        self.image_url = image_url
+
+
+
+def _compactURL(entity):
+    indices = getattr(entity, 'indices', None)
+    if indices is not None:
+        indices = CompactIndices(indices.start, indices.end)
+
+    return CompactURL(getattr(entity, 'url', None),
+                      getattr(entity, 'display_url', None),
+                      getattr(entity, 'expanded_url', None),
+                      getattr(entity, 'media_url', None),
+                      indices)
+
+
+
+def compactStatus(status):
+    """
+    Extract a L{CompactStatus} from a L{streaming.Status}.
+    """
+    user = getattr(status, 'user', None)
+    if user is not None:
+        user = CompactUser(getattr(user, 'id', None),
+                           getattr(user, 'screen_name', None),
+                           getattr(user, 'profile_image_url', None))
+
+    entities = getattr(status, 'entities', None)
+    if entities is not None:
+        entities = CompactEntities(
+                [_compactURL(url)
+                 for url in getattr(entities, 'urls', None) or ()],
+                [_compactURL(media)
+                 for media in getattr(entities, 'media', None) or ()])
+
+    retweeted = getattr(status, 'retweeted_status', None)
+    if retweeted is not None:
+        retweeted = compactStatus(retweeted)
+
+    return CompactStatus(getattr(status, 'id', None),
+                         getattr(status, 'text', None),
+                         user,
+                         getattr(status, 'in_reply_to_screen_name', None),
+                         retweeted,
+                         entities,
+                         getattr(status, 'lang', None))
+
+
+
+class StreamTimer(object):
+    """
+    Tracks the timing of activity on a Twitter stream to detect stalls.
+
+    Twitter sends a keep-alive about every 30 seconds when there are no
+    statuses to deliver. The expected intervals between keep-alives and
+    between statuses are tracked as exponential moving averages, and a
+    stream is considered stalled if nothing was received for a multiple of
+    the keep-alive interval. If L{checkStatuses} is set, it is also
+    considered stalled if no status was received for a multiple of the
+    status interval.
+
+    @ivar keepAliveInterval: Average interval between keep-alives, in
+        seconds.
+    @type keepAliveInterval: C{float}
+    @ivar statusInterval: Average interval between statuses, in seconds, or
+        C{None} if less than two statuses have been received.
+    @type statusInterval: C{float}
+    @ivar keepAliveFactor: Multiple of L{keepAliveInterval} without any data
+        after which the stream is considered stalled.
+    @ivar statusFactor: Multiple of L{statusInterval} without any statuses
+        after which the stream is considered stalled.
+    @ivar minDataTimeout: Minimum time without any data before considering
+        the stream stalled.
+    @ivar minStatusTimeout: Minimum time without statuses before considering
+        the stream stalled.
+    @ivar smoothing: Weight of a new interval in the moving averages.
+    @ivar checkStatuses: Whether a stream that stops delivering statuses,
+        while still sending keep-alives, is considered stalled.
+    @type checkStatuses: C{bool}
+    """
+
+    keepAliveInterval = 30
+    statusInterval = None
+    keepAliveFactor = 3
+    statusFactor = 20
+    minDataTimeout = 45
+    minStatusTimeout = 300
+    smoothing = 0.2
+
+    def __init__(self, clock, checkStatuses=False):
+        self.clock = clock
+        self.checkStatuses = checkStatuses
+        self.started = self.lastData = clock.seconds()
+        self.lastStatus = None
+        self.lastKeepAlive = None
+        self.maxKeepAliveInterval = None
+
+
+    def _average(self, average, interval):
+        if average is None:
+            return interval
+        else:
+            return (1 - self.smoothing) * average + self.smoothing * interval
+
+
+    def dataReceived(self):
+        self.lastData = self.clock.seconds()
+
+
+    def keepAliveReceived(self):
+        now = self.clock.seconds()
+        if self.lastKeepAlive is not None:
+            interval = now - self.lastKeepAlive
+            self.keepAliveInterval = self._average(self.keepAliveInterval,
+                                                   interval)
+            self.maxKeepAliveInterval = max(self.maxKeepAliveInterval,
+                                            interval)
+        self.lastKeepAlive = now
+
+
+    def statusReceived(self):
+        now = self.clock.seconds()
+        if self.lastStatus is not None:
+            self.statusInterval = self._average(self.statusInterval,
+                                                now - self.lastStatus)
+        self.lastStatus = now
+
+
+    def getDataTimeout(self):
+        return max(self.minDataTimeout,
+                   self.keepAliveFactor * self.keepAliveInterval)
+
+
+    def getStatusTimeout(self):
+        if self.statusInterval is None:
+            return None
+        else:
+            return max(self.minStatusTimeout,
+                       self.statusFactor * self.statusInterval)
+
+
+    def checkStall(self):
+        """
+        Check if the stream has stalled.
+
+        @return: A description of the stall, or C{None}.
+        @rtype: C{str}
+        """
+        now = self.clock.seconds()
+
+        dataTimeout = self.getDataTimeout()
+        if now - self.lastData > dataTimeout:
+            return "no data for %d seconds" % (now - self.lastData)
+
+        statusTimeout = self.getStatusTimeout()
+        if (self.checkStatuses and statusTimeout is not None and
+            now - self.lastStatus > statusTimeout):
+            return "no statuses for %d seconds" % (now - self.lastStatus)
+
+        return None
+
+
+    def getMetrics(self):
+        """
+        Return the current timings of the stream, in seconds.
+
+        @rtype: C{dict}
+        """
+        now = self.clock.seconds()
+
+        def since(timestamp):
+            if timestamp is None:
+                return None
+            else:
+                return now - timestamp
+
+        return {
+            'connected': since(self.started),
+            'sinceData': since(self.lastData),
+            'sinceStatus': since(self.lastStatus),
+            'sinceKeepAlive': since(self.lastKeepAlive),
+            'keepAliveInterval': self.keepAliveInterval,
+            'maxKeepAliveInterval': self.maxKeepAliveInterval,
+            'statusInterval': self.statusInterval,
+            'dataTimeout': self.getDataTimeout(),
+            'statusTimeout': self.getStatusTimeout(),
+            }
+
+
+
 class VerboseTwitterStream(streaming.TwitterStream):
     """
     More verbose Twitter protocol.
+
+    This tracks the timing of received data, statuses and keep-alives with a
+    L{StreamTimer}, checking every L{checkInterval} seconds if the stream has
+    stalled. A stalled stream is disconnected right away, instead of waiting
+    for the protocol timeout, so that the monitor can reconnect.
+
+    Each status is passed on with the raw datagram it was parsed from as
+    its C{datagram} attribute, so that the dispatcher can record it in its
+    journal once it knows the status is not a duplicate.
+
+    @ivar timer: The timer for the current connection.
+    @type timer: L{StreamTimer}
+    @ivar checkStatuses: Whether to also consider the stream stalled when
+        it stops delivering statuses, see L{StreamTimer.checkStatuses}.
+    @type checkStatuses: C{bool}
     """
 
-    def timeoutConnection(self):
-        streaming.TwitterStream.timeoutConnection(self)
-        log.msg("Twitter connection timed out.")
+    checkInterval = 5
+    checkStatuses = False
+    clock = reactor
+    timer = None
+    _stallCheck = None
+
+    def connectionMade(self):
+        streaming.TwitterStream.connectionMade(self)
+        self.timer = StreamTimer(self.clock, self.checkStatuses)
+        self._stallCheck = task.LoopingCall(self.checkStall)
+        self._stallCheck.clock = self.clock
+        self._stallCheck.start(self.checkInterval, now=False)
+
+
+    def connectionLost(self, reason):
+        if self._stallCheck is not None and self._stallCheck.running:
+            self._stallCheck.stop()
+        streaming.TwitterStream.connectionLost(self, reason)
+
+
+    def dataReceived(self, data):
+        self.timer.dataReceived()
+        streaming.TwitterStream.dataReceived(self, data)
+
+
+    def datagramReceived(self, data):
+        try:
+            obj = json.loads(data)
+        except ValueError:
+            log.err(None, "Invalid JSON in stream: %r" % data)
+            return
+
+        if u'text' not in obj:
+            log.msg("Unsupported object %r" % obj)
+            return
+
+        self.timer.statusReceived()
+        status = streaming.Status.fromDict(obj)
+        status.datagram = data
+        self.callback(status)
 
 
     def keepAliveReceived(self):
-        log.msg("Twitter keep-alive")
+        self.timer.keepAliveReceived()
+
+
+    def checkStall(self):
+        """
+        Disconnect if the stream has stalled.
+        """
+        stall = self.timer.checkStall()
+        if stall is not None:
+            log.msg("Twitter stream stalled: %s." % stall)
+            self._stallCheck.stop()
+            self.timeoutConnection()
+
+
+    def timeoutConnection(self):
+        streaming.TwitterStream.timeoutConnection(self)
+        log.msg("Twitter connection timed out.")
 
 
 
@@ -38,30 +380,127 @@ class TwitterLogger(object):
 
 
 
-def propertyToDomish(prop):
-    element = domish.Element((NS_TWITTER, prop.tag_name))
+_missing = object()
+_serializers = {}
 
-    for propName in prop.SIMPLE_PROPS:
-        if hasattr(prop, propName):
-            value = getattr(prop, propName)
-            element.addElement(propName, content=value)
+def _makeSerializer(cls):
+    """
+    Create a function that renders instances of a property class as domish.
 
-    for propName in prop.COMPLEX_PROPS:
-        if hasattr(prop, propName):
-            child = propertyToDomish(getattr(prop, propName))
-            element.addChild(child)
+    The qualified names of the element and its children are resolved once,
+    and each property is looked up only once per instance.
+    """
+    qname = (NS_TWITTER, cls.tag_name)
+    simple = tuple((propName, (NS_TWITTER, propName))
+                   for propName in cls.SIMPLE_PROPS)
+    complex = tuple(cls.COMPLEX_PROPS)
+    Element = domish.Element
+
+    def serialize(prop):
+        element = Element(qname)
+        children = element.children
+
+        for propName, childName in simple:
+            value = getattr(prop, propName, _missing)
+            if value is not _missing:
+                child = Element(childName)
+                child.parent = element
+                children.append(child)
+                if value:
+                    child.addContent(value)
+
+        for propName in complex:
+            value = getattr(prop, propName, _missing)
+            if value is not _missing:
+                child = propertyToDomish(value)
+                child.parent = element
+                children.append(child)
 
-    return element
+        return element
+
+    return serialize
+
+
+
+def propertyToDomish(prop):
+    """
+    Render a Twitter Streaming API property as domish.
+
+    The serializer for the class of C{prop} is created on first use.
+    """
+    cls = prop.__class__
+    try:
+        serialize = _serializers[cls]
+    except KeyError:
+        serialize = _serializers[cls] = _makeSerializer(cls)
+    return serialize(prop)
 
 
 
 class TwitterPubSubClient(pubsub.PubSubClient):
+    """
+    Publishes raw statuses to a publish-subscribe node.
+
+    Items are queued and published in batches of up to C{batchSize} items,
+    with at most C{maxInFlight} publish requests outstanding. When a batch
+    fails to publish, no new batches are sent. Once the outstanding requests
+    have finished, all failed batches are put back at the front of the queue
+    in their original order, to be retried after C{retryDelay} seconds.
+    Batches rejected with an error condition in C{permanentConditions} are
+    dropped instead, as retrying them would fail again.
+
+    At most C{maxQueue} items are kept in memory. Further items are spilled
+    to the spool file, if given, and are read back as the queue drains. If
+    there is no spool file, the oldest items are dropped instead.
+
+    @ivar batchSize: Maximum number of items per publish request.
+    @type batchSize: C{int}
+    @ivar maxInFlight: Maximum number of outstanding publish requests.
+    @type maxInFlight: C{int}
+    @ivar maxQueue: Maximum number of items kept in memory.
+    @type maxQueue: C{int}
+    @ivar retryDelay: Seconds to wait before retrying failed batches.
+    @type retryDelay: C{int}
+    @ivar spoolPath: Path of the file to spill items to, or C{None}.
+    @type spoolPath: C{str}
+    @ivar spooled: Number of items waiting in the spool file.
+    @type spooled: C{int}
+    @ivar dropped: Number of items dropped because the queue was full, or
+        because they were rejected.
+    @type dropped: C{int}
+    @ivar permanentConditions: Stanza error conditions for which a batch is
+        not retried.
+    @type permanentConditions: C{frozenset}
+    """
+
+    permanentConditions = frozenset(['bad-request', 'not-acceptable',
+                                     'not-allowed', 'forbidden',
+                                     'feature-not-implemented'])
 
-    def __init__(self, service, nodeIdentifier):
+    batchSize = 20
+    maxInFlight = 4
+    maxQueue = 1000
+    retryDelay = 5
+    clock = reactor
+
+    def __init__(self, service, nodeIdentifier, spoolPath=None):
         self.service = service
         self.nodeIdentifier = nodeIdentifier
-        self.queue = defer.DeferredQueue()
+        self.spoolPath = spoolPath
+        self.queue = deque()
+        self.inFlight = 0
+        self.spooled = 0
+        self.dropped = 0
         self._initialized = False
+        self._sequence = 0
+        self._failed = []
+        self._retryCall = None
+        self._spoolFile = None
+        self._spoolOffset = 0
+
+        if spoolPath and os.path.exists(spoolPath):
+            self._openSpool()
+            self.spooled = self._countSpooled()
 
 
     def connectionInitialized(self):
@@ -74,29 +513,142 @@ class TwitterPubSubClient(pubsub.PubSubClient):
         self._initialized = False
 
 
-    def processQueue(self):
-        def publishItem(item):
-            def publishFailed(failure):
-                log.err(failure)
-                log.msg("Requeueing")
-                self.queue.put(item)
+    def _openSpool(self):
+        if self._spoolFile is None:
+            self._spoolFile = open(self.spoolPath, 'a+b')
+
 
-            d = self.publish(self.service, self.nodeIdentifier, [item])
-            d.addErrback(publishFailed)
-            return d
+    def _countSpooled(self):
+        """
+        Count the items in the spool file, starting at the read offset.
+        """
+        count = 0
+        offset = self._spoolOffset
+        self._spoolFile.seek(offset)
+        while True:
+            header = self._spoolFile.read(4)
+            if len(header) < 4:
+                break
+            length, = struct.unpack('>I', header)
+            offset += 4 + length
+            self._spoolFile.seek(offset)
+            count += 1
+        return count
+
+
+    def _spoolItem(self, item):
+        """
+        Append a serialized item to the spool file.
+        """
+        self._openSpool()
+        data = item.toXml().encode('utf-8')
+        self._spoolFile.seek(0, 2)
+        self._spoolFile.write(struct.pack('>I', len(data)) + data)
+        self._spoolFile.flush()
+        self.spooled += 1
+
+
+    def _unspoolItems(self, count):
+        """
+        Move up to C{count} items from the spool file to the queue.
 
-        if not self._initialized:
+        The items are rebuilt from their parsed XML, so that they are
+        published in the publish-subscribe namespace. When the spool file
+        has been read completely, it is truncated.
+        """
+        self._spoolFile.seek(self._spoolOffset)
+        while count and self.spooled:
+            length, = struct.unpack('>I', self._spoolFile.read(4))
+            data = self._spoolFile.read(length)
+            element = parseXml(data)
+            self.queue.append(pubsub.Item(element.getAttribute('id'),
+                                          element.firstChildElement()))
+            self._spoolOffset += 4 + length
+            self.spooled -= 1
+            count -= 1
+
+        if not self.spooled:
+            self._spoolFile.seek(0)
+            self._spoolFile.truncate()
+            self._spoolOffset = 0
+
+
+    def processQueue(self):
+        """
+        Send batches of queued items, up to the maximum in flight.
+        """
+        if not self._initialized or self._failed:
             return
 
-        d = self.queue.get()
-        d.addCallback(publishItem)
-        d.addCallback(lambda _: reactor.callLater(0, self.processQueue))
+        while self.inFlight < self.maxInFlight:
+            if self.spooled and len(self.queue) < self.maxQueue:
+                self._unspoolItems(self.maxQueue - len(self.queue))
+
+            if not self.queue:
+                break
+
+            items = [self.queue.popleft()
+                     for _ in xrange(min(self.batchSize, len(self.queue)))]
+            self._sequence += 1
+            self.inFlight += 1
+            d = self.publish(self.service, self.nodeIdentifier, items)
+            d.addCallbacks(self._publishSucceeded, self._publishFailed,
+                           errbackArgs=(self._sequence, items))
+
+
+    def _publishSucceeded(self, result):
+        self.inFlight -= 1
+        self._batchDone()
+
+
+    def _publishFailed(self, failure, sequence, items):
+        log.err(failure)
+        self.inFlight -= 1
+        if (failure.check(error.StanzaError) and
+            failure.value.condition in self.permanentConditions):
+            log.msg("Dropping %d rejected items" % len(items))
+            self.dropped += len(items)
+        else:
+            self._failed.append((sequence, items))
+        self._batchDone()
+
+
+    def _batchDone(self):
+        if not self._failed:
+            self.processQueue()
+        elif not self.inFlight and self._retryCall is None:
+            log.msg("Requeueing %d failed batches" % len(self._failed))
+            self._retryCall = self.clock.callLater(self.retryDelay,
+                                                   self._retry)
+
+
+    def _retry(self):
+        """
+        Put failed batches back at the front of the queue and resume.
+        """
+        self._retryCall = None
+        self._failed.sort()
+        for sequence, items in reversed(self._failed):
+            self.queue.extendleft(reversed(items))
+        self._failed = []
+        self.processQueue()
 
 
     def onEntry(self, entry):
         payload = propertyToDomish(entry)
         item = pubsub.Item(entry.id, payload)
-        self.queue.put(item)
+
+        if self.spooled or len(self.queue) >= self.maxQueue:
+            if self.spoolPath:
+                self._spoolItem(item)
+            else:
+                self.queue.popleft()
+                self.queue.append(item)
+                self.dropped += 1
+        else:
+            self.queue.append(item)
+
+        self.processQueue()
 
 
 
@@ -110,14 +662,50 @@ class TwitterDispatcher(object):
     are passed to all observers, who can then filter out the desired statuses
     themselves.
 
+    The filter is partitioned over one or more monitors, each maintaining its
+    own connection to the Streaming API. A term or user ID is always assigned
+    to the same monitor, so that changing the filter of one source only
+    reconnects the monitors whose part of the filter has changed. Statuses
+    received over multiple connections are only delivered once.
+
     Call C{refreshFilters} after adding, removing, or changing observers to
     recalculate the filter and reconnect.
+
+    @ivar monitors: The monitors to partition the filter over.
+    @type monitors: C{list} of L{TwitterMonitor}
+    @ivar maxTerms: Maximum number of terms to track per connection.
+    @type maxTerms: C{int}
+    @ivar maxUserIDs: Maximum number of user IDs to follow per connection.
+    @type maxUserIDs: C{int}
+    @ivar maxRecent: Number of recently received status IDs to keep for
+        dropping duplicates.
+    @type maxRecent: C{int}
+    @ivar dropped: Number of matching statuses dropped for being over the
+        maximum rate, by source store ID.
+    @type dropped: C{dict}
+    @ivar clock: Clock used for the rate buckets and retweet collapsers of
+        the sources.
+    @ivar journal: Journal to record the raw datagrams of received statuses
+        in, or C{None}. Statuses received over multiple connections are
+        recorded once.
+    @type journal: L{ikdisplay.journal.Journal}
     """
 
-    def __init__(self, store, monitor, embedder):
+    maxTerms = 400
+    maxUserIDs = 5000
+    maxRecent = 1000
+    clock = None
+    journal = None
+
+    def __init__(self, store, monitors, embedder):
         self.store = store
-        self.monitor = monitor
+        self.monitors = monitors
         self.embedder = embedder
+        self.dropped = {}
+        self._recentIDs = set()
+        self._recentOrder = deque()
+        self._buckets = {}
+        self._collapsers = {}
         self.setFilters()
 
 
@@ -126,6 +714,64 @@ class TwitterDispatcher(object):
         return self.store.query(TwitterSource, TwitterSource.enabled==True)
 
 
+    def _getBucket(self, source):
+        """
+        Return the token bucket for the maximum rate of a source.
+
+        The buckets are kept here by store ID, as the source items
+        themselves may be unloaded between statuses. A new bucket is made
+        when the maximum rate of the source changes.
+
+        @return: The bucket, or C{None} if the source has no maximum rate.
+        """
+        bucket = self._buckets.get(source.storeID)
+        if not source.maxRate:
+            if bucket is not None:
+                del self._buckets[source.storeID]
+            return None
+
+        if bucket is None or bucket.rate != source.maxRate / 60.0:
+            bucket = source.makeBucket(self.clock)
+            self._buckets[source.storeID] = bucket
+        return bucket
+
+
+    def _getCollapser(self, source):
+        """
+        Return the retweet collapser of a source.
+
+        Like the buckets, the collapsers are kept here by store ID, so that
+        the retweet counts and pending updates survive the source item being
+        unloaded.
+
+        @return: The collapser, or C{None} if the source does not collapse
+            retweets.
+        """
+        collapser = self._collapsers.get(source.storeID)
+        if collapser is None:
+            collapser = source.makeRetweetCollapser(self.clock)
+            if collapser is not None:
+                self._collapsers[source.storeID] = collapser
+        return collapser
+
+
+    def _accept(self, source, entry):
+        """
+        Check if a source matches a status, and the status is within the
+        maximum rate of the source.
+        """
+        if not source.match(entry):
+            return False
+
+        bucket = self._getBucket(source)
+        if bucket is None or source.admit(entry, bucket):
+            return True
+        else:
+            self.dropped[source.storeID] = self.dropped.get(source.storeID,
+                                                            0) + 1
+            return False
+
+
     def collectFilters(self):
         terms = set()
         userIDs = set()
@@ -137,39 +783,135 @@ class TwitterDispatcher(object):
         return terms, userIDs
 
 
+    def _getPartition(self, value):
+        """
+        Return the index of the monitor a term or user ID is assigned to.
+        """
+        checksum = zlib.crc32(value.encode('utf-8')) & 0xffffffff
+        return checksum % len(self.monitors)
+
+
     def setFilters(self):
         terms, userIDs = self.collectFilters()
         self.terms = terms
         self.userIDs = userIDs
-        self.monitor.args = {}
-        if self.terms:
-            self.monitor.args['track'] = ','.join((term.strip('"')
-                                                   for term in self.terms))
-        if self.userIDs:
-            self.monitor.args['follow'] = ','.join(self.userIDs)
-
-        if self.monitor.args:
-            self.monitor.delegate = self.onEntry
-        else:
-            self.monitor.delegate = None
+
+        partitions = [(set(), set()) for monitor in self.monitors]
+        for term in terms:
+            term = term.strip('"')
+            partitions[self._getPartition(term)][0].add(term)
+        for userID in userIDs:
+            partitions[self._getPartition(userID)][1].add(userID)
+
+        for index, monitor in enumerate(self.monitors):
+            track, follow = partitions[index]
+            if len(track) > self.maxTerms:
+                log.msg("Twitter stream %d tracks %d terms, "
+                        "more than the maximum of %d." %
+                        (index, len(track), self.maxTerms))
+            if len(follow) > self.maxUserIDs:
+                log.msg("Twitter stream %d follows %d users, "
+                        "more than the maximum of %d." %
+                        (index, len(follow), self.maxUserIDs))
+
+            monitor.args = {}
+            if track:
+                monitor.args['track'] = ','.join(sorted(track))
+            if follow:
+                monitor.args['follow'] = ','.join(sorted(follow))
+
+            if monitor.args:
+                monitor.delegate = self.onEntry
+            else:
+                monitor.delegate = None
 
 
     def refreshFilters(self):
-        oldArgs = self.monitor.args or {}
+        """
+        Recalculate the filter and reconnect the affected monitors.
+        """
+        oldArgs = [monitor.args or {} for monitor in self.monitors]
         self.setFilters()
-        if oldArgs != self.monitor.args:
-            self.monitor.connect(forceReconnect=True)
+        for monitor, args in zip(self.monitors, oldArgs):
+            if args != monitor.args:
+                monitor.connect(forceReconnect=True)
+
+
+    def getStreamMetrics(self):
+        """
+        Return the timings of the current connection of each monitor.
+
+        @return: Per monitor, the metrics from its L{StreamTimer}, or
+            C{None} if it is not connected.
+        @rtype: C{list}
+        """
+        metrics = []
+        for monitor in self.monitors:
+            protocol = getattr(monitor, 'protocol', None)
+            timer = getattr(protocol, 'timer', None)
+            if timer is not None:
+                metrics.append(timer.getMetrics())
+            else:
+                metrics.append(None)
+        return metrics
+
+
+    def _isDuplicate(self, entry):
+        """
+        Check if a status has recently been received on another connection.
+        """
+        if entry.id in self._recentIDs:
+            return True
+
+        self._recentIDs.add(entry.id)
+        self._recentOrder.append(entry.id)
+        if len(self._recentOrder) > self.maxRecent:
+            self._recentIDs.discard(self._recentOrder.popleft())
+        return False
+
+
+    def replayDatagram(self, data):
+        """
+        Pass a status that was recorded in the journal to the sources.
+
+        Statuses that are still in the window for dropping duplicates are
+        not delivered again.
+        """
+        obj = json.loads(data)
+        if u'text' in obj:
+            self.onEntry(streaming.Status.fromDict(obj))
 
 
     def onEntry(self, entry):
+        """
+        Pass a status to the sources that accept it.
+
+        Statuses that are not accepted by any source, because they do not
+        match or are over the source's maximum rate, are dropped before
+        looking for embedded images.
+        """
         def deliver(entry):
-            for source in self._getEnabledSources():
-                source.onEntry(entry)
+            for source in sources:
+                source.onEntry(entry, self._getCollapser(source))
+
+        if self._isDuplicate(entry):
+            return
+
+        datagram = getattr(entry, 'datagram', None)
+        if self.journal is not None and datagram is not None:
+            self.journal.append(JOURNAL_TWITTER, datagram)
+
+        entry = compactStatus(entry)
 
         log.msg(format="Tweet by %(screen_name)s (%(lang)s): %(text)s",
                 screen_name=entry.user.screen_name.encode('utf-8'),
                 text=entry.text.encode('utf-8'),
-                lang=getattr(entry, "lang", None))
+                lang=entry.lang)
+
+        sources = [source for source in self._getEnabledSources()
+                          if self._accept(source, entry)]
+        if not sources:
+            return
 
         d = self.embedder.augmentStatusWithImage(entry)
         d.addCallback(deliver)
@@ -220,7 +962,7 @@ class Embedder(object):
         This tries to detect images from URLs embedded in the entry and
         includes the first one in the entry's C{image_url} attribute.
 
-        @type entry: L{streaming.Status}
+        @type entry: L{CompactStatus} or L{streaming.Status}
 
         @rtype: L{defer.Deferred}
         """
@@ -240,7 +982,7 @@ class Embedder(object):
         elif hasattr(entry.entities, 'urls') and entry.entities.urls:
             ds = []
             for urlentry in entry.entities.urls:
-                url = getattr(urlentry, 'expanded_url', urlentry.url)
+                url = getattr(urlentry, 'expanded_url', None) or urlentry.url
                 if url:
                     if (not url.startswith('http://') and
                         not url.startswith('https://')):
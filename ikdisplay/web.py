@@ -53,6 +53,11 @@ class NotFound(Exception):
     pass
 
 
+
+class InvalidArgument(Exception):
+    pass
+
+
 class APIMethod(ProtectedResource):
 
     def __init__(self, fun, pw):
@@ -80,6 +85,12 @@ class APIMethod(ProtectedResource):
             return "%s not found\n" % str(f.value)
         result.addErrback(notFound)
 
+        def invalidArgument(f):
+            f.trap(InvalidArgument)
+            request.setResponseCode(http.BAD_REQUEST)
+            return "Invalid argument %s\n" % str(f.value)
+        result.addErrback(invalidArgument)
+
         def genericError(f):
             request.setResponseCode(http.BAD_REQUEST)
             log.err(f)
@@ -101,12 +112,18 @@ class APIMethod(ProtectedResource):
 
 class APIResource(resource.Resource):
 
-    def __init__(self, store, pubsubDispatcher, twitterDispatcher, password):
+    def __init__(self, store, pubsubDispatcher, twitterDispatcher, password,
+                 archive=None, deduplicator=None, scheduler=None,
+                 history=None):
         resource.Resource.__init__(self)
         self.store = store
         self.password = password
         self.pubsubDispatcher = pubsubDispatcher
         self.twitterDispatcher = twitterDispatcher
+        self.archive = archive
+        self.deduplicator = deduplicator
+        self.scheduler = scheduler
+        self.history = history
 
 
     def getChild(self, path, req):
@@ -144,6 +161,58 @@ class APIResource(resource.Resource):
         return result
 
 
+    def api_twitterStreams(self, request):
+        """ Get the timings of the connections to the Twitter Streaming API. """
+        return self.twitterDispatcher.getStreamMetrics()
+
+
+    def api_notifications(self, request):
+        """ Get the archived notifications of the feed with {handle}, the last {count} or those {since} a time. """
+        if self.archive is None:
+            raise NotFound("archive")
+
+        handle = request.args["handle"][0].decode('utf-8')
+        if "since" in request.args:
+            entries = self.archive.getSince(handle,
+                                            float(request.args["since"][0]))
+        else:
+            count = int(request.args.get("count", [13])[0])
+            entries = self.archive.getLast(handle, count)
+
+        result = []
+        for timestamp, notification in entries:
+            notification = notification.asDict()
+            notification['_time'] = timestamp
+            result.append(notification)
+        return result
+
+
+    def api_history(self, request):
+        """ Get the last notifications published to the feed with {handle}, including those from before a restart. """
+        if self.history is None:
+            raise NotFound("history")
+
+        handle = request.args["handle"][0].decode('utf-8')
+        d = self.history.getHistory(handle)
+        d.addCallback(lambda notifications: [notification.asDict()
+                                             for notification in notifications])
+        return d
+
+
+    def api_dedupe(self, request):
+        """ Get the number of checked and dropped duplicate notifications per feed. """
+        if self.deduplicator is None:
+            raise NotFound("deduplicator")
+        return self.deduplicator.getMetrics()
+
+
+    def api_lanes(self, request):
+        """ Get the queue length and queueing delays of the publishing lanes, per priority. """
+        if self.scheduler is None:
+            raise NotFound("scheduler")
+        return self.scheduler.getMetrics()
+
+
     def api_getItem(self, request):
         """ Given an {id}, get the corresponding item from the database. """
         id = int(request.args["id"][0])
@@ -171,6 +240,14 @@ class APIResource(resource.Resource):
             value = unicode(args[k][0])
             if isinstance(schema[k], attributes.boolean):
                 value = value == "true"
+            if isinstance(schema[k], attributes.integer):
+                if not value.strip():
+                    value = None
+                else:
+                    try:
+                        value = int(value)
+                    except ValueError:
+                        raise InvalidArgument(k)
             if isinstance(schema[k], JIDAttribute):
                 value = JID(value)
             if isinstance(schema[k], attributes.textlist):
@@ -190,6 +267,9 @@ class APIResource(resource.Resource):
                 self.pubsubDispatcher.removeObserver(item)
             if item.enabled:
                 self.pubsubDispatcher.addObserver(item)
+        elif source.IPubSubEventProcessor.providedBy(item):
+            # The routing filter might have changed.
+            self.pubsubDispatcher.refreshRoutes()
 
         if hasattr(item, 'terms') and hasattr(item, 'userIDs'):
             self.twitterDispatcher.refreshFilters()
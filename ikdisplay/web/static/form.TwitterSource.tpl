@@ -11,6 +11,19 @@
 {.end}</textarea>
     </div>
 
+    <div>
+        Maximum statuses per minute:
+        <input name="maxRate" dojoType="dijit.form.TextBox" {.section maxRate}value="{@}"{.end} />
+    </div>
+
+    <div>
+        Sampling over the maximum:
+        <select name="sampling" dojoType="dijit.form.FilteringSelect" value="{sampling}">
+            <option value="uniform">Uniform</option>
+            <option value="pictures">Prefer pictures</option>
+            <option value="followed">Prefer followed users</option>
+        </select>
+    </div>
+
     <button dojoType="dijit.form.Button" onClick="BackChannel.actions.updateItem({_id}, this);">Save</button>
 </form>
-
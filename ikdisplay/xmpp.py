@@ -6,18 +6,24 @@ from twisted.python import log
 from twisted.words.protocols.jabber import error
 from twisted.words.protocols.jabber.jid import internJID as JID
 from twisted.words.protocols.jabber.xmlstream import IQ, TimeoutError
-from twisted.words.xish import domish
+from twisted.words.xish.domish import escapeToXml
 
 from wokkel.client import XMPPClient
+from wokkel.generic import parseXml
 from wokkel.ping import PingClientProtocol
-from wokkel.pubsub import Item, PubSubClient
+from wokkel.pubsub import Item, ItemsEvent, PubSubClient
 from wokkel.xmppim import MessageProtocol, PresenceProtocol
 
 from axiom import item, attributes
 
-NS_NOTIFICATION = 'http://mediamatic.nl/ns/ikdisplay/2009/notification'
+from ikdisplay.notification import NS_NOTIFICATION, Notification
+from ikdisplay.notification import elementToNotification, notificationToXml
+
 NS_X_DELAY='jabber:x:delay'
 NS_DELAY='urn:xmpp:delay'
+NS_JOURNAL = 'http://mediamatic.nl/ns/ikdisplay/2012/journal'
+
+JOURNAL_PUBSUB = 'pubsub'
 
 class JIDAttribute(attributes.text):
     """
@@ -67,9 +73,21 @@ class PubSubSubscription(item.Item):
 
 class IPubSubEventProcessor(Interface):
     subscription = Attribute("""Reference to subscription""")
+    payloadParser = Attribute("""
+        Optional callable to parse item payloads into records, or C{None}.
+
+        Processors of the same node that have the same parser get the
+        records from a single parse of each item.
+        """)
+
+    def itemsReceived(event, records=None):
+        """
+        Called when an items event is available for processing.
 
-    def itemsReceived(event):
-        """Called when an items event is available for processing."""
+        If this processor has a L{payloadParser}, C{records} holds the
+        parsed payload for each item in C{event}, as returned by
+        L{parseItems}.
+        """
 
 
     def installOnSubscription(other):
@@ -84,6 +102,201 @@ class IPubSubEventProcessor(Interface):
         """Return the pubsub node to subscribe to."""
 
 
+    def getRoutingFilter():
+        """
+        Return the filter for the parsed records this processor accepts.
+
+        The filter maps names of record attributes to the values accepted
+        for that attribute. If the attribute of a record holds a set of
+        values, like verbs, one of them must be accepted. A record must match
+        all entries of the filter. Only applies to processors that have a
+        L{payloadParser}.
+
+        @return: The filter, or C{None} to accept all records.
+        @rtype: C{dict}
+        """
+
+
+
+def parseItems(event, parser):
+    """
+    Parse the payloads of the items in an items event.
+
+    @param event: The items event.
+    @type event: L{wokkel.pubsub.ItemsEvent}
+    @param parser: Callable that takes a payload and returns a record.
+    @return: For each item, the record parsed from its payload, or C{None}
+        if the item has no payload or parsing failed.
+    @rtype: C{list}
+    """
+    records = []
+    for item in event.items:
+        try:
+            payload = item.elements().next()
+        except StopIteration:
+            records.append(None)
+            continue
+
+        try:
+            records.append(parser(payload))
+        except Exception:
+            log.err()
+            records.append(None)
+
+    return records
+
+
+
+def _matchFilter(routingFilter, record):
+    """
+    Check if a parsed record matches a routing filter.
+    """
+    for key, values in routingFilter.iteritems():
+        value = getattr(record, key, None)
+        if isinstance(value, (set, frozenset)):
+            if values.isdisjoint(value):
+                return False
+        elif value not in values:
+            return False
+    return True
+
+
+
+class PubSubRoutes(object):
+    """
+    Routes the items of a node to its observers.
+
+    Observers without a routing filter get all items. Observers with one
+    only get the items whose parsed records match their filter. These
+    observers are indexed by the values of one of the attributes in their
+    filter, the one with the fewest values. For each record, only the
+    observers found in these indexes are checked against the rest of
+    their filter.
+
+    @ivar observers: The observers that get all items, with their parser.
+    @type observers: C{list} of C{tuple}
+    @ivar indexes: Per parser, per record attribute, per value, the
+        observers with their filter.
+    @type indexes: C{dict}
+    """
+
+    def __init__(self, observers):
+        self.observers = []
+        self.indexes = {}
+
+        for observer in observers:
+            parser = getattr(observer, 'payloadParser', None)
+            routingFilter = None
+            if parser is not None:
+                routingFilter = observer.getRoutingFilter()
+
+            if routingFilter is None:
+                self.observers.append((observer, parser))
+                continue
+
+            routingFilter = dict((key, frozenset(values))
+                                 for key, values in routingFilter.iteritems())
+            key = min(routingFilter,
+                      key=lambda key: (len(routingFilter[key]), key))
+            index = self.indexes.setdefault(parser, {}).setdefault(key, {})
+            for value in routingFilter[key]:
+                index.setdefault(value, []).append((observer, routingFilter))
+
+
+    def _match(self, indexes, record):
+        """
+        Return the indexed observers whose filter matches a record.
+        """
+        seen = set()
+        matches = []
+        for key, index in indexes.iteritems():
+            value = getattr(record, key, None)
+            if isinstance(value, (set, frozenset)):
+                values = value
+            else:
+                values = (value,)
+
+            for value in values:
+                for observer, routingFilter in index.get(value, ()):
+                    if id(observer) in seen:
+                        continue
+                    seen.add(id(observer))
+                    if _matchFilter(routingFilter, record):
+                        matches.append(observer)
+        return matches
+
+
+    def deliver(self, event):
+        """
+        Pass an items event to the observers.
+
+        Observers with a filter are only called if at least one item
+        matches, and get C{None} instead of the records of the other items.
+        """
+        parsed = {}
+        def getRecords(parser):
+            if parser not in parsed:
+                parsed[parser] = parseItems(event, parser)
+            return parsed[parser]
+
+        for observer, parser in self.observers:
+            try:
+                if parser is None:
+                    observer.itemsReceived(event)
+                else:
+                    observer.itemsReceived(event, getRecords(parser))
+            except Exception, e:
+                log.err(e)
+
+        for parser, indexes in self.indexes.iteritems():
+            records = getRecords(parser)
+            routed = []
+            routedRecords = {}
+            for position, record in enumerate(records):
+                if record is None:
+                    continue
+
+                for observer in self._match(indexes, record):
+                    if id(observer) not in routedRecords:
+                        routed.append(observer)
+                        routedRecords[id(observer)] = [None] * len(records)
+                    routedRecords[id(observer)][position] = record
+
+            for observer in routed:
+                try:
+                    observer.itemsReceived(event, routedRecords[id(observer)])
+                except Exception, e:
+                    log.err(e)
+
+
+
+def serializeItemsEvent(event):
+    """
+    Serialize the node and items of an items event, for the journal.
+
+    @rtype: C{str}
+    """
+    xml = u"<items xmlns='%s' service='%s' node='%s'>%s</items>" % (
+            NS_JOURNAL,
+            escapeToXml(event.sender.full(), isattrib=1),
+            escapeToXml(event.nodeIdentifier, isattrib=1),
+            u''.join([item.toXml() for item in event.items]))
+    return xml.encode('utf-8')
+
+
+
+def parseItemsEvent(data, recipient):
+    """
+    Parse an items event serialized with L{serializeItemsEvent}.
+
+    @rtype: L{ItemsEvent}
+    """
+    element = parseXml(data)
+    items = [child for child in element.elements() if child.name == 'item']
+    return ItemsEvent(JID(element['service']), recipient, element['node'],
+                      items, None)
+
+
 
 class PubSubDispatcher(PubSubClient):
     """
@@ -102,18 +315,23 @@ class PubSubDispatcher(PubSubClient):
     @ivar delayFactor: Multiplication factor after each repeated temporary
         failure.
     @type delayFactor: C{float}
+    @ivar journal: Journal to record incoming events in, or C{None}.
+    @type journal: L{ikdisplay.journal.Journal}
     """
 
     delayInitial = 0.25
     delay = delayInitial
     delayMax = 16
     delayFactor = 2
+    journal = None
 
     def __init__(self, store, reactor=None):
         self.store = store
 
         self._initialized = False
         self._nodes = {}
+        self._routes = {}
+        self._waitingForConnection = []
 
         if reactor is None:
             from twisted.internet import reactor
@@ -291,6 +509,10 @@ class PubSubDispatcher(PubSubClient):
             self._subscribe(subscription.service,
                             subscription.nodeIdentifier)
 
+        waiting, self._waitingForConnection = self._waitingForConnection, []
+        for d in waiting:
+            d.callback(None)
+
 
     def connectionLost(self, reason):
         self._initialized = False
@@ -311,6 +533,7 @@ class PubSubDispatcher(PubSubClient):
                                                service=service,
                                                nodeIdentifier=nodeIdentifier)
         observer.installOnSubscription(subscription)
+        self.refreshRoutes()
 
         if self._initialized:
             d = self._subscribe(subscription.service,
@@ -330,6 +553,7 @@ class PubSubDispatcher(PubSubClient):
             return
 
         observer.uninstallFromSubscription(subscription)
+        self.refreshRoutes()
 
         powerups = subscription.powerupsFor(IPubSubEventProcessor)
         try:
@@ -341,6 +565,16 @@ class PubSubDispatcher(PubSubClient):
                 d.addErrback(log.err)
 
 
+    def refreshRoutes(self):
+        """
+        Forget the routes of all nodes.
+
+        Call this after changing an observer in a way that affects its
+        routing filter. The routes are set up again when items come in.
+        """
+        self._routes = {}
+
+
     def itemsReceived(self, event):
         """
         Called when items have been received.
@@ -356,42 +590,122 @@ class PubSubDispatcher(PubSubClient):
         L{domish.Element} and the node information dictionary.
 
         If items are received from unknown nodes, the subscription is
-        cancelled.
+        cancelled. Otherwise, if L{journal} is set, the event is recorded
+        in it first, to be replayed with L{replayItems}.
+
+        Observers that have a C{payloadParser} are passed the parsed records
+        along with the event. The payloads are parsed only once per parser,
+        however many observers use it. Items are routed to observers with
+        a routing filter using L{PubSubRoutes}.
         """
         if event.recipient != self.parent.jid:
             # This was not for us.
             return
 
+        subscription = self._getSubscription(event)
+        if subscription is None:
+            log.msg("Got event from %r, node %r. Unsubscribing." % (
+                event.sender, event.nodeIdentifier))
+            self.unsubscribe(event.sender, event.nodeIdentifier,
+                             event.recipient)
+            return
+
+        if self.journal is not None:
+            self.journal.append(JOURNAL_PUBSUB, serializeItemsEvent(event))
+
+        self._deliver(subscription, event)
+
+
+    def replayItems(self, data):
+        """
+        Deliver an items event that was recorded in the journal.
+
+        Events for nodes that are no longer subscribed to are ignored.
+        """
+        event = parseItemsEvent(data, self.parent.jid)
+        subscription = self._getSubscription(event)
+        if subscription is not None:
+            self._deliver(subscription, event)
+
+
+    def _getSubscription(self, event):
+        """
+        Return the subscription for the node of an event, or C{None}.
+        """
         try:
-            subscription = self.store.findUnique(PubSubSubscription,
+            return self.store.findUnique(PubSubSubscription,
                     attributes.AND(
                         PubSubSubscription.service==event.sender,
                         PubSubSubscription.nodeIdentifier==event.nodeIdentifier
                         )
                     )
         except KeyError:
-            log.msg("Got event from %r, node %r. Unsubscribing." % (
-                event.sender, event.nodeIdentifier))
-            self.unsubscribe(event.sender, event.nodeIdentifier,
-                             event.recipient)
-            return
+            return None
 
-        for observer in subscription.powerupsFor(IPubSubEventProcessor):
-            try:
-                observer.itemsReceived(event)
-            except Exception, e:
-                log.err(e)
+
+    def _deliver(self, subscription, event):
+        """
+        Route the items of an event to the observers of its subscription.
+        """
+        node = (subscription.service, subscription.nodeIdentifier)
+        try:
+            routes = self._routes[node]
+        except KeyError:
+            observers = subscription.powerupsFor(IPubSubEventProcessor)
+            routes = self._routes[node] = PubSubRoutes(observers)
+
+        routes.deliver(event)
+
+
+    def fetchNotifications(self, service, nodeIdentifier, maxItems):
+        """
+        Retrieve the last notifications published to a node.
+
+        If the connection has not been established yet, the request is sent
+        once it has.
+
+        @return: Deferred that fires with a list of L{Notification}s.
+        """
+        def request(_):
+            return self.items(service, nodeIdentifier, maxItems)
+
+        def cb(items):
+            notifications = []
+            for item in items:
+                for element in item.elements():
+                    if (element.uri == NS_NOTIFICATION and
+                        element.name == 'notification'):
+                        notification = elementToNotification(element)
+                        notification.itemIdentifier = item.getAttribute('id')
+                        notifications.append(notification)
+            return notifications
+
+        if self._initialized:
+            d = defer.succeed(None)
+        else:
+            d = defer.Deferred()
+            self._waitingForConnection.append(d)
+        d.addCallback(request)
+        d.addCallback(cb)
+        return d
 
 
     def publishNotifications(self, service, nodeIdentifier, notifications):
-        items = []
-        for notification in notifications:
-            payload = domish.Element((NS_NOTIFICATION, 'notification'))
+        """
+        Publish notifications to a node.
 
-            for key, value in notification.iteritems():
-                payload.addElement(key, content=value)
+        The notifications are included as their cached XML serialization, and
+        the same items are used when publishing is retried. Notifications
+        with an item identifier replace the item with that identifier.
 
-            items.append(Item(payload=payload))
+        @return: Deferred that fires when the notifications have been
+            published, or errbacks if publishing failed.
+        """
+        items = []
+        for notification in notifications:
+            item = Item(getattr(notification, 'itemIdentifier', None))
+            item.addRawXml(notificationToXml(notification))
+            items.append(item)
 
         def trapNotFound(failure):
             """
@@ -405,13 +719,11 @@ class PubSubDispatcher(PubSubClient):
                 d = self.createNode(service, nodeIdentifier)
                 d.addCallback(lambda _: self.publish(service, nodeIdentifier,
                                                      items))
-
-        def eb(failure):
-            log.err(failure)
+                return d
 
         d = self.publish(service, nodeIdentifier, items)
         d.addErrback(trapNotFound)
-        d.addErrback(eb)
+        return d
 
 
 
@@ -457,10 +769,10 @@ class GroupChatHandler(MessageProtocol):
             sender.resource and
             (not message.x or message.x.uri not in (NS_X_DELAY, NS_X_DELAY))):
 
-            notification = {
-                    u'title': sender.resource or u'*',
-                    u'subtitle': unicode(message.body),
-                    }
+            notification = Notification(
+                    title=sender.resource or u'*',
+                    subtitle=unicode(message.body),
+                    )
             self.aggregator.processNotification(notification)
 
 
@@ -19,6 +19,14 @@ backChannel =
 
     addMessage: function(message, callback)
     {
+        // Updates of an item that is shown replace it in place.
+        var existing = backChannel.findMessage(message.id);
+        if (existing.length)
+        {
+            backChannel.updateMessage(existing, message, callback);
+            return;
+        }
+
         var clone = function()
         {
             backChannel.cloneMessage(message, callback);
@@ -55,8 +63,35 @@ backChannel =
                 .prependTo($(backChannel.options.itemList));
     },
 
+    findMessage: function(id)
+    {
+        if (!id)
+        {
+            return $();
+        }
+
+        return $('.item').filter(function () {
+            return $(this).attr('data-item-id') === id;
+            }).first();
+    },
+
+    updateMessage: function(existing, message, callback)
+    {
+        var clonedItem = $('.clone-item').clone().show().removeClass('clone-item').addClass('item');
+        backChannel.fillClone(clonedItem, message);
+        if (backChannel.options.resetHeight)
+        {
+            clonedItem.css('height', 'auto');
+        } else {
+            clonedItem.css('height', existing.css('height'));
+        }
+        existing.replaceWith(clonedItem);
+        callback();
+    },
+
     fillClone: function(clone, message)
     {
+        clone.attr('data-item-id', message.id || '');
         $('.list-ikdisplay-backchannel-title', clone).text(message.title);
         if (message.html)
         {
@@ -74,7 +109,12 @@ backChannel =
           $('a', $meta_node).remove();
           $meta_text_node = $meta_node;
         }
-        $meta_text_node.text(message.meta);
+        if (message.retweets)
+        {
+            $meta_text_node.text(message.meta + ' \u00b7 ' + message.retweets + ' RT');
+        } else {
+            $meta_text_node.text(message.meta);
+        }
 
         if (message.picture)
         {